@@ -0,0 +1,270 @@
+"""
+A logic analyzer core that captures signals of a design into the BRAMs of
+the ice40 and sends them over the UART.
+
+`DefineLogicAnalyzer(width, depth, pretrigger)` samples I, `width` bits, into
+a ring buffer of `depth` samples while it is armed.  ARM starts a capture,
+the first TRIGGER after `pretrigger` samples are in the buffer ends it
+`depth - pretrigger` samples later, so the buffer holds `pretrigger` samples
+before the trigger, the trigger and the samples after it.  The buffer is
+then sent from the oldest sample on, ceil(width / 8) bytes per sample with
+the most significant byte first, as O and VALID for the data and valid of
+TXMOD.  logic_analyzer_dump.py arms the core and decodes the samples.
+
+A BRAM of the hx1k is 256 x 16, 512 x 8, 1024 x 4 or 2048 x 2 bits, so the
+core takes ceil(width / (4096 / depth)) BRAMs.
+"""
+from magma import *
+import mantle
+import math
+import os
+from functools import lru_cache
+from mantle.lattice.ice40 import RAMB
+
+
+# the UART receiver and transmitter of examples/uart, 115200 baud at 12 MHz
+uart_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'uart')
+RXMOD = DefineFromVerilogFile(os.path.join(uart_dir, 'rxmod.v'))[0]
+TXMOD = DefineFromVerilogFile(os.path.join(uart_dir, 'txmod.v'))[0]
+
+# depths of the BRAM geometries of the ice40
+depths = (256, 512, 1024, 2048)
+
+
+def sample_bytes(width):
+    return (width + 7) // 8
+
+
+# I is sampled in the cycles CE is high (has_ce), otherwise in every cycle
+# ARMED is high from ARM to the end of the capture, VALID is held until READY takes a byte
+@lru_cache(maxsize=None)
+def DefineLogicAnalyzer(width, depth=256, pretrigger=0, has_ce=False):
+    assert depth in depths
+    assert 0 <= pretrigger < depth
+    # bits of a sample in a BRAM
+    ram_width = 4096 // depth
+    num_rams = (width + ram_width - 1) // ram_width
+    assert num_rams <= 16
+    # number of bits for depth
+    n = int(math.log2(depth))
+    num_bytes = sample_bytes(width)
+    # the bytes of a sample are selected by a Mux of up to 16
+    assert num_bytes <= 16
+    # number of bits for num_bytes
+    n_bytes = int(math.ceil(math.log2(num_bytes)))
+
+    class LogicAnalyzer(Circuit):
+        name = 'LogicAnalyzer{}x{}_{}'.format(width, depth, pretrigger) + ('_CE' if has_ce else '')
+        IO = ['I', In(Bits(width)), 'TRIGGER', In(Bit), 'ARM', In(Bit), 'READY', In(Bit),
+              'CLK', In(Clock), 'O', Out(Bits(8)), 'VALID', Out(Bit), 'ARMED', Out(Bit)]
+        if has_ce:
+            IO += ['CE', In(Bit)]
+        @classmethod
+        def definition(io):
+            reg_armed = mantle.DFF()
+            reg_triggered = mantle.DFF()
+            reg_send = mantle.DFF()
+            adder_waddr = mantle.Add(n, cin=False, cout=False)
+            reg_waddr = mantle.Register(n, has_ce=True, has_reset=True)
+            adder_stop = mantle.Add(n, cin=False, cout=False)
+            reg_stop = mantle.Register(n, has_ce=True)
+            wire(io.CLK, reg_armed.CLK)
+            wire(io.CLK, reg_triggered.CLK)
+            wire(io.CLK, reg_send.CLK)
+            wire(io.CLK, reg_waddr.CLK)
+            wire(io.CLK, reg_stop.CLK)
+            # ARM starts a capture while the core is idle
+            or_busy = mantle.Or()
+            wire(reg_armed.O, or_busy.I0)
+            wire(reg_send.O, or_busy.I1)
+            nand_idle = mantle.NAnd()
+            wire(or_busy.O, nand_idle.I0)
+            wire(or_busy.O, nand_idle.I1)
+            and_go = mantle.And()
+            wire(io.ARM, and_go.I0)
+            wire(nand_idle.O, and_go.I1)
+            go = and_go.O
+            # the capture is complete when the write address reaches the stop address
+            comparison_stop = mantle.EQ(n)
+            wire(reg_waddr.O, comparison_stop.I0)
+            wire(reg_stop.O, comparison_stop.I1)
+            and_complete = mantle.And()
+            wire(reg_triggered.O, and_complete.I0)
+            wire(comparison_stop.O, and_complete.I1)
+            complete = and_complete.O
+            nand_complete = mantle.NAnd()
+            wire(complete, nand_complete.I0)
+            wire(complete, nand_complete.I1)
+            and_capture = mantle.And()
+            wire(reg_armed.O, and_capture.I0)
+            wire(nand_complete.O, and_capture.I1)
+            capture = and_capture.O
+            if has_ce:
+                and_write = mantle.And()
+                wire(capture, and_write.I0)
+                wire(io.CE, and_write.I1)
+                write = and_write.O
+            else:
+                write = capture
+            # a trigger is taken in a sample while armed, once pretrigger samples are written
+            nand_triggered = mantle.NAnd()
+            wire(reg_triggered.O, nand_triggered.I0)
+            wire(reg_triggered.O, nand_triggered.I1)
+            and_trigger_1 = mantle.And()
+            and_trigger_2 = mantle.And()
+            wire(write, and_trigger_1.I0)
+            wire(io.TRIGGER, and_trigger_1.I1)
+            wire(and_trigger_1.O, and_trigger_2.I0)
+            wire(nand_triggered.O, and_trigger_2.I1)
+            accept = and_trigger_2.O
+            if pretrigger:
+                reg_filled = mantle.DFF()
+                wire(io.CLK, reg_filled.CLK)
+                comparison_filled = mantle.EQ(n)
+                wire(reg_waddr.O, comparison_filled.I0)
+                wire(bits(pretrigger, n), comparison_filled.I1)
+                or_filled = mantle.Or()
+                wire(reg_filled.O, or_filled.I0)
+                wire(comparison_filled.O, or_filled.I1)
+                and_filled = mantle.And()
+                wire(reg_armed.O, and_filled.I0)
+                wire(or_filled.O, and_filled.I1)
+                wire(and_filled.O, reg_filled.I)
+                and_accept = mantle.And()
+                wire(accept, and_accept.I0)
+                wire(reg_filled.O, and_accept.I1)
+                accept = and_accept.O
+            # the capture stops depth - pretrigger samples after the trigger, where the
+            # oldest sample of the buffer is
+            wire(reg_waddr.O, adder_stop.I0)
+            wire(bits((depth - pretrigger) % depth, n), adder_stop.I1)
+            wire(adder_stop.O, reg_stop.I)
+            wire(accept, reg_stop.CE)
+            or_armed = mantle.Or()
+            wire(go, or_armed.I0)
+            wire(capture, or_armed.I1)
+            wire(or_armed.O, reg_armed.I)
+            and_triggered = mantle.And()
+            wire(reg_triggered.O, and_triggered.I0)
+            wire(nand_complete.O, and_triggered.I1)
+            or_triggered = mantle.Or()
+            wire(accept, or_triggered.I0)
+            wire(and_triggered.O, or_triggered.I1)
+            wire(or_triggered.O, reg_triggered.I)
+            # ARM starts writing at 0
+            or_waddr_ce = mantle.Or()
+            wire(go, or_waddr_ce.I0)
+            wire(write, or_waddr_ce.I1)
+            wire(reg_waddr.O, adder_waddr.I0)
+            wire(bits(1, n), adder_waddr.I1)
+            wire(adder_waddr.O, reg_waddr.I)
+            wire(or_waddr_ce.O, reg_waddr.CE)
+            wire(go, reg_waddr.RESET)
+
+            # send the samples from the oldest one on, a sample is read from the RAMs a
+            # cycle after its address, so VALID waits a cycle after every sample
+            adder_sample = mantle.Add(n, cin=False, cout=False)
+            reg_sample = mantle.Register(n, has_ce=True, has_reset=True)
+            adder_raddr = mantle.Add(n, cin=False, cout=False)
+            reg_wait = mantle.DFF()
+            wire(io.CLK, reg_sample.CLK)
+            wire(io.CLK, reg_wait.CLK)
+            nand_wait = mantle.NAnd()
+            wire(reg_wait.O, nand_wait.I0)
+            wire(reg_wait.O, nand_wait.I1)
+            and_valid = mantle.And()
+            wire(reg_send.O, and_valid.I0)
+            wire(nand_wait.O, and_valid.I1)
+            and_taken = mantle.And()
+            wire(and_valid.O, and_taken.I0)
+            wire(io.READY, and_taken.I1)
+            taken = and_taken.O
+            if num_bytes > 1:
+                adder_byte = mantle.Add(n_bytes, cin=False, cout=False)
+                reg_byte = mantle.Register(n_bytes, has_ce=True, has_reset=True)
+                wire(io.CLK, reg_byte.CLK)
+                comparison_byte = mantle.EQ(n_bytes)
+                wire(reg_byte.O, comparison_byte.I0)
+                wire(bits(num_bytes - 1, n_bytes), comparison_byte.I1)
+                wire(reg_byte.O, adder_byte.I0)
+                wire(bits(1, n_bytes), adder_byte.I1)
+                wire(adder_byte.O, reg_byte.I)
+                or_byte_ce = mantle.Or()
+                wire(taken, or_byte_ce.I0)
+                wire(complete, or_byte_ce.I1)
+                wire(or_byte_ce.O, reg_byte.CE)
+                or_byte_reset = mantle.Or()
+                wire(comparison_byte.O, or_byte_reset.I0)
+                wire(complete, or_byte_reset.I1)
+                wire(or_byte_reset.O, reg_byte.RESET)
+                and_next = mantle.And()
+                wire(taken, and_next.I0)
+                wire(comparison_byte.O, and_next.I1)
+                next_sample = and_next.O
+            else:
+                next_sample = taken
+            or_wait = mantle.Or()
+            wire(next_sample, or_wait.I0)
+            wire(complete, or_wait.I1)
+            wire(or_wait.O, reg_wait.I)
+            comparison_sample = mantle.EQ(n)
+            wire(reg_sample.O, comparison_sample.I0)
+            wire(bits(depth - 1, n), comparison_sample.I1)
+            and_last = mantle.And()
+            wire(next_sample, and_last.I0)
+            wire(comparison_sample.O, and_last.I1)
+            nand_last = mantle.NAnd()
+            wire(and_last.O, nand_last.I0)
+            wire(and_last.O, nand_last.I1)
+            and_send = mantle.And()
+            wire(reg_send.O, and_send.I0)
+            wire(nand_last.O, and_send.I1)
+            or_send = mantle.Or()
+            wire(complete, or_send.I0)
+            wire(and_send.O, or_send.I1)
+            wire(or_send.O, reg_send.I)
+            or_sample_ce = mantle.Or()
+            wire(next_sample, or_sample_ce.I0)
+            wire(complete, or_sample_ce.I1)
+            wire(reg_sample.O, adder_sample.I0)
+            wire(bits(1, n), adder_sample.I1)
+            wire(adder_sample.O, reg_sample.I)
+            wire(or_sample_ce.O, reg_sample.CE)
+            wire(complete, reg_sample.RESET)
+            # the write address stops at the oldest sample
+            wire(reg_waddr.O, adder_raddr.I0)
+            wire(reg_sample.O, adder_raddr.I1)
+
+            # RAM i holds bits [i * ram_width, (i + 1) * ram_width) of the samples
+            sample = []
+            for i in range(num_rams):
+                ram = RAMB(depth, ram_width)
+                used = min(ram_width, width - i * ram_width)
+                if used < ram_width:
+                    wire(concat(io.I[i * ram_width:], bits(0, ram_width - used)), ram.WDATA)
+                else:
+                    wire(io.I[i * ram_width:(i + 1) * ram_width], ram.WDATA)
+                wire(reg_waddr.O, ram.WADDR)
+                wire(enable(write), ram.WE)
+                wire(io.CLK, ram.WCLK)
+                wire(adder_raddr.O, ram.RADDR)
+                wire(1, ram.RE)
+                wire(io.CLK, ram.RCLK)
+                sample += [ram.RDATA[j] for j in range(used)]
+            # byte k of a sample is bits [8 * (num_bytes - 1 - k), 8 * (num_bytes - k))
+            if num_bytes == 1:
+                byte_ports = [io.O]
+            else:
+                mux_byte = mantle.Mux(height=2 ** n_bytes, width=8)
+                byte_ports = [getattr(mux_byte, 'I{}'.format(k)) for k in range(2 ** n_bytes)]
+                # a Mux of 2 selects with a Bit
+                wire(reg_byte.O if n_bytes > 1 else reg_byte.O[0], mux_byte.S)
+                wire(mux_byte.O, io.O)
+            for k, byte in enumerate(byte_ports):
+                for j in range(8):
+                    i = 8 * (num_bytes - 1 - k) + j
+                    wire(sample[i] if k < num_bytes and i < width else 0, byte[j])
+            wire(and_valid.O, io.VALID)
+            wire(reg_armed.O, io.ARMED)
+
+    return LogicAnalyzer
@@ -0,0 +1,84 @@
+"""
+Host side of the logic analyzer core: arm it, download a capture over the
+UART and decode it into NumPy arrays.
+
+The core sends `depth` samples of ceil(width / 8) bytes, the most significant
+byte first, from the oldest sample on; sample `pretrigger` is the trigger.
+The capture is saved as .npy (the samples) and optionally as a .csv in the
+format of the Saleae exports in notebooks/signal-generator/*/data, a row per
+change with the time in seconds and channel 0 (bit 0) first, so the
+notebooks load it like their captures.
+
+usage: python logic_analyzer_dump.py usb_path --width W --depth D [--pretrigger P]
+                                     [--rate Hz] [--out capture.npy] [--csv capture.csv]
+"""
+import argparse
+
+import numpy as np
+import serial
+
+
+# the byte that arms the core, logic_analyzer_main.py takes any byte
+ARM = b'a'
+
+
+def read_capture(ser, width, depth):
+    """Arm the core and read the bytes of a capture."""
+    num_bytes = (width + 7) // 8
+    ser.write(ARM)
+    data = ser.read(depth * num_bytes)
+    if len(data) < depth * num_bytes:
+        raise IOError('received {} of {} bytes, was the trigger seen?'.format(len(data), depth * num_bytes))
+    return data
+
+
+def decode(data, width):
+    """The samples of a capture, uint64 array of shape [depth]."""
+    num_bytes = (width + 7) // 8
+    words = np.frombuffer(data, dtype=np.uint8).reshape(-1, num_bytes).astype(np.uint64)
+    shifts = np.arange(8 * (num_bytes - 1), -1, -8, dtype=np.uint64)
+    return (words << shifts).sum(axis=1, dtype=np.uint64) & np.uint64((1 << width) - 1)
+
+
+def channels(samples, width):
+    """The bits of the samples, uint8 array of shape [depth, width], channel 0 is bit 0."""
+    return (samples[:, None] >> np.arange(width, dtype=np.uint64) & np.uint64(1)).astype(np.uint8)
+
+
+def write_csv(filename, bits, rate, pretrigger=0):
+    """Write the changes of the channels like a Saleae export, time 0 is the trigger."""
+    changed = np.ones(len(bits), dtype=bool)
+    changed[1:] = np.any(bits[1:] != bits[:-1], axis=1)
+    times = (np.arange(len(bits)) - pretrigger) / rate
+    with open(filename, 'w') as csv_file:
+        csv_file.write(', '.join(['Time[s]'] + ['Channel {}'.format(i) for i in range(bits.shape[1])]) + '\n')
+        for time, row in zip(times[changed], bits[changed]):
+            csv_file.write(', '.join(['{:.15f}'.format(time)] + [str(bit) for bit in row]) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('usb_path')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--width', type=int, required=True, help='width of the core')
+    parser.add_argument('--depth', type=int, required=True, help='depth of the core')
+    parser.add_argument('--pretrigger', type=int, default=0, help='pretrigger of the core')
+    parser.add_argument('--rate', type=float, default=12e6, help='sample rate of the core in Hz')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='seconds to wait for the trigger and the samples')
+    parser.add_argument('--out', default='capture.npy')
+    parser.add_argument('--csv', help='also write the capture in the format of the Saleae exports')
+    args = parser.parse_args()
+
+    with serial.Serial(args.usb_path, args.baud, timeout=args.timeout) as ser:
+        data = read_capture(ser, args.width, args.depth)
+    samples = decode(data, args.width)
+    np.save(args.out, samples)
+    print('{}: {} samples of {} bits, trigger at {}'.format(args.out, len(samples), args.width, args.pretrigger))
+    if args.csv:
+        write_csv(args.csv, channels(samples, args.width), args.rate, args.pretrigger)
+        print('{}: written'.format(args.csv))
+
+
+if __name__ == '__main__':
+    main()
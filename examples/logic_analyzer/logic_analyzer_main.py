@@ -0,0 +1,70 @@
+"""
+The sine wave generator of notebooks/signal-generator with a logic analyzer
+on its output.
+
+The 8 bit wave is on J3 like in the notebook and is sampled once per entry
+of the wavetable, the capture triggers at the start of a period.  Any byte
+received over the UART arms the logic analyzer, D5 is lit while it is armed.
+
+    ../../bin/magma -b icestick logic_analyzer_main.py
+    python logic_analyzer_dump.py usb_path --width 8 --depth 512 --pretrigger 64 --rate 46875 \
+                                  --csv sine-capture.csv
+"""
+from magma import *
+import mantle
+import math
+from loam.boards.icestick import IceStick
+from mantle.lattice.ice40 import ROMB
+from logic_analyzer import DefineLogicAnalyzer, RXMOD, TXMOD
+
+
+width = 8
+depth = 512
+pretrigger = 64
+
+
+icestick = IceStick()
+icestick.Clock.on()
+icestick.RX.input().on()
+icestick.TX.output().on()
+for i in range(width):
+    icestick.J3[i].output().on()
+icestick.D5.on()
+
+main = icestick.main()
+
+# the address of the wavetable is bits [8, 16) of a counter, as in the notebook
+counter = mantle.Counter(16)
+wire(main.CLKIN, counter.CLK)
+wavetable = [int(128 + 127 * math.sin(2 * math.pi * i / 256)) for i in range(256)]
+rom = ROMB(256, 16, wavetable)
+wire(counter.O[8:16], rom.RADDR)
+wire(1, rom.RE)
+wire(main.CLKIN, rom.RCLK)
+wire(rom.RDATA[:width], main.J3)
+
+rx = RXMOD()
+tx = TXMOD()
+analyzer = DefineLogicAnalyzer(width, depth, pretrigger, has_ce=True)()
+wire(main.CLKIN, rx.CLK)
+wire(main.CLKIN, tx.CLK)
+wire(main.CLKIN, analyzer.CLK)
+wire(main.RX, rx.RX)
+wire(rom.RDATA[:width], analyzer.I)
+# a sample per entry of the wavetable, in the last cycle of the entry
+comparison_sample = mantle.EQ(8)
+wire(counter.O[:8], comparison_sample.I0)
+wire(bits(255, 8), comparison_sample.I1)
+wire(comparison_sample.O, analyzer.CE)
+comparison_trigger = mantle.EQ(8)
+wire(counter.O[8:16], comparison_trigger.I0)
+wire(bits(0, 8), comparison_trigger.I1)
+wire(comparison_trigger.O, analyzer.TRIGGER)
+wire(rx.valid, analyzer.ARM)
+wire(tx.ready, analyzer.READY)
+wire(analyzer.O, tx.data)
+wire(analyzer.VALID, tx.valid)
+wire(tx.TX, main.TX)
+wire(analyzer.ARMED, main.D5)
+
+EndCircuit()
@@ -0,0 +1,102 @@
+import math
+from functools import lru_cache
+import magma as m
+m.set_mantle_target("ice40")
+from mantle import Register, Add
+from mantle.lattice.ice40 import RAMB
+
+
+# depths of the BRAM geometries of the ice40, it has no distributed RAM
+depths = (256, 512, 1024, 2048)
+
+
+@lru_cache(maxsize=None)
+def DefineFIFO(depth=512):
+    """A FIFO of depth bytes in the BRAMs of the ice40.
+
+    I, I_valid and I_ready take a byte like TXMOD does, O, O_valid and
+    O_ready hand them on with the oldest byte in O as long as O_valid is high.
+    LEVEL is the number of bytes in the FIFO, FULL and EMPTY are LEVEL ==
+    depth and LEVEL == 0.  A byte is in O two cycles after it was taken.
+    """
+    assert depth in depths
+    # number of bits for depth
+    n = int(math.log2(depth))
+    # bits of a byte in a BRAM
+    ram_width = 4096 // depth
+    num_rams = (8 + ram_width - 1) // ram_width
+
+    class FIFO(m.Circuit):
+        name = f"FIFO{depth}"
+        IO = ["I", m.In(m.Bits(8)),
+              "I_valid", m.In(m.Bit),
+              "I_ready", m.Out(m.Bit),
+              "O", m.Out(m.Bits(8)),
+              "O_valid", m.Out(m.Bit),
+              "O_ready", m.In(m.Bit),
+              "LEVEL", m.Out(m.Bits(n + 1)),
+              "FULL", m.Out(m.Bit),
+              "EMPTY", m.Out(m.Bit),
+              "CLK", m.In(m.Clock),]
+
+        @classmethod
+        def definition(io):
+            waddr = Register(n, init=0, has_ce=True)
+            raddr = Register(n, init=0, has_ce=True)
+            level = Register(n + 1, init=0)
+            # O holds a byte read from the BRAMs
+            holding = Register(1, init=0)
+
+            full = level.O == m.bits(depth, n + 1)
+            empty = level.O == m.bits(0, n + 1)
+            write = io.I_valid & ~full
+            taken = holding.O[0] & io.O_ready
+            # the bytes in the BRAMs are those of LEVEL but the one in O
+            stored = ~(empty | ((level.O == m.bits(1, n + 1)) & holding.O[0]))
+            # a byte is read when O is free or taken in this cycle, the BRAMs
+            # never read the address written in the same cycle
+            read = stored & (~holding.O[0] | taken)
+            m.wire(read | (holding.O[0] & ~taken), holding.I[0])
+
+            waddr_next = Add(n)
+            m.wire(waddr.O, waddr_next.I0)
+            m.wire(m.bits(1, n), waddr_next.I1)
+            m.wire(waddr_next.O, waddr.I)
+            m.wire(write, waddr.CE)
+            raddr_next = Add(n)
+            m.wire(raddr.O, raddr_next.I0)
+            m.wire(m.bits(1, n), raddr_next.I1)
+            m.wire(raddr_next.O, raddr.I)
+            m.wire(read, raddr.CE)
+
+            # LEVEL + 1 on a write, - 1 (all ones) on a byte taken, both or none leave it
+            level_next = Add(n + 1)
+            m.wire(level.O, level_next.I0)
+            m.wire(m.bits([write ^ taken] + n * [taken & ~write]), level_next.I1)
+            m.wire(level_next.O, level.I)
+
+            # RAM i holds bits [i * ram_width, (i + 1) * ram_width) of the bytes
+            data = []
+            for i in range(num_rams):
+                ram = RAMB(depth, ram_width)
+                used = min(ram_width, 8 - i * ram_width)
+                if used < ram_width:
+                    m.wire(m.concat(io.I[i * ram_width:], m.bits(0, ram_width - used)), ram.WDATA)
+                else:
+                    m.wire(io.I[i * ram_width:(i + 1) * ram_width], ram.WDATA)
+                m.wire(waddr.O, ram.WADDR)
+                m.wire(m.enable(write), ram.WE)
+                m.wire(io.CLK, ram.WCLK)
+                m.wire(raddr.O, ram.RADDR)
+                m.wire(m.enable(read), ram.RE)
+                m.wire(io.CLK, ram.RCLK)
+                data += [ram.RDATA[j] for j in range(used)]
+
+            m.wire(m.bits(data), io.O)
+            m.wire(holding.O[0], io.O_valid)
+            m.wire(~full, io.I_ready)
+            m.wire(level.O, io.LEVEL)
+            m.wire(full, io.FULL)
+            m.wire(empty, io.EMPTY)
+
+    return FIFO
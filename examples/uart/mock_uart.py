@@ -0,0 +1,83 @@
+"""
+A pseudo terminal that stands in for an icestick running uart_loopback.py, so
+the UART drivers can be tested and benchmarked without hardware.
+
+Every byte written to the terminal comes back, at most baud / 10 bytes per
+second like on an 8N1 line; `respond` can replace the echo by another
+design, it maps the bytes received to the bytes sent back.
+
+usage: python mock_uart.py [--count N] [--baud B]
+"""
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+
+class MockUART:
+    def __init__(self, baud=115200, respond=None):
+        self.baud = baud
+        self.respond = respond or (lambda data: data)
+        self.master = None
+        self.slave = None
+        self.path = None
+        self.done = False
+        self.thread = None
+
+    def __enter__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self):
+        # the time the last byte sent back leaves the line
+        line = time.perf_counter()
+        while not self.done:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                # the other side is closed
+                break
+            response = self.respond(data)
+            if self.baud:
+                line = max(line, time.perf_counter()) + 10 * len(response) / self.baud
+            os.write(self.master, response)
+            if self.baud:
+                time.sleep(max(0, line - time.perf_counter()))
+
+    def close(self):
+        self.done = True
+        if self.thread:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = self.thread = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--count", type=int, default=1, help="number of devices")
+    parser.add_argument("--baud", type=int, default=115200, help="line rate, 0 for none")
+    args = parser.parse_args()
+    devices = [MockUART(args.baud).__enter__() for _ in range(args.count)]
+    print(" ".join(device.path for device in devices), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for device in devices:
+            device.close()
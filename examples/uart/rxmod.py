@@ -0,0 +1,240 @@
+import math
+import sys
+from functools import lru_cache
+import magma as m
+m.set_mantle_target("ice40")
+from mantle import Register, Add
+from fifo import DefineFIFO
+from txmod import divider
+
+
+@m.circuit.combinational
+def rxmod_logic(
+        rx : m.Bits(1),
+        majority : m.Bits(1),
+        tick : m.Bit,
+        first : m.Bit,
+        second : m.Bit,
+        decide : m.Bit,
+        last : m.Bit,
+        reading : m.Bit,
+        samples : m.Bits(2),
+        readBit : m.Bits(4),
+        data : m.Bits(8),) -> (m.Bit,
+                               m.Bits(2),
+                               m.Bits(4),
+                               m.Bits(8),
+                               m.Bit,
+                               m.Bit,):
+
+    if (reading == m.bit(0)) & (tick == m.bit(1)) & (rx == m.bits(0, 1)):
+        # the first sample of a start bit
+        reading_out = m.bit(1)
+        samples_out = samples
+        readBit_out = m.bits(0, 4)
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(1)
+    elif (reading == m.bit(1)) & (first == m.bit(1)):
+        reading_out = reading
+        samples_out = m.concat(rx, samples[1:])
+        readBit_out = readBit
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+    elif (reading == m.bit(1)) & (second == m.bit(1)):
+        reading_out = reading
+        samples_out = m.concat(samples[0:1], rx)
+        readBit_out = readBit
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+    elif (reading == m.bit(1)) & \
+         (decide == m.bit(1)) & \
+         (readBit == m.bits(0, 4)) & \
+         (majority == m.bits(1, 1)):
+        # a glitch, not a start bit
+        reading_out = m.bit(0)
+        samples_out = samples
+        readBit_out = readBit
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+    elif (reading == m.bit(1)) & \
+         (decide == m.bit(1)) & \
+         (readBit == m.bits(9, 4)):
+        # the middle of the stop bit, the byte is valid without a framing
+        # error and the next start bit is looked for from here on
+        reading_out = m.bit(0)
+        samples_out = samples
+        readBit_out = readBit
+        data_out = data
+        valid_out = majority[0]
+        start_out = m.bit(0)
+    elif (reading == m.bit(1)) & (decide == m.bit(1)):
+        # the bits come LSB first, the start bit is shifted out by the data
+        reading_out = reading
+        samples_out = samples
+        readBit_out = readBit
+        data_out = m.concat(data[1:], majority)
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+    elif (reading == m.bit(1)) & (last == m.bit(1)):
+        reading_out = reading
+        samples_out = samples
+        readBit_out = m.bits(m.uint(readBit) + m.bits(1, 4))
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+    else:
+        reading_out = reading
+        samples_out = samples
+        readBit_out = readBit
+        data_out = data
+        valid_out = m.bit(0)
+        start_out = m.bit(0)
+
+    return (reading_out,
+            samples_out,
+            readBit_out,
+            data_out,
+            valid_out,
+            start_out,)
+
+
+@lru_cache(maxsize=None)
+def DefineRXMOD(clock_hz=12000000, baud=115200, oversample=16):
+    """An 8N1 receiver of baud at a clock of clock_hz, a drop-in for rxmod.v.
+
+    RX is sampled oversample times a bit, the value of a bit is the majority
+    of the 3 samples in its middle.  The receiver looks for the next start
+    bit from the middle of a stop bit on, so it keeps up with a continuous
+    stream from a sender 2% (oversample 8) to 3% (16 and 32) faster than
+    baud, and oversample * baud is at most clock_hz / 2.  valid is high for
+    a cycle with the byte in data, which holds until the next byte comes in;
+    bytes with a framing error are dropped.
+    """
+    assert oversample in (8, 16, 32)
+    # number of bits for oversample
+    n = int(math.log2(oversample))
+    # the start bit is found at sample 0, sample s of a bit is taken in the
+    # tick with count s - 1, the majority is of samples mid - 1 to mid + 1
+    mid = oversample // 2
+    width, inc = divider(clock_hz, oversample * baud)
+
+    class RXMOD(m.Circuit):
+        name = "RXMOD" if (clock_hz, baud, oversample) == (12000000, 115200, 16) \
+            else f"RXMOD_{clock_hz}_{baud}_{oversample}"
+        IO = ["RX", m.In(m.Bit),
+              "CLK", m.In(m.Clock),
+              "data", m.Out(m.Bits(8)),
+              "valid", m.Out(m.Bit),]
+
+        @classmethod
+        def definition(io):
+            # RX crosses into the clock through two registers
+            RX_1 = Register(1, init=1)
+            RX_2 = Register(1, init=1)
+            m.wire(io.RX, RX_1.I[0])
+            m.wire(RX_1.O, RX_2.I)
+            # the sample clock, a tick when the accumulator overflows
+            phase = Register(width, init=0)
+            phase_add = Add(width, cout=True)
+            m.wire(phase.O, phase_add.I0)
+            m.wire(m.bits(inc, width), phase_add.I1)
+            m.wire(phase_add.O, phase.I)
+            tick = phase_add.COUT
+            count = Register(n, init=0, has_ce=True, has_reset=True)
+            count_add = Add(n)
+            m.wire(count.O, count_add.I0)
+            m.wire(m.bits(1, n), count_add.I1)
+            m.wire(count_add.O, count.I)
+            m.wire(tick, count.CE)
+
+            reading = Register(1, init=0)
+            samples = Register(2, init=0)
+            readBit = Register(4, init=0)
+            dataReg = Register(8, init=0)
+            validReg = Register(1, init=0)
+            rx = RX_2.O[0]
+            majority = (samples.O[0] & samples.O[1]) | \
+                       (samples.O[0] & rx) | \
+                       (samples.O[1] & rx)
+            (reading_next,
+             samples_next,
+             readBit_next,
+             data_next,
+             valid_next,
+             start,) = rxmod_logic(RX_2.O,
+                                   m.bits([majority]),
+                                   tick,
+                                   tick & (count.O == m.bits(mid - 2, n)),
+                                   tick & (count.O == m.bits(mid - 1, n)),
+                                   tick & (count.O == m.bits(mid, n)),
+                                   tick & (count.O == m.bits(oversample - 1, n)),
+                                   reading.O[0],
+                                   samples.O,
+                                   readBit.O,
+                                   dataReg.O)
+            m.wire(start, count.RESET)
+            m.wire(reading_next, reading.I[0])
+            m.wire(samples_next, samples.I)
+            m.wire(readBit_next, readBit.I)
+            m.wire(data_next, dataReg.I)
+            m.wire(valid_next, validReg.I[0])
+            m.wire(dataReg.O, io.data)
+            m.wire(validReg.O[0], io.valid)
+
+    return RXMOD
+
+
+RXMOD = DefineRXMOD()
+
+
+@lru_cache(maxsize=None)
+def DefineBufferedRXMOD(depth=512, clock_hz=12000000, baud=115200, oversample=16):
+    """RXMOD in front of a FIFO of depth bytes, see fifo.py.
+
+    The bytes received are taken from data with the valid and ready of the
+    FIFO, a byte received while it is FULL is dropped.
+    """
+    FIFO = DefineFIFO(depth)
+    RX = DefineRXMOD(clock_hz, baud, oversample)
+
+    class BufferedRXMOD(m.Circuit):
+        name = f"Buffered{RX.name}_{depth}"
+        IO = ["RX", m.In(m.Bit),
+              "data", m.Out(m.Bits(8)),
+              "valid", m.Out(m.Bit),
+              "ready", m.In(m.Bit),
+              "LEVEL", m.Out(m.Bits(int(math.log2(depth)) + 1)),
+              "FULL", m.Out(m.Bit),
+              "EMPTY", m.Out(m.Bit),
+              "CLK", m.In(m.Clock),]
+
+        @classmethod
+        def definition(io):
+            rx = RX()
+            fifo = FIFO()
+            m.wire(io.RX, rx.RX)
+            m.wire(rx.data, fifo.I)
+            m.wire(rx.valid, fifo.I_valid)
+            m.wire(fifo.O, io.data)
+            m.wire(fifo.O_valid, io.valid)
+            m.wire(io.ready, fifo.O_ready)
+            m.wire(fifo.LEVEL, io.LEVEL)
+            m.wire(fifo.FULL, io.FULL)
+            m.wire(fifo.EMPTY, io.EMPTY)
+
+    return BufferedRXMOD
+
+
+if __name__ == "__main__":
+    # python rxmod.py [clock_hz baud [depth]], a depth compiles BufferedRXMOD
+    if len(sys.argv) == 4:
+        circuit = DefineBufferedRXMOD(int(sys.argv[3]), int(sys.argv[1]), int(sys.argv[2]))
+    elif len(sys.argv) == 3:
+        circuit = DefineRXMOD(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        circuit = RXMOD
+    m.compile("rxmod", circuit, output="verilog")
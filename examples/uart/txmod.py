@@ -1,6 +1,25 @@
+import math
+import sys
+from functools import lru_cache
 import magma as m
 m.set_mantle_target("ice40")
-from mantle import Register
+from mantle import Register, Add
+from fifo import DefineFIFO
+
+
+def divider(clock_hz, baud, max_error=0.001):
+    """Width and increment of the phase accumulator of the bit clock.
+
+    The accumulator adds inc every cycle and a bit ends when it overflows, so
+    a bit takes 2 ** width / inc cycles on average, within max_error of
+    clock_hz / baud, and every edge is less than a cycle off the ideal one.
+    """
+    assert 2 * baud <= clock_hz
+    for width in range(1, 33):
+        inc = round(baud * 2 ** width / clock_hz)
+        if abs(inc * clock_hz / 2 ** width - baud) <= max_error * baud:
+            return width, inc
+    raise ValueError(f"no divider for {baud} baud at {clock_hz} Hz")
 
 
 @m.circuit.combinational
@@ -9,86 +28,175 @@ def txmod_logic(
         writing : m.Bit,
         valid : m.Bit,
         dataStore : m.Bits(11),
-        writeClock : m.Bits(14),
+        tick : m.Bit,
         writeBit : m.Bits(4),) -> (m.Bit,
                                    m.Bits(11),
-                                   m.Bits(14),
                                    m.Bits(4),
+                                   m.Bit,
+                                   m.Bit,
                                    m.Bit,):
 
     if (writing == m.bit(0)) & (valid == m.bit(1)):
         writing_out = m.bit(1)
         dataStore_out = m.concat(dataStore[0:1], data, dataStore[9:])
-        writeClock_out = m.bits(100, 14)
         writeBit_out = m.bits(0, 4)
         TXReg_out = dataStore[0]
+        start_out = m.bit(1)
     elif (writing == m.bit(1)) & \
-         (writeClock == m.bits(0, 14)) & \
+         (tick == m.bit(1)) & \
+         (writeBit == m.bits(9, 4)) & \
+         (valid == m.bit(1)):
+        # the start bit of the next byte follows the stop bit
+        writing_out = writing
+        dataStore_out = m.concat(dataStore[0:1], data, dataStore[9:])
+        writeBit_out = m.bits(0, 4)
+        TXReg_out = dataStore[0]
+        start_out = m.bit(0)
+    elif (writing == m.bit(1)) & \
+         (tick == m.bit(1)) & \
          (writeBit == m.bits(9, 4)):
         dataStore_out = dataStore
-        writeClock_out = writeClock
         writeBit_out = writeBit
         TXReg_out = m.bit(1)
         writing_out = m.bit(0)
-    elif (writing == m.bit(1)) & (writeClock == m.bits(0, 14)):
+        start_out = m.bit(0)
+    elif (writing == m.bit(1)) & (tick == m.bit(1)):
+        # the next bit starts with the tick
         writing_out = writing
         dataStore_out = dataStore
-        TXReg_out = dataStore[writeBit]
         writeBit_out = m.bits(m.uint(writeBit) + m.bits(1, 4))
-        writeClock_out = m.bits(100, 14)
+        TXReg_out = dataStore[writeBit_out]
+        start_out = m.bit(0)
     elif writing == m.bit(1):
         writing_out = writing
         dataStore_out = dataStore
         writeBit_out = writeBit
         TXReg_out = dataStore[writeBit]
-        writeClock_out = m.bits(m.uint(writeClock) - m.bits(1, 14))
+        start_out = m.bit(0)
     else:
         writing_out = writing
         dataStore_out = dataStore
-        writeClock_out = writeClock
         writeBit_out = writeBit
         TXReg_out = m.bit(1)
+        start_out = m.bit(0)
+
+    # a byte is taken while idle or with the tick at the end of a stop bit
+    ready_out = (writing == m.bit(0)) | \
+                ((tick == m.bit(1)) & (writeBit == m.bits(9, 4)))
 
     return (writing_out,
             dataStore_out,
-            writeClock_out,
             writeBit_out,
-            TXReg_out,)
-
-
-class TXMOD(m.Circuit):
-    IO = ["TX", m.Out(m.Bit),
-          "data", m.In(m.Bits(8)),
-          "valid", m.In(m.Bit),
-          "ready", m.Out(m.Bit),
-          "CLK", m.In(m.Clock),]
-
-    @classmethod
-    def definition(io):
-        TXReg = Register(1, init=1)
-        dataStore = Register(11, init=1536)
-        writing = Register(1, init=0)
-        writeClock = Register(14, init=0)
-        writeBit = Register(4, init=0)
-        (writing_next,
-         dataStore_next,
-         writeClock_next,
-         writeBit_next,
-         TXReg_next,) = txmod_logic(io.data,
+            TXReg_out,
+            start_out,
+            ready_out,)
+
+
+@lru_cache(maxsize=None)
+def DefineTXMOD(clock_hz=12000000, baud=115200, margin=0.03):
+    """An 8N1 transmitter of baud at a clock of clock_hz.
+
+    A bit ends when the phase accumulator of `divider` overflows, it starts
+    from 0 with every frame, so 1 to 3 Mbaud at 12 MHz are as exact as the
+    clock allows.  The bits are sent margin faster than baud, 3% like the
+    101 cycles a bit of txmod.v at 12 MHz by default: uart_main.v has no
+    FIFO, so every byte has to be sent back before the next one is in.
+    """
+    rate = round(baud * (1 + margin))
+    width, inc = divider(clock_hz, rate)
+
+    class TXMOD(m.Circuit):
+        name = "TXMOD" if (clock_hz, baud, margin) == (12000000, 115200, 0.03) \
+            else f"TXMOD_{clock_hz}_{rate}"
+        IO = ["TX", m.Out(m.Bit),
+              "data", m.In(m.Bits(8)),
+              "valid", m.In(m.Bit),
+              "ready", m.Out(m.Bit),
+              "CLK", m.In(m.Clock),]
+
+        @classmethod
+        def definition(io):
+            TXReg = Register(1, init=1)
+            dataStore = Register(11, init=1536)
+            writing = Register(1, init=0)
+            writeBit = Register(4, init=0)
+            # the bit clock, a tick when the accumulator overflows
+            phase = Register(width, init=0, has_reset=True)
+            phase_add = Add(width, cout=True)
+            m.wire(phase.O, phase_add.I0)
+            m.wire(m.bits(inc, width), phase_add.I1)
+            m.wire(phase_add.O, phase.I)
+            (writing_next,
+             dataStore_next,
+             writeBit_next,
+             TXReg_next,
+             start,
+             ready,) = txmod_logic(io.data,
                                    writing.O[0],
                                    io.valid,
                                    dataStore.O,
-                                   writeClock.O,
+                                   phase_add.COUT,
                                    writeBit.O)
-        m.wire(writing_next, writing.I[0])
-        m.wire(dataStore_next, dataStore.I)
-        m.wire(writeClock_next, writeClock.I)
-        m.wire(writeBit_next, writeBit.I)
-        m.wire(TXReg_next, TXReg.I[0])
-        ready = writing.O[0] == m.bit(0)
-        m.wire(ready, io.ready)
-        m.wire(TXReg.O[0], io.TX)
+            m.wire(start, phase.RESET)
+            m.wire(writing_next, writing.I[0])
+            m.wire(dataStore_next, dataStore.I)
+            m.wire(writeBit_next, writeBit.I)
+            m.wire(TXReg_next, TXReg.I[0])
+            m.wire(ready, io.ready)
+            m.wire(TXReg.O[0], io.TX)
+
+    return TXMOD
+
+
+TXMOD = DefineTXMOD()
+
+
+@lru_cache(maxsize=None)
+def DefineBurstTXMOD(depth=512, clock_hz=12000000, baud=115200, margin=0.03):
+    """TXMOD behind a FIFO of depth bytes, see fifo.py.
+
+    The FIFO takes a byte every cycle it is not FULL, the frames of the
+    bytes in it are sent back to back, and LEVEL, FULL and EMPTY give its
+    fill for flow control.
+    """
+    FIFO = DefineFIFO(depth)
+    TX = DefineTXMOD(clock_hz, baud, margin)
+
+    class BurstTXMOD(m.Circuit):
+        name = f"Burst{TX.name}_{depth}"
+        IO = ["TX", m.Out(m.Bit),
+              "data", m.In(m.Bits(8)),
+              "valid", m.In(m.Bit),
+              "ready", m.Out(m.Bit),
+              "LEVEL", m.Out(m.Bits(int(math.log2(depth)) + 1)),
+              "FULL", m.Out(m.Bit),
+              "EMPTY", m.Out(m.Bit),
+              "CLK", m.In(m.Clock),]
+
+        @classmethod
+        def definition(io):
+            fifo = FIFO()
+            tx = TX()
+            m.wire(io.data, fifo.I)
+            m.wire(io.valid, fifo.I_valid)
+            m.wire(fifo.I_ready, io.ready)
+            m.wire(fifo.O, tx.data)
+            m.wire(fifo.O_valid, tx.valid)
+            m.wire(tx.ready, fifo.O_ready)
+            m.wire(tx.TX, io.TX)
+            m.wire(fifo.LEVEL, io.LEVEL)
+            m.wire(fifo.FULL, io.FULL)
+            m.wire(fifo.EMPTY, io.EMPTY)
+
+    return BurstTXMOD
 
 
 if __name__ == "__main__":
-    m.compile("txmod", TXMOD, output="verilog")
+    # python txmod.py [clock_hz baud [depth]], a depth compiles BurstTXMOD
+    if len(sys.argv) == 4:
+        circuit = DefineBurstTXMOD(int(sys.argv[3]), int(sys.argv[1]), int(sys.argv[2]))
+    elif len(sys.argv) == 3:
+        circuit = DefineTXMOD(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        circuit = TXMOD
+    m.compile("txmod", circuit, output="verilog")
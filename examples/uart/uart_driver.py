@@ -1,5 +1,10 @@
-import serial
+import argparse
+import os
 import sys
+import threading
+import time
+
+import serial
 
 
 def main(infile, outfile, usb_path):
@@ -18,15 +23,103 @@ def main(infile, outfile, usb_path):
         f.write(res)
 
 
-def usage():
-    print(f"usage: {sys.argv[0]} infile outfile usb_path")
+class Echo:
+    """Drain the echo of a serial port into a file on a thread of its own.
+
+    `received` counts the bytes written to the file, writers wait on
+    `changed` until few enough bytes are in flight.
+    """
+
+    def __init__(self, ser, out):
+        self.ser = ser
+        self.out = out
+        self.received = 0
+        self.error = None
+        self.done = False
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        try:
+            while not self.done:
+                # blocks for the timeout of the port at most, so done is seen
+                data = self.ser.read(max(1, self.ser.in_waiting))
+                if data:
+                    self.out.write(data)
+                    with self.changed:
+                        self.received += len(data)
+                        self.changed.notify_all()
+        except Exception as error:
+            with self.changed:
+                self.error = error
+                self.changed.notify_all()
+
+    def wait(self, count, timeout):
+        """Wait until `count` bytes are received, False when none came for `timeout` seconds."""
+        with self.changed:
+            while self.received < count:
+                if self.error:
+                    raise self.error
+                before = self.received
+                self.changed.wait(timeout)
+                if self.received == before and not self.error:
+                    return False
+        return True
+
+
+def stream(infile, outfile, usb_path, baud=115200, chunk=256, window=2048, timeout=1.0):
+    """Send infile in chunks while a thread writes the echo to outfile.
+
+    At most `window` bytes are in flight, sent but not echoed, so neither
+    the buffers of the OS nor those of the FTDI overflow, and the memory
+    used does not depend on the size of the file.
+    """
+    total = os.path.getsize(infile)
+    print(f"Streaming infile={infile} ({total} bytes) to outfile={outfile}")
+    start = time.perf_counter()
+    report = start
+    sent = 0
+    with open(infile, "rb") as f, open(outfile, "wb") as out, \
+            serial.Serial(usb_path, baud, timeout=timeout) as ser:
+        echo = Echo(ser, out)
+        echo.thread.start()
+        try:
+            while True:
+                data = f.read(chunk)
+                if not data:
+                    break
+                # a chunk larger than the window waits for everything sent before it
+                if not echo.wait(min(sent, sent + len(data) - window), timeout):
+                    raise IOError(f"no echo for {timeout} s after {echo.received} bytes")
+                ser.write(data)
+                sent += len(data)
+                now = time.perf_counter()
+                if now - report >= 1:
+                    report = now
+                    print(f"\r{echo.received} of {total} bytes, {echo.received / (now - start):.0f} bytes/s",
+                          end="", file=sys.stderr, flush=True)
+            if not echo.wait(total, timeout):
+                raise IOError(f"no echo for {timeout} s after {echo.received} bytes")
+            # before the reader is joined, it waits out the timeout of its read
+            elapsed = time.perf_counter() - start
+        finally:
+            echo.done = True
+            echo.thread.join()
+    print(f"\r{total} bytes in {elapsed:.3f} s, {total / elapsed:.0f} bytes/s", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        usage()
-        exit(1)
-    infile = sys.argv[1]
-    outfile = sys.argv[2]
-    usb_path = sys.argv[3]
-    main(infile, outfile, usb_path)
+    parser = argparse.ArgumentParser(description="Send infile over the UART and write the echo to outfile.")
+    parser.add_argument("infile")
+    parser.add_argument("outfile")
+    parser.add_argument("usb_path")
+    parser.add_argument("--stream", action="store_true",
+                        help="send in chunks while the echo is written, for files of any size")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--chunk", type=int, default=256, help="bytes per write in --stream")
+    parser.add_argument("--window", type=int, default=2048, help="bytes in flight in --stream")
+    args = parser.parse_args()
+    if args.stream:
+        stream(args.infile, args.outfile, args.usb_path, args.baud, args.chunk, args.window)
+    else:
+        main(args.infile, args.outfile, args.usb_path)
@@ -0,0 +1,64 @@
+"""
+uart_main.v in magma: every byte received on RX is sent back on TX.
+
+The bytes received go through the FIFO of BufferedRXMOD to TXMOD, which
+sends them back to back, so a file streamed at the full rate of the line
+comes back unchanged.  The pins are those of ice40.pcf, LED0 to LED3 show
+the low bits of the byte in the FIFO output and LED4 lights when the FIFO
+is FULL, when bytes get dropped.
+
+usage: python uart_loopback.py [clock_hz baud [depth]]
+       make uart_loopback.run
+"""
+import sys
+import magma as m
+m.set_mantle_target("ice40")
+from rxmod import DefineBufferedRXMOD
+from txmod import DefineTXMOD
+
+
+def DefineLoopback(depth=512, clock_hz=12000000, baud=115200):
+    RX = DefineBufferedRXMOD(depth, clock_hz, baud)
+    TX = DefineTXMOD(clock_hz, baud)
+
+    class main(m.Circuit):
+        IO = ["CLK", m.In(m.Clock),
+              "RX", m.In(m.Bit),
+              "TX", m.Out(m.Bit),
+              "LED0", m.Out(m.Bit),
+              "LED1", m.Out(m.Bit),
+              "LED2", m.Out(m.Bit),
+              "LED3", m.Out(m.Bit),
+              "LED4", m.Out(m.Bit),
+              "PMOD_1", m.Out(m.Bit),
+              "PMOD_2", m.Out(m.Bit),]
+
+        @classmethod
+        def definition(io):
+            rx = RX()
+            tx = TX()
+            m.wire(io.RX, rx.RX)
+            m.wire(rx.data, tx.data)
+            m.wire(rx.valid, tx.valid)
+            m.wire(tx.ready, rx.ready)
+            m.wire(tx.TX, io.TX)
+            m.wire(rx.data[0], io.LED0)
+            m.wire(rx.data[1], io.LED1)
+            m.wire(rx.data[2], io.LED2)
+            m.wire(rx.data[3], io.LED3)
+            m.wire(rx.FULL, io.LED4)
+            m.wire(io.RX, io.PMOD_1)
+            m.wire(tx.TX, io.PMOD_2)
+
+    return main
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) == 3:
+        circuit = DefineLoopback(args[2], args[0], args[1])
+    elif len(args) == 2:
+        circuit = DefineLoopback(clock_hz=args[0], baud=args[1])
+    else:
+        circuit = DefineLoopback()
+    m.compile("uart_loopback", circuit, output="verilog")
@@ -0,0 +1,202 @@
+"""
+Send jobs to a pool of icesticks with asyncio and collect their responses.
+
+Every serial device has a queue of jobs and a task that sends a job and
+reads its response at the same time, a job goes to the device with the
+fewest jobs queued.  For uart_loopback.py the response of a job is its echo;
+the jobs of a file are written to the outfile in order, and the throughput
+of every device and of the pool is reported at the end.  --mock N runs the
+pool on N pseudo terminals of mock_uart.py instead of hardware.
+
+usage: python uart_pool.py infile outfile usb_path [usb_path ...] [--job-size S]
+       python uart_pool.py infile outfile --mock N [--baud B]
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import os
+import time
+
+import serial
+
+from mock_uart import MockUART
+
+
+class AsyncSerial:
+    """A serial port read and written by the event loop."""
+
+    def __init__(self, path, baud=115200):
+        # pyserial configures the line, the loop reads and writes its fd
+        self.ser = serial.Serial(path, baud)
+        self.fd = self.ser.fileno()
+        os.set_blocking(self.fd, False)
+        self.loop = asyncio.get_running_loop()
+
+    async def _ready(self, add, remove, timeout):
+        future = self.loop.create_future()
+        add(self.fd, lambda: future.done() or future.set_result(None))
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            remove(self.fd)
+
+    async def write(self, data, timeout=None):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                await self._ready(self.loop.add_writer, self.loop.remove_writer, timeout)
+
+    async def read(self, size, timeout=None):
+        """Read size bytes, raises asyncio.TimeoutError when none come for timeout seconds."""
+        data = bytearray()
+        while len(data) < size:
+            try:
+                chunk = os.read(self.fd, size - len(data))
+            except BlockingIOError:
+                chunk = None
+            if chunk:
+                data += chunk
+            else:
+                await self._ready(self.loop.add_reader, self.loop.remove_reader, timeout)
+        return bytes(data)
+
+    async def drain(self, quiet):
+        """Drop the bytes received until none come for quiet seconds."""
+        self.ser.reset_input_buffer()
+        while True:
+            try:
+                chunk = os.read(self.fd, 4096)
+            except BlockingIOError:
+                chunk = None
+            if not chunk:
+                # the line has no data, VMIN 0 of pyserial reads b'' then
+                try:
+                    await self._ready(self.loop.add_reader, self.loop.remove_reader, quiet)
+                except asyncio.TimeoutError:
+                    return
+
+    def close(self):
+        self.ser.close()
+
+
+class Device:
+    def __init__(self, path, baud=115200, timeout=1.0):
+        self.path = path
+        self.port = AsyncSerial(path, baud)
+        self.timeout = timeout
+        self.queue = asyncio.Queue()
+        self.active = 0
+        self.jobs = 0
+        self.sent = 0
+        self.received = 0
+
+    async def run(self):
+        while True:
+            data, size, future = await self.queue.get()
+            self.active = 1
+            write = asyncio.ensure_future(self.port.write(data, self.timeout))
+            try:
+                response = await self.port.read(size, self.timeout)
+                await write
+            except Exception as error:
+                write.cancel()
+                if not future.done():
+                    future.set_exception(IOError(f"{self.path}: no response for {self.timeout} s")
+                                         if isinstance(error, asyncio.TimeoutError) else error)
+                # the rest of the response would be taken for that of the next job
+                with contextlib.suppress(OSError):
+                    await self.port.drain(self.timeout)
+            else:
+                if not future.done():
+                    future.set_result(response)
+                self.jobs += 1
+                self.sent += len(data)
+                self.received += len(response)
+            finally:
+                self.active = 0
+                self.queue.task_done()
+
+
+class DevicePool:
+    """Serial devices with a queue of jobs each, use with `async with`."""
+
+    def __init__(self, paths, baud=115200, timeout=1.0):
+        self.paths = paths
+        self.baud = baud
+        self.timeout = timeout
+        self.devices = []
+        self.tasks = []
+        self.start = None
+
+    async def __aenter__(self):
+        self.devices = [Device(path, self.baud, self.timeout) for path in self.paths]
+        self.tasks = [asyncio.ensure_future(device.run()) for device in self.devices]
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for device in self.devices:
+            device.port.close()
+
+    async def submit(self, data, size=None):
+        """Send a job to the least busy device, returns its response of size bytes, len(data) by default."""
+        device = min(self.devices, key=lambda device: device.queue.qsize() + device.active)
+        future = asyncio.get_running_loop().create_future()
+        await device.queue.put((data, len(data) if size is None else size, future))
+        return await future
+
+    def stats(self):
+        """Jobs, bytes and bytes per second of every device and of the pool."""
+        elapsed = time.perf_counter() - self.start
+        rows = [(device.path, device.jobs, device.sent, device.received, device.received / elapsed)
+                for device in self.devices]
+        total = sum(row[3] for row in rows)
+        rows.append(("pool", sum(row[1] for row in rows), sum(row[2] for row in rows), total, total / elapsed))
+        return rows
+
+
+async def transfer(pool, infile, outfile, job_size=4096, in_flight=None):
+    """Send infile in jobs of job_size bytes and write the responses to outfile in order."""
+    in_flight = in_flight or 2 * len(pool.devices)
+    pending = collections.deque()
+    with open(infile, "rb") as f, open(outfile, "wb") as out:
+        while True:
+            data = f.read(job_size)
+            if not data:
+                break
+            pending.append(asyncio.ensure_future(pool.submit(data)))
+            if len(pending) >= in_flight:
+                out.write(await pending.popleft())
+        while pending:
+            out.write(await pending.popleft())
+
+
+async def run(paths, infile, outfile, baud, job_size, timeout):
+    async with DevicePool(paths, baud, timeout) as pool:
+        await transfer(pool, infile, outfile, job_size)
+        for path, jobs, sent, received, rate in pool.stats():
+            print(f"{path}: {jobs} jobs, {sent} bytes sent, {received} bytes received, {rate:.0f} bytes/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("infile")
+    parser.add_argument("outfile")
+    parser.add_argument("usb_path", nargs="*")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--job-size", type=int, default=4096)
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds without a response byte")
+    parser.add_argument("--mock", type=int, default=0, metavar="N", help="run on N mock devices")
+    args = parser.parse_args()
+    if not args.usb_path and not args.mock:
+        parser.error("no devices, give usb paths or --mock N")
+    with contextlib.ExitStack() as stack:
+        mocks = [stack.enter_context(MockUART(args.baud)) for _ in range(args.mock)]
+        paths = args.usb_path + [mock.path for mock in mocks]
+        asyncio.run(run(paths, args.infile, args.outfile, args.baud, args.job_size, args.timeout))
@@ -0,0 +1,51 @@
+"""
+Run DevicePool on the pseudo terminals of mock_uart.py.
+
+    python -m pytest uart_pool_test.py
+"""
+import asyncio
+import time
+
+from mock_uart import MockUART
+from uart_pool import DevicePool, transfer
+
+
+def test_transfer(tmp_path):
+    infile, outfile = tmp_path / "infile", tmp_path / "outfile"
+    infile.write_bytes(bytes(range(256)) * 64)
+    with MockUART(baud=0) as first, MockUART(baud=0) as second:
+        async def run():
+            async with DevicePool([first.path, second.path]) as pool:
+                await transfer(pool, infile, outfile, job_size=1000)
+                return pool.stats()
+        stats = asyncio.run(run())
+    assert outfile.read_bytes() == infile.read_bytes()
+    assert stats[-1][3] == len(infile.read_bytes())
+
+
+def test_late_response_dropped():
+    timeout = 0.2
+    responses = []
+
+    def respond(data):
+        # the response of the first job comes after its timeout
+        responses.append(data)
+        if len(responses) == 1:
+            time.sleep(2 * timeout)
+        return data
+
+    with MockUART(baud=0, respond=respond) as mock:
+        async def run():
+            async with DevicePool([mock.path], timeout=timeout) as pool:
+                try:
+                    await pool.submit(b"first job")
+                except IOError as error:
+                    failed = error
+                else:
+                    failed = None
+                return failed, await pool.submit(b"second job"), pool.devices[0].jobs
+        failed, response, jobs = asyncio.run(run())
+    assert failed is not None
+    # the drain after the failure dropped the late response of the first job
+    assert response == b"second job"
+    assert jobs == 1
@@ -0,0 +1,171 @@
+"""
+Rebuild an icestick bitstream, patching the BRAM contents of the last build
+when only ROM data changed.
+
+Weights in the ROMs of `WeightROM` or the wavetable of a `mantle.Memory` are
+the INIT_0 .. INIT_F parameters of SB_RAM40_4K instances in the verilog.
+When the new verilog differs from the one of the last build only in those
+parameters, the placed and routed design is still valid: the old contents
+are looked up in the .ram_data sections of the .asc and replaced by the new
+ones, like icebram does, and icepack is run again.  Anything else runs the
+full yosys, arachne-pnr and icepack flow, and icetime checks the timing of
+the placed and routed design against the clock.
+
+usage: python bram_patch.py build/main [--full] [--clock MHz]
+
+build/main.v and build/main.pcf are the output of magma; build/main.txt and
+build/main.bin are written, build/main.built.v keeps the verilog of the .txt
+and build/main.rpt is the timing report.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+
+# an SB_RAM40_4K instance: parameters and instance name
+ram_pattern = re.compile(r"SB_RAM40_4K\s*#\((.*?)\)\s*(\w+)\s*\(", re.DOTALL)
+# an INIT_x parameter of SB_RAM40_4K, LUT_INIT is not matched
+init_pattern = re.compile(r"\.INIT_([0-9A-F])\(\s*(\d+)'([hdb])([0-9a-fA-F_]+)\s*\)")
+bases = {'h': 16, 'd': 10, 'b': 2}
+# the critical path in the report of icetime
+delay_pattern = re.compile(r"Total path delay: ([0-9.]+) ns \(([0-9.]+) MHz\)")
+
+
+def read_inits(verilog):
+    """INIT values of every SB_RAM40_4K, {instance: [INIT_0, ..., INIT_F]}."""
+    rams = {}
+    for match in ram_pattern.finditer(verilog):
+        inits = [0] * 16
+        for i, _, base, value in init_pattern.findall(match.group(1)):
+            inits[int(i, 16)] = int(value.replace('_', ''), bases[base])
+        rams[match.group(2)] = inits
+    return rams
+
+
+def strip_inits(verilog):
+    """The verilog without the values of the INIT_x parameters."""
+    return init_pattern.sub(lambda match: '.INIT_{}()'.format(match.group(1)), verilog)
+
+
+def read_asc_rams(lines):
+    """Line numbers and INIT values of the .ram_data sections of an .asc."""
+    rams = []
+    for i, line in enumerate(lines):
+        if line.startswith('.ram_data'):
+            rams.append((i + 1, [int(l, 16) for l in lines[i + 1:i + 17]]))
+    return rams
+
+
+def patch_asc(lines, old_rams, new_rams):
+    """Replace the contents of the changed RAMs in the lines of an .asc.
+
+    Returns the number of patched BRAMs, raises ValueError when a changed
+    RAM is not found or is ambiguous, then the design has to be rebuilt.
+    """
+    changes = {}
+    for name, new in new_rams.items():
+        old = old_rams[name]
+        if old != new:
+            old, new = tuple(old), tuple(new)
+            # RAMs with the same contents are indistinguishable in the .asc
+            if changes.setdefault(old, new) != new:
+                raise ValueError('RAMs with the same contents change differently')
+    for name, new in new_rams.items():
+        if old_rams[name] == new and tuple(new) in changes:
+            raise ValueError('RAMs with the same contents change differently')
+    patched = 0
+    asc_rams = read_asc_rams(lines)
+    for old, new in changes.items():
+        found = [start for start, inits in asc_rams if tuple(inits) == old]
+        if not found:
+            raise ValueError('RAM contents not found in the .asc')
+        for start in found:
+            lines[start:start + 16] = ['{:064x}'.format(init) for init in new]
+            patched += 1
+    return patched
+
+
+def run(*command):
+    print(' '.join(command))
+    subprocess.check_call(command)
+
+
+def timing_report(name, clock=12):
+    """Write the icetime report of the .asc, returns the maximum clock in MHz."""
+    command = ['icetime', '-tmd', 'hx1k', '-c', str(clock), '-r', name + '.rpt', name + '.txt']
+    print(' '.join(command))
+    # icetime fails when the clock is not met, the report is written anyway
+    subprocess.call(command)
+    with open(name + '.rpt') as report_file:
+        match = delay_pattern.search(report_file.read())
+    if not match:
+        raise subprocess.CalledProcessError(1, command)
+    delay, fmax = float(match.group(1)), float(match.group(2))
+    print('critical path {:.2f} ns, {:.2f} MHz, {} the {} MHz clock'.format(
+        delay, fmax, 'meets' if fmax >= clock else 'FAILS', clock))
+    return fmax
+
+
+def full_build(name, clock=12):
+    run('yosys', '-q', '-p', 'synth_ice40 -top main -blif {}.blif'.format(name), name + '.v')
+    run('arachne-pnr', '-q', '-d', '1k', '-o', name + '.txt', '-p', name + '.pcf', name + '.blif')
+    run('icepack', name + '.txt', name + '.bin')
+    # the timing is reported, the bitstream is written either way
+    try:
+        timing_report(name, clock)
+    except (subprocess.CalledProcessError, OSError) as error:
+        print('warning: no timing report: {}'.format(error))
+
+
+def patch_build(name):
+    """Patch the .asc of the last build, returns the number of patched BRAMs."""
+    with open(name + '.built.v') as built_file:
+        built = built_file.read()
+    with open(name + '.v') as verilog_file:
+        verilog = verilog_file.read()
+    if strip_inits(built) != strip_inits(verilog):
+        raise ValueError('the logic changed')
+    with open(name + '.txt') as asc_file:
+        lines = asc_file.read().split('\n')
+    patched = patch_asc(lines, read_inits(built), read_inits(verilog))
+    if patched:
+        with open(name + '.txt', 'w') as asc_file:
+            asc_file.write('\n'.join(lines))
+        run('icepack', name + '.txt', name + '.bin')
+    return patched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('name', help='path of the build without extension, e.g. build/main')
+    parser.add_argument('--full', action='store_true', help='always run the full flow')
+    parser.add_argument('--clock', type=float, default=12, help='clock to check in MHz')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    built = all(os.path.exists(args.name + ext) for ext in ('.built.v', '.txt'))
+    reason = '--full' if args.full else None if built else 'no previous build'
+    try:
+        if not reason:
+            try:
+                print('patched {} BRAMs'.format(patch_build(args.name)))
+            except ValueError as error:
+                reason = str(error)
+        if reason:
+            print('full build: {}'.format(reason))
+            full_build(args.name, args.clock)
+    except subprocess.CalledProcessError:
+        sys.exit(1)
+    except OSError as error:
+        # a tool of the flow is missing
+        sys.exit(str(error))
+    shutil.copyfile(args.name + '.v', args.name + '.built.v')
+    print('{:.2f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Export the ROM and LUT contents of modules.py as init files.
+
+The weights and the images of a checkpoint are written in the layout of the
+hardware for the N, num_cycles and num_lanes of modules.py, one file per
+BRAM or image:
+
+    weights-l{lane}-j{j}-r{rom}   BRAM rom of the j-th ROM of a lane, entry
+                                  idx / num_lanes * num_cycles + cycle holds
+                                  the j-th word of block cycle of row idx + lane
+    image{k}-j{j}                 the j-th ROM of image k, entry cycle holds
+                                  its block cycle (ReadROM with num_cycles > 16)
+    image{k}-luts                 the LUT_INIT of the N LUTs of image k, one
+                                  per line (ReadROM with num_cycles <= 16)
+
+as .hex (a 16 bit word per line, for $readmemh and icebram) and .bin (big
+endian words).  manifest.json records the hash of the checkpoint, the layout
+and the sha256 of every file; the files are only written again when the
+checkpoint or the layout changed, or a file does not match its checksum.
+
+usage: python export_roms.py [--checkpoint nn_train/BNN.pkl] [--out build/roms] [--force]
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import modules
+
+
+def rom_files(weights_roms, image_words):
+    """{name: uint16 words} of every init file."""
+    files = {}
+    num_lanes, num_rams, depth = weights_roms.shape
+    for lane in range(num_lanes):
+        for j in range(num_rams):
+            for rom in range(depth // 256):
+                files['weights-l{}-j{}-r{}'.format(lane, j, rom)] = weights_roms[lane, j, 256 * rom:256 * (rom + 1)]
+    num_images, _, num_cycles = image_words.shape
+    for k in range(num_images):
+        if num_cycles <= 16:
+            # bit cycle of the LUT of image bit i is bit i of block cycle
+            bits = image_words[k, :, None, :] >> np.arange(16)[None, :, None] & 1
+            files['image{}-luts'.format(k)] = (bits << np.arange(num_cycles)).sum(axis=-1).reshape(-1)
+        else:
+            for j in range(num_rams):
+                words = np.zeros(256, dtype=np.uint16)
+                words[:num_cycles] = image_words[k, j]
+                files['image{}-j{}'.format(k, j)] = words
+    return {name: np.asarray(words, dtype=np.uint16) for name, words in files.items()}
+
+
+def encode(words):
+    """The .hex and .bin contents of a file."""
+    text = ''.join('{:04x}\n'.format(int(word)) for word in words)
+    return {'.hex': text.encode(), '.bin': words.astype('>u2').tobytes()}
+
+
+def up_to_date(out, manifest):
+    """True when the manifest in out matches manifest and every file its checksum."""
+    path = os.path.join(out, 'manifest.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as manifest_file:
+        old = json.load(manifest_file)
+    if {k: v for k, v in old.items() if k != 'files'} != {k: v for k, v in manifest.items() if k != 'files'}:
+        return False
+    for name, checksum in old['files'].items():
+        try:
+            with open(os.path.join(out, name), 'rb') as init_file:
+                if hashlib.sha256(init_file.read()).hexdigest() != checksum:
+                    return False
+        except IOError:
+            return False
+    return True
+
+
+def export(checkpoint, out, force=False):
+    """Write the init files of checkpoint into out, returns the number of files written."""
+    with open(checkpoint, 'rb') as checkpoint_file:
+        data = checkpoint_file.read()
+    manifest = {'checkpoint': os.path.basename(checkpoint), 'sha1': hashlib.sha1(data).hexdigest(),
+                'N': modules.N, 'num_cycles': modules.num_cycles, 'num_lanes': modules.num_lanes}
+    if not force and up_to_date(out, manifest):
+        return 0
+    # the .npy cache of modules.py, packed once per checkpoint and layout
+    weights_roms, image_words = modules.load_contents(checkpoint)
+    os.makedirs(out, exist_ok=True)
+    manifest['files'] = {}
+    written = 0
+    for name, words in sorted(rom_files(weights_roms, image_words).items()):
+        for ext, contents in encode(words).items():
+            path = os.path.join(out, name + ext)
+            manifest['files'][name + ext] = hashlib.sha256(contents).hexdigest()
+            # unchanged files keep their time stamp
+            if not force and os.path.exists(path):
+                with open(path, 'rb') as init_file:
+                    if init_file.read() == contents:
+                        continue
+            with open(path + '.tmp', 'wb') as init_file:
+                init_file.write(contents)
+            os.replace(path + '.tmp', path)
+            written += 1
+    with open(os.path.join(out, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--checkpoint', default=modules.filename)
+    parser.add_argument('--out', default=os.path.join(modules.cache_dir, 'roms'))
+    parser.add_argument('--force', action='store_true', help='write every file again')
+    args = parser.parse_args()
+    written = export(args.checkpoint, args.out, args.force)
+    print('{}: {} files written'.format(args.out, written) if written else '{}: up to date'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Bit-exact NumPy model of the digits recognition `Pipeline` in modules.py.
+
+The hardware scores class `idx` of an image as
+
+    sum over cycle of popcount(NXOr(WEIGHT[idx][cycle], IMAGE[cycle]))
+
+and keeps the first class whose score is strictly greater than every score
+seen before it (the UGT compare in `Classifier`).  This model packs both
+operands into uint64 lanes, XORs them and counts bits, which gives the same
+scores for a whole batch of images at once.
+
+usage: python golden.py [--mnist MNIST_data] [--threads T]
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+filename = 'nn_train/BNN.pkl'
+# clock of the icestick, Pipeline runs at it in main.py with BNN_CLOCK_MHZ=12
+fpga_clock = 12e6
+
+
+def load_checkpoint(filename=filename):
+    with open(filename, 'rb') as input_file:
+        return pickle.load(input_file)
+
+
+def pack_images(images):
+    """Pack binary images into the word layout of the weight ROM.
+
+    Args:
+        images: array of shape [num_images, pixels], a pixel is set when it
+            is > 0, so both {0, 1} and {-1, 1} images are accepted.
+    Returns:
+        uint16 array of shape [num_images, pixels // 16], word `cycle`
+        holds pixels [16 * cycle, 16 * (cycle + 1)), first pixel in the
+        most significant bit, the same way `weights_int16` is packed.
+    """
+    bits = np.asarray(images).reshape(len(images), -1, 16) > 0
+    return np.packbits(bits, axis=-1).view('>u2')[..., 0].astype(np.uint16)
+
+
+def lut_images(imgs_int16):
+    """Convert `imgs_int16` from the SB_LUT4 layout used by `ReadROM`.
+
+    LUT `i` is addressed by CYCLE, so bit `i` of the image word read in a
+    given cycle is bit `cycle` of `imgs_int16[:, i]`.
+    """
+    imgs_int16 = np.asarray(imgs_int16, dtype=np.uint16)
+    num_cycles = imgs_int16.shape[1]
+    cycles = np.arange(num_cycles, dtype=np.uint16)
+    bits = (imgs_int16[:, None, :] >> cycles[None, :, None]) & 1
+    return (bits << cycles[None, None, :]).sum(axis=-1).astype(np.uint16)
+
+
+def to_uint64(words):
+    """Concatenate rows of uint16 words and view them as uint64 lanes."""
+    words = np.ascontiguousarray(words, dtype=np.uint16)
+    pad = -words.shape[1] % 4
+    if pad:
+        words = np.pad(words, ((0, 0), (0, pad)), 'constant')
+    return words.view(np.uint64)
+
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    def popcount(x):
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + \
+            ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def _scores(images64, weights64, num_bits):
+    # NXOr then popcount over num_bits is num_bits minus the popcount of the
+    # XOr, which also ignores the zero padding of the last lane
+    diff = popcount(images64[:, None, :] ^ weights64[None, :, :])
+    return num_bits - diff.sum(axis=-1, dtype=np.int64)
+
+
+def scores(image_words, weight_words, threads=None, chunk=4096):
+    """Accumulated popcounts, shape [num_images, num_classes].
+
+    Args:
+        image_words: uint16 array [num_images, num_cycles] of image blocks.
+        weight_words: uint16 array [num_classes, num_cycles] of weight blocks.
+        threads: number of worker threads, defaults to the number of CPUs.
+        chunk: number of images scored by a worker at a time.
+    """
+    num_bits = 16 * weight_words.shape[1]
+    images64 = to_uint64(image_words)
+    weights64 = to_uint64(weight_words)
+    chunks = [images64[i:i + chunk] for i in range(0, len(images64), chunk)]
+    if threads == 1 or len(chunks) <= 1:
+        results = [_scores(c, weights64, num_bits) for c in chunks]
+    else:
+        with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+            results = list(pool.map(
+                lambda c: _scores(c, weights64, num_bits), chunks))
+    if not results:
+        return np.zeros((0, len(weight_words)), dtype=np.int64)
+    return np.concatenate(results)
+
+
+def classify(image_words, weight_words, threads=None):
+    """Predicted labels, the first maximum wins like in `Classifier`."""
+    return np.argmax(scores(image_words, weight_words, threads), axis=1)
+
+
+def classify_layers(image_words, layer_words, threads=None):
+    """Predicted labels of a BNN of several layers, like `LayerPipeline` in layers.py.
+
+    A neuron of a hidden layer is set when its score is at least half of its
+    inputs, the outputs of a layer are the image words of the next one.
+    """
+    for weight_words in layer_words[:-1]:
+        hidden = scores(image_words, weight_words, threads)
+        image_words = pack_images(2 * hidden >= 16 * weight_words.shape[1])
+    return classify(image_words, layer_words[-1], threads)
+
+
+def image_size(checkpoint):
+    """Width of the square images the checkpoint was trained on, 16 or 28."""
+    return int(round(np.sqrt(np.shape(checkpoint['imgs'])[1])))
+
+
+def load_mnist_test(train_dir, size=16):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'nn_train'))
+    from mnist import read_data_sets
+    test = read_data_sets(train_dir, size=size).test
+    return test.images, np.argmax(test.labels, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--checkpoint', default=filename)
+    parser.add_argument('--mnist', metavar='DIR',
+                        help='also classify the MNIST test set in DIR')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--lanes', type=int, default=1,
+                        help='num_lanes of the Pipeline, for the FPGA estimate')
+    parser.add_argument('--images', type=int, default=1,
+                        help='num_images of the streamed pipeline, for the FPGA estimate')
+    parser.add_argument('--clock', type=float, default=fpga_clock / 1e6,
+                        help='clock of the Pipeline in MHz, for the FPGA estimate')
+    args = parser.parse_args()
+
+    checkpoint = load_checkpoint(args.checkpoint)
+    if 'layers' in checkpoint:
+        # a checkpoint with hidden layers for layers.py, it has no 'weights' of a single layer
+        layer_words = [pack_images(layer) for layer in checkpoint['layers']]
+        predictions = classify_layers(pack_images(checkpoint['imgs']), layer_words)
+        print('{} layers: predictions {}'.format(len(layer_words), predictions.tolist()))
+        if args.mnist:
+            images, labels = load_mnist_test(args.mnist, image_size(checkpoint))
+            predictions = classify_layers(pack_images(images), layer_words, args.threads)
+            print('{} layers: accuracy {:.4f}'.format(len(layer_words), np.mean(predictions == labels)))
+        return
+    weights = pack_images(checkpoint['weights'])
+    num_classes, num_cycles = weights.shape
+
+    # the images baked into ReadROM, image_id selects one of them
+    predictions = classify(pack_images(checkpoint['imgs']), weights)
+    print('ROM images: predictions {}'.format(predictions.tolist()))
+    if 'imgs_int16' in checkpoint:
+        # the 16 x 16 checkpoints also have the images in the layout of the LUTs
+        predictions = classify(lut_images(checkpoint['imgs_int16']), checkpoint['weights_int16'])
+        print('LUT images: predictions {}'.format(predictions.tolist()))
+
+    if args.mnist:
+        images, labels = load_mnist_test(args.mnist, image_size(checkpoint))
+        image_words = pack_images(images)
+        start = time.perf_counter()
+        predictions = classify(image_words, weights, args.threads)
+        elapsed = time.perf_counter() - start
+        accuracy = np.mean(predictions == labels)
+        print('MNIST test set: {} images, accuracy {:.4f}'.format(
+            len(labels), accuracy))
+        print('CPU: {:.3f} s, {:.0f} images/s'.format(
+            elapsed, len(labels) / elapsed))
+    cycles = -(-num_classes // args.lanes) * num_cycles
+    clock = args.clock * 1e6
+    print('FPGA: {} cycles per batch of {}, {:.0f} images/s at {:.0f} Hz'.format(
+        cycles, args.images, clock / cycles * args.images, clock))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+"""
+Run a BNN of several binary layers on the datapath of Pipeline.
+
+The layers are scored one after another by the same NXOr, pop count and
+accumulator of Execute: the rows (neurons) of a layer like the classes of
+Pipeline, against the image for the first layer and against the binarized
+outputs of the layer before for the others.  A neuron of a hidden layer is
+1 when its pop count is at least half of its inputs, the sign of the sum of
+the +-1 products, and the outputs are collected N at a time into a scratch
+BRAM with a half for the outputs of a layer and one for the layer before.
+The weights of all layers are packed one after another into one ROM, so
+its address just counts up while the layers are scored.  The last layer
+is classified like in Pipeline.
+
+BNN.pkl holds the weight matrices of the layers in 'layers', written by
+nn_train/MNIST_XNORNet.ipynb when it is trained with hidden layers.
+"""
+from magma import *
+import mantle
+import math
+import pickle
+from functools import lru_cache
+import numpy as np
+from mantle.lattice.ice40 import ROMB, RAMB
+from modules import *
+
+
+# sizes of the hidden layers, the first layer has the N * num_cycles pixels of the image as
+# inputs and the last one has num_classes rows
+hidden_sizes = [64]
+layer_sizes = [N * num_cycles] + hidden_sizes + [num_classes]
+num_layers = len(layer_sizes) - 1
+# number of bits for num_layers
+n_layers = max(int(math.ceil(math.log2(num_layers))), 1)
+# number of blocks of the inputs and number of rows of a layer
+layer_cycles = [size // N for size in layer_sizes[:-1]]
+layer_rows = layer_sizes[1:]
+# number of bits for the rows of the largest layer
+n_rows = int(math.ceil(math.log2(max(layer_rows))))
+# number of bits for N, the outputs of a hidden layer are written N at a time
+n_N = int(math.log2(N))
+# number of words of the weight ROM and of its 256 word BRAMs
+layer_depth = sum(rows * cycles for rows, cycles in zip(layer_rows, layer_cycles))
+n_layer_addr = int(math.ceil(math.log2(layer_depth)))
+num_layer_roms = int(math.ceil(layer_depth / 256))
+# a layer has at most as many inputs as the image, so its cycles and counts fit into Execute,
+# and the outputs of a hidden layer are whole blocks
+assert hidden_sizes and num_lanes == 1 and N == 2 ** n_N
+assert all(size % N == 0 and size <= N * num_cycles for size in hidden_sizes)
+# a half of the scratch RAM holds the blocks of a layer
+assert n <= 7 and n_rows - n_N <= 7
+# the weight ROM, the scratch RAM and the image ROM fit into the 16 BRAMs of the hx1k
+assert N // 16 * (num_layer_roms + 1 + (n > 4)) <= 16
+
+
+# layer_roms[j, addr] is the j-th word of the block at addr of the weight ROM, the blocks of
+# row idx of a layer start at the end of the layer before plus idx * its cycles
+@lru_cache(maxsize=None)
+def load_layers(filename=filename):
+    with open(filename, 'rb') as input_file:
+        layers = pickle.load(input_file)['layers']
+    words = []
+    for weights, rows, cycles in zip(layers, layer_rows, layer_cycles):
+        if np.shape(weights) != (rows, cycles * N):
+            raise ValueError('a layer of {} is {}, hidden_sizes gives {}'.format(
+                filename, np.shape(weights), (rows, cycles * N)))
+        weights = np.asarray(weights).reshape(rows * cycles, N) > 0
+        words.append(np.packbits(weights[..., ::-1], axis=-1, bitorder='little').view('<u2'))
+    words = np.concatenate(words)
+    layer_roms = np.zeros((N // 16, num_layer_roms * 256), dtype=np.uint16)
+    layer_roms[:, :len(words)] = words.T
+    return layer_roms
+
+
+# layer_list(j, rom) is the rom-th BRAM of the j-th 16 bit wide ROM, as a list for ROMB
+def layer_list(j, rom=0):
+    return load_layers(filename)[j, 256 * rom:256 * (rom + 1)].tolist()
+
+
+# values[LAYER] for a constant of every layer, e.g. its number of cycles
+def layer_constant(layer, values, width):
+    mux = mantle.Mux(height=2 ** n_layers, width=width)
+    for i in range(2 ** n_layers):
+        wire(bits(values[i] if i < len(values) else 0, width), getattr(mux, 'I{}'.format(i)))
+    # a Mux of 2 selects with a Bit
+    wire(layer if n_layers > 1 else layer[0], mux.S)
+    return mux.O
+
+
+# generate layer, row, cycle and the weight ROM address of the blocks, like Controller
+# with a layer counter: the last cycle of a row switches to the next row and the last row
+# of a layer to the next layer, which waits for WRITTEN, the last outputs of the layer
+# before in the scratch RAM; after the last layer VALID stays low
+class LayerController(Circuit):
+    name = "LayerController"
+    IO = ['WRITTEN', In(Bit), 'CLK', In(Clock), 'LAYER', Out(Bits(n_layers)), 'ROW', Out(Bits(n_rows)),
+          'CYCLE', Out(Bits(n)), 'ADDR', Out(Bits(n_layer_addr)), 'VALID', Out(Bit)]
+    @classmethod
+    def definition(io):
+        adder_cycle = mantle.Add(n, cin=False, cout=False)
+        reg_cycle = mantle.Register(n, has_ce=True, has_reset=True)
+        adder_row = mantle.Add(n_rows, cin=False, cout=False)
+        reg_row = mantle.Register(n_rows, has_ce=True, has_reset=True)
+        adder_layer = mantle.Add(n_layers, cin=False, cout=False)
+        reg_layer = mantle.Register(n_layers, has_ce=True)
+        adder_addr = mantle.Add(n_layer_addr, cin=False, cout=False)
+        reg_addr = mantle.Register(n_layer_addr, has_ce=True)
+        reg_run = mantle.DFF(init=1)
+        reg_wait = mantle.DFF()
+        wire(io.CLK, reg_cycle.CLK)
+        wire(io.CLK, reg_row.CLK)
+        wire(io.CLK, reg_layer.CLK)
+        wire(io.CLK, reg_addr.CLK)
+        wire(io.CLK, reg_run.CLK)
+        wire(io.CLK, reg_wait.CLK)
+        # a block is read every cycle while running, unless the layer waits for its inputs
+        nand_wait = mantle.NAnd()
+        wire(reg_wait.O, nand_wait.I0)
+        wire(reg_wait.O, nand_wait.I1)
+        and_issue = mantle.And()
+        wire(reg_run.O, and_issue.I0)
+        wire(nand_wait.O, and_issue.I1)
+        issue = and_issue.O
+        comparison_cycle = mantle.EQ(n)
+        wire(reg_cycle.O, comparison_cycle.I0)
+        wire(layer_constant(reg_layer.O, [cycles - 1 for cycles in layer_cycles], n), comparison_cycle.I1)
+        comparison_row = mantle.EQ(n_rows)
+        wire(reg_row.O, comparison_row.I0)
+        wire(layer_constant(reg_layer.O, [rows - 1 for rows in layer_rows], n_rows), comparison_row.I1)
+        comparison_layer = mantle.EQ(n_layers)
+        wire(reg_layer.O, comparison_layer.I0)
+        wire(bits(num_layers - 1, n_layers), comparison_layer.I1)
+        # the last cycle of a row, of the last row of a layer
+        and_row = mantle.And()
+        wire(issue, and_row.I0)
+        wire(comparison_cycle.O, and_row.I1)
+        and_layer = mantle.And()
+        wire(and_row.O, and_layer.I0)
+        wire(comparison_row.O, and_layer.I1)
+        # a hidden layer is followed by the next one, the last one finishes the image
+        nand_last = mantle.NAnd()
+        wire(comparison_layer.O, nand_last.I0)
+        wire(comparison_layer.O, nand_last.I1)
+        and_next = mantle.And()
+        wire(and_layer.O, and_next.I0)
+        wire(nand_last.O, and_next.I1)
+        nand_done = mantle.NAnd()
+        wire(and_layer.O, nand_done.I0)
+        wire(comparison_layer.O, nand_done.I1)
+        wire(reg_cycle.O, adder_cycle.I0)
+        wire(bits(1, n), adder_cycle.I1)
+        wire(adder_cycle.O, reg_cycle.I)
+        wire(issue, reg_cycle.CE)
+        wire(comparison_cycle.O, reg_cycle.RESET)
+        wire(reg_row.O, adder_row.I0)
+        wire(bits(1, n_rows), adder_row.I1)
+        wire(adder_row.O, reg_row.I)
+        wire(and_row.O, reg_row.CE)
+        wire(comparison_row.O, reg_row.RESET)
+        wire(reg_layer.O, adder_layer.I0)
+        wire(bits(1, n_layers), adder_layer.I1)
+        wire(adder_layer.O, reg_layer.I)
+        wire(and_next.O, reg_layer.CE)
+        # the layers are packed one after another, the address follows the blocks
+        wire(reg_addr.O, adder_addr.I0)
+        wire(bits(1, n_layer_addr), adder_addr.I1)
+        wire(adder_addr.O, reg_addr.I)
+        wire(issue, reg_addr.CE)
+        # wait from the end of a hidden layer until its last outputs are written
+        nand_written = mantle.NAnd()
+        wire(io.WRITTEN, nand_written.I0)
+        wire(io.WRITTEN, nand_written.I1)
+        and_wait = mantle.And()
+        wire(reg_wait.O, and_wait.I0)
+        wire(nand_written.O, and_wait.I1)
+        or_wait = mantle.Or()
+        wire(and_next.O, or_wait.I0)
+        wire(and_wait.O, or_wait.I1)
+        wire(or_wait.O, reg_wait.I)
+        and_run = mantle.And()
+        wire(reg_run.O, and_run.I0)
+        wire(nand_done.O, and_run.I1)
+        wire(and_run.O, reg_run.I)
+        wire(reg_layer.O, io.LAYER)
+        wire(reg_row.O, io.ROW)
+        wire(reg_cycle.O, io.CYCLE)
+        wire(reg_addr.O, io.ADDR)
+        wire(issue, io.VALID)
+
+
+# weight ROM of all layers, WEIGHT is the block at ADDR one cycle later
+# a ROM deeper than 256 words spans num_layer_roms BRAMs like WeightROM
+class LayerROM(Circuit):
+    name = "LayerROM"
+    IO = ['ADDR', In(Bits(n_layer_addr)), 'CLK', In(Clock), 'WEIGHT', Out(Bits(N))]
+    @classmethod
+    def definition(io):
+        if num_layer_roms > 1:
+            # the read is registered, so is the selection of the BRAM
+            reg_rom = mantle.Register(n_layer_addr - 8)
+            wire(io.CLK, reg_rom.CLK)
+            wire(io.ADDR[8:], reg_rom.I)
+        for j in range(N // 16):
+            weight = io.WEIGHT[16 * j:16 * (j + 1)]
+            if num_layer_roms > 1:
+                mux_for_rom = mantle.Mux(height=2 ** (n_layer_addr - 8), width=16)
+                wire(reg_rom.O if n_layer_addr > 9 else reg_rom.O[0], mux_for_rom.S)
+                wire(mux_for_rom.O, weight)
+            for rom in range(2 ** max(n_layer_addr - 8, 0)):
+                if rom >= num_layer_roms:
+                    wire(bits(0, 16), getattr(mux_for_rom, 'I{}'.format(rom)))
+                    continue
+                weigths_rom = ROMB(256,16,layer_list(j, rom))
+                wire(io.ADDR[:min(n_layer_addr, 8)], weigths_rom.RADDR[:min(n_layer_addr, 8)])
+                if n_layer_addr < 8:
+                    wire(bits(0, 8-n_layer_addr), weigths_rom.RADDR[n_layer_addr:])
+                wire(1, weigths_rom.RE)
+                wire(io.CLK, weigths_rom.RCLK)
+                if num_layer_roms > 1:
+                    wire(weigths_rom.RDATA, getattr(mux_for_rom, 'I{}'.format(rom)))
+                else:
+                    wire(weigths_rom.RDATA, weight)
+
+
+# Pipeline for a BNN of num_layers layers, O is the label of the image of image_id and D
+# is high after it is known
+class LayerPipeline(Circuit):
+    name = "LayerPipeline"
+    IO = ['CLK', In(Clock), 'O', Out(Bits(b)), 'D', Out(Bit)]
+    @classmethod
+    def definition(io):
+        # IF - get layer, row, cycle and the address of the weight block
+        controller = LayerController()
+        wire(io.CLK, controller.CLK)
+        # RR - get weight block, the input block from the image or the scratch RAM, all of them
+        # register the read
+        weight_rom = LayerROM()
+        image_rom = ImageROM()
+        reg_2 = mantle.Register(n_rows + n_layers + n + 1)
+        wire(io.CLK, weight_rom.CLK)
+        wire(io.CLK, image_rom.CLK)
+        wire(io.CLK, reg_2.CLK)
+        wire(controller.ADDR, weight_rom.ADDR)
+        wire(controller.CYCLE, image_rom.CYCLE)
+        wire(concat(controller.ROW, controller.LAYER, controller.CYCLE, bits([controller.VALID])), reg_2.I)
+        # layer l reads the half 1 - l % 2 of the scratch RAM the layer before wrote
+        nand_read = mantle.NAnd()
+        wire(controller.LAYER[0], nand_read.I0)
+        wire(controller.LAYER[0], nand_read.I1)
+        scratch_rams = []
+        for j in range(N // 16):
+            scratch_ram = RAMB(256, 16)
+            wire(controller.CYCLE, scratch_ram.RADDR[:n])
+            if n < 7:
+                wire(bits(0, 7 - n), scratch_ram.RADDR[n:7])
+            wire(nand_read.O, scratch_ram.RADDR[7])
+            wire(1, scratch_ram.RE)
+            wire(io.CLK, scratch_ram.RCLK)
+            wire(io.CLK, scratch_ram.WCLK)
+            scratch_rams.append(scratch_ram)
+        # the first layer reads the image
+        comparison_2 = mantle.EQ(n_layers)
+        mux_2 = mantle.Mux(height=2, width=N)
+        wire(reg_2.O[n_rows:n_rows + n_layers], comparison_2.I0)
+        wire(bits(0, n_layers), comparison_2.I1)
+        wire(concat(*[scratch_ram.RDATA for scratch_ram in scratch_rams]), mux_2.I0)
+        wire(image_rom.IMAGE, mux_2.I1)
+        wire(comparison_2.O, mux_2.S)
+        # EX - NXOr for multiplication, pop count and accumulate the result for activation,
+        # the layer is delayed with the row
+        execute = DefineExecute(n_idx=n_rows + n_layers)()
+        wire(io.CLK, execute.CLK)
+        wire(weight_rom.WEIGHT, execute.WEIGHT)
+        wire(mux_2.O, execute.IMAGE)
+        wire(reg_2.O[:n_rows + n_layers], execute.IDX)
+        wire(reg_2.O[n_rows + n_layers:n_rows + n_layers + n], execute.CYCLE)
+        wire(reg_2.O[n_rows + n_layers + n], execute.VALID)
+        count_row = execute.COUNT_IDX[:n_rows]
+        count_layer = execute.COUNT_IDX[n_rows:]
+        # the complete count of a row is the one of the last cycle of its layer
+        comparison_3_1 = mantle.EQ(n)
+        and_3_1 = mantle.And()
+        wire(execute.COUNT_CYCLE, comparison_3_1.I0)
+        wire(layer_constant(count_layer, [cycles - 1 for cycles in layer_cycles], n), comparison_3_1.I1)
+        wire(execute.COUNT_VALID, and_3_1.I0)
+        wire(comparison_3_1.O, and_3_1.I1)
+        comparison_3_2 = mantle.EQ(n_layers)
+        wire(count_layer, comparison_3_2.I0)
+        wire(bits(num_layers - 1, n_layers), comparison_3_2.I1)
+        comparison_3_3 = mantle.EQ(n_rows)
+        wire(count_row, comparison_3_3.I0)
+        wire(layer_constant(count_layer, [rows - 1 for rows in layer_rows], n_rows), comparison_3_3.I1)
+        # WB - a hidden output is 1 when the count is at least half of the inputs, it is
+        # shifted in and the block of N outputs is written with the last one of them
+        comparison_act = mantle.UGT(n_bc_adder)
+        wire(execute.COUNT, comparison_act.I0)
+        wire(layer_constant(count_layer, [size // 2 - 1 for size in layer_sizes[:-1]], n_bc_adder),
+             comparison_act.I1)
+        nand_hidden = mantle.NAnd()
+        wire(comparison_3_2.O, nand_hidden.I0)
+        wire(comparison_3_2.O, nand_hidden.I1)
+        and_shift = mantle.And()
+        wire(and_3_1.O, and_shift.I0)
+        wire(nand_hidden.O, and_shift.I1)
+        reg_act = mantle.Register(N, has_ce=True)
+        wire(io.CLK, reg_act.CLK)
+        # the first row of a block ends up in the most significant bit, like the image
+        activations = concat(bits([comparison_act.O]), reg_act.O[:N - 1])
+        wire(activations, reg_act.I)
+        wire(and_shift.O, reg_act.CE)
+        comparison_block = mantle.EQ(n_N)
+        wire(count_row[:n_N], comparison_block.I0)
+        wire(bits(N - 1, n_N), comparison_block.I1)
+        and_write = mantle.And()
+        wire(and_shift.O, and_write.I0)
+        wire(comparison_block.O, and_write.I1)
+        for j, scratch_ram in enumerate(scratch_rams):
+            if n_rows > n_N:
+                wire(count_row[n_N:], scratch_ram.WADDR[:n_rows - n_N])
+            if n_rows - n_N < 7:
+                wire(bits(0, 7 - n_rows + n_N), scratch_ram.WADDR[n_rows - n_N:7])
+            wire(count_layer[0], scratch_ram.WADDR[7])
+            wire(activations[16 * j:16 * (j + 1)], scratch_ram.WDATA)
+            wire(enable(and_write.O), scratch_ram.WE)
+        # the block of the last row lets the controller start the next layer
+        and_written = mantle.And()
+        wire(and_write.O, and_written.I0)
+        wire(comparison_3_3.O, and_written.I1)
+        wire(and_written.O, controller.WRITTEN)
+        # CF - classify the image with the last layer, its complete count of row 0 starts a new maximum
+        classifier = DefineClassifier(has_load=True)()
+        wire(io.CLK, classifier.CLK)
+        wire(execute.COUNT, classifier.I)
+        wire(count_row[:b], classifier.IDX)
+        and_final = mantle.And()
+        wire(and_3_1.O, and_final.I0)
+        wire(comparison_3_2.O, and_final.I1)
+        comparison_first = mantle.EQ(n_rows)
+        and_load = mantle.And()
+        wire(count_row, comparison_first.I0)
+        wire(bits(0, n_rows), comparison_first.I1)
+        wire(and_final.O, and_load.I0)
+        wire(comparison_first.O, and_load.I1)
+        wire(and_load.O, classifier.LOAD)
+        and_done = mantle.And()
+        wire(and_final.O, and_done.I0)
+        wire(comparison_3_3.O, and_done.I1)
+        # the classifier takes the count of the last row one cycle later
+        reg_4 = mantle.DFF()
+        wire(io.CLK, reg_4.CLK)
+        wire(and_done.O, reg_4.I)
+        reg_5 = mantle.Register(b, has_ce=True)
+        wire(io.CLK, reg_5.CLK)
+        wire(classifier.O, reg_5.I)
+        wire(reg_4.O, reg_5.CE)
+        wire(reg_5.O, io.O)
+        # latch the light indicating the end
+        reg_6 = mantle.DFF()
+        or_gate = mantle.Or()
+        wire(io.CLK, reg_6.CLK)
+        wire(reg_4.O, or_gate.I0)
+        wire(reg_6.O, or_gate.I1)
+        wire(or_gate.O, reg_6.I)
+        wire(reg_6.O, io.D)
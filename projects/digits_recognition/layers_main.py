@@ -0,0 +1,23 @@
+from magma import *
+from loam.boards.icestick import IceStick
+from layers import LayerPipeline
+
+
+icestick = IceStick()
+icestick.Clock.on()
+icestick.D1.on()
+icestick.D2.on()
+icestick.D3.on()
+icestick.D4.on()
+icestick.D5.on()
+
+main = icestick.main()
+
+# the layers of the BNN in nn_train/BNN.pkl are scored one after another on one datapath
+pipeline = LayerPipeline()
+wire(main.CLKIN, pipeline.CLK)
+wire(pipeline.O[:4], bits([main.D1, main.D2, main.D3, main.D4]))
+# light 5 indicates the end of prediction
+wire(pipeline.D, main.D5)
+
+EndCircuit()
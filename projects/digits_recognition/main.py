@@ -5,6 +5,12 @@ if os.path.exists('pipeline.py'):
     from pipeline import Pipeline
 else:
     from modules import Pipeline
+from pll import pll_clock
+
+# clock of the pipeline in MHz, by default the 12 MHz clock divided by 16; 12 runs
+# it from CLKIN and other clocks are generated by the PLL, check the timing report
+# of the build (bram_patch.py --clock) before setting it
+clock_mhz = os.environ.get('BNN_CLOCK_MHZ')
 
 
 icestick = IceStick()
@@ -17,10 +23,15 @@ icestick.D5.on()
 
 main = icestick.main()
 
-# decrease the frequency to avoid timing violation
-counter = Counter(4)
 pipeline = Pipeline()
-wire(counter.O[-1], pipeline.CLK)
+if clock_mhz is None:
+    # decrease the frequency to avoid timing violation
+    counter = Counter(4)
+    wire(counter.O[-1], pipeline.CLK)
+elif float(clock_mhz) == 12:
+    wire(main.CLKIN, pipeline.CLK)
+else:
+    wire(pll_clock(main, float(clock_mhz) * 1e6), pipeline.CLK)
 wire(pipeline.O[:4], bits([main.D1, main.D2, main.D3, main.D4]))
 # light 5 indicates the end of prediction
 wire(pipeline.D, main.D5)
@@ -23,51 +23,131 @@ THE SOFTWARE.
 """
 from magma import *
 import mantle
+import hashlib
 import math
+import os
 import pickle
-from mantle.lattice.ice40 import ROMB, SB_LUT4
+from functools import lru_cache
+import numpy as np
+from mantle.lattice.ice40 import ROMB, RAMB, SB_LUT4
 
 
+# N, num_cycles and num_lanes can be overridden from the environment, sweep.py
+# builds every point of its design space in a process of its own
 image_id = 3
-num_cycles = 16
+num_cycles = int(os.environ.get('BNN_NUM_CYCLES', 16))
 num_classes = 10
 # operand width
-N = 16
+N = int(os.environ.get('BNN_N', 16))
+# number of classes scored in parallel, each lane has its own weight ROM
+num_lanes = int(os.environ.get('BNN_NUM_LANES', 1))
+# number of images scored in parallel against each weight block by the streamed pipeline
+num_images = 1
+# number of register stages in the bit counter, to meet the 12 MHz clock of the icestick
+bc_stages = 1
 # number of bits for num_cycles
 n = int(math.ceil(math.log2(num_cycles)))
 # number of bits for num_classes
 b = int(math.ceil(math.log2(num_classes)))
+# number of bits for num_images
+n_images = int(math.ceil(math.log2(num_images)))
 # number of bits for bit counter output
 n_bc = int(math.floor(math.log2(N))) + 1
 # number of bits for bit counter output accumulator
 n_bc_adder = int(math.floor(math.log2(N*num_cycles))) + 1
+# number of rounds over the classes, num_lanes classes per round
+num_rounds = int(math.ceil(num_classes / num_lanes))
+# idx of the first class scored in the last round
+last_idx = (num_rounds - 1) * num_lanes
+# number of words of a weight ROM, the rows of a lane are packed one after another
+rom_depth = num_rounds * num_cycles
+# number of bits for rom_depth
+n_addr = int(math.ceil(math.log2(rom_depth)))
+# number of 256 word BRAMs of a weight ROM
+num_roms = int(math.ceil(rom_depth / 256))
 
 
 # read weight and images
 # weight matrix is of image_size x num_classes, here is 10 x 256, each is 1 bit
-# image vector is of image_size, here is 256, each is 1 bit
+# image vector is of image_size, here is 256, each is 1 bit, image_size is N * num_cycles,
+# e.g. N = 16 and num_cycles = 49 for the 28 x 28 images of MNIST
 filename = 'nn_train/BNN.pkl'
-with open(filename, 'rb') as input_file:
-    checkpoint = pickle.load(input_file)
-# weights is ndarray of size 10 (rows) x 256 / 16 = 160, each entry standing for 16 bits
-weights = checkpoint['weights_int16']
-weights_f = weights.flatten()
-# weight_list is list of size 160, each entry standing for 16 bits
-weights_list = weights_f.tolist()
-# weight_list is list of size 256, each entry standing for 16 bits
-for i in range(256 - len(weights_list)):
-    weights_list.append(0)
-# imgs is ndarray of size 10 (images) x 16 x 16 / 16 = 160, each entry standing for 16 bits
-imgs = checkpoint['imgs_int16']
-imgs_f = imgs.flatten()
-# imgs_list is list of size 160, every 16 entries standing for one image
-imgs_list = imgs_f.tolist()
+# the ROM and LUT contents are cached in build, keyed by the hash of the pickle and the layout
+cache_dir = 'build'
+
+
+def pack_contents(checkpoint):
+    images = np.asarray(checkpoint['imgs']).reshape(-1, num_cycles, N) > 0
+    # weights_roms[lane, j] is the j-th 16 bit wide ROM of a lane, entry
+    # idx / num_lanes * num_cycles + cycle holds the j-th word of the cycle-th block of row idx + lane
+    # a checkpoint with hidden layers has its weights in 'layers' for layers.py, its ROMs are empty
+    if 'layers' in checkpoint and np.shape(checkpoint.get('weights')) != (num_classes, N * num_cycles):
+        weights_roms = np.zeros((num_lanes, N // 16, 0), dtype=np.uint16)
+    else:
+        # blocks[row, cycle] is the cycle-th block of N bits of a row, the first bit is the most significant
+        weights = np.asarray(checkpoint['weights']).reshape(num_classes, num_cycles, N) > 0
+        # words[row, cycle, j] are bits [16 * j, 16 * (j + 1)) of the cycle-th block of a row
+        words = np.packbits(weights[..., ::-1], axis=-1, bitorder='little').view('<u2')
+        weights_roms = np.zeros((num_lanes, N // 16, num_roms * 256), dtype=np.uint16)
+        for lane in range(num_lanes):
+            rows = np.arange(lane, num_classes, num_lanes)
+            entries = np.arange(len(rows))[:, None] * num_cycles + np.arange(num_cycles)
+            weights_roms[lane][:, entries] = words[rows].transpose(2, 0, 1)
+    # image_words[image, j, cycle] is the j-th word of the cycle-th block of an image
+    image_words = np.packbits(images[..., ::-1], axis=-1, bitorder='little').view('<u2')
+    return weights_roms, np.ascontiguousarray(image_words.transpose(0, 2, 1))
+
+
+# the name of the contents of a pickle in the cache, its hash and the layout
+def contents_key(filename, data):
+    return '{}-{}-N{}-c{}-l{}'.format(os.path.splitext(os.path.basename(filename))[0],
+                                      hashlib.sha1(data).hexdigest()[:16], N, num_cycles, num_lanes)
+
+
+# load weights_roms and image_words the first time they are needed, the pickle is only read
+# if its contents are not in the cache yet
+@lru_cache(maxsize=None)
+def load_contents(filename=filename):
+    with open(filename, 'rb') as input_file:
+        data = input_file.read()
+    key = contents_key(filename, data)
+    paths = [os.path.join(cache_dir, '{}-{}.npy'.format(key, name)) for name in ('weights_roms', 'image_words')]
+    if not all(os.path.exists(path) for path in paths):
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, contents in zip(paths, pack_contents(pickle.loads(data))):
+            np.save(path + '.tmp.npy', contents)
+            os.replace(path + '.tmp.npy', path)
+    # a tuple(...) here would be magma's tuple
+    weights_roms, image_words = (np.load(path, mmap_mode='r') for path in paths)
+    return weights_roms, image_words
+
+
+# weights_list(lane, j, rom) is the rom-th BRAM of the j-th ROM of a lane, as a list for ROMB
+def weights_list(lane, j, rom=0):
+    weights_roms = load_contents(filename)[0]
+    if not weights_roms.shape[2]:
+        raise ValueError('{} has hidden layers, build it with layers.py'.format(filename))
+    return weights_roms[lane, j, 256 * rom:256 * (rom + 1)].tolist()
+
+
+# image_lut(i) is the LUT_INIT of bit i of the image block of image_id, bit cycle of it is
+# bit i of the cycle-th block
+def image_lut(i, image=image_id):
+    words = load_contents(filename)[1][image, i // 16]
+    return sum(int(word >> (i % 16) & 1) << cycle for cycle, word in enumerate(words))
+
+
+# image_list(j) is the j-th 16 bit wide ROM of the image of image_id, entry cycle is its cycle-th block
+def image_list(j, image=image_id):
+    words = load_contents(filename)[1][image, j].tolist()
+    return words + [0] * (256 - len(words))
 
 
 # generate address for weight and image block
 # idx means the idx-th row of weight matrix
 # cycle means the cycle-th block of idx-th row of weight matrix
 # cycle also means the cycle-th block of image vector
+# idx steps by num_lanes, the lanes score rows idx to idx + num_lanes - 1
 class Controller(Circuit):
     name = "Controller"
     IO = ['CLK', In(Clock), 'IDX', Out(Bits(b)),
@@ -91,17 +171,28 @@ class Controller(Circuit):
         wire(comparison_cycle.O, reg_idx.CE)
         comparison_idx = mantle.EQ(b)
         wire(reg_idx.O, comparison_idx.I0)
-        wire(bits(num_classes-1, b), comparison_idx.I1)
+        wire(bits(last_idx, b), comparison_idx.I1)
         wire(reg_idx.O, adder_idx.I0)
-        wire(bits(0, b-1), adder_idx.I1[1:])
         nand_gate = mantle.NAnd()
         wire(comparison_cycle.O, nand_gate.I0)
         wire(comparison_idx.O, nand_gate.I1)
         # after all idx rows, we stop accumulating idx
-        wire(nand_gate.O, adder_idx.I1[0])
+        for i in range(b):
+            if (num_lanes >> i) & 1:
+                wire(nand_gate.O, adder_idx.I1[i])
+            else:
+                wire(0, adder_idx.I1[i])
         wire(adder_idx.O, reg_idx.I)
         wire(reg_idx.O, io.IDX)
-        wire(adder_cycle.O, io.CYCLE)
+        if num_cycles == 2 ** n:
+            wire(adder_cycle.O, io.CYCLE)
+        else:
+            # the adder only wraps around at 2 ** n, CYCLE follows the reset to 0
+            mux_cycle = mantle.Mux(height=2, width=n)
+            wire(adder_cycle.O, mux_cycle.I0)
+            wire(bits(0, n), mux_cycle.I1)
+            wire(comparison_cycle.O, mux_cycle.S)
+            wire(mux_cycle.O, io.CYCLE)
 
 
 # Test Unit for Rom Reading
@@ -128,29 +219,169 @@ class TestReadROM(Circuit):
             wire(lut_list[i].O, io.IMAGE[i])
 
 
+# address of the weight block of row IDX and block CYCLE in a weight ROM, the rows of a lane are
+# packed one after another, ADDR = IDX / num_lanes * num_cycles + CYCLE
+class RowAddress(Circuit):
+    name = "RowAddress"
+    IO = ['IDX', In(Bits(b)), 'CYCLE', In(Bits(n)), 'ADDR', Out(Bits(n_addr))]
+    @classmethod
+    def definition(io):
+        if num_lanes == 1 and num_cycles == 2 ** n:
+            wire(io.CYCLE, io.ADDR[:n])
+            wire(io.IDX[:n_addr - n], io.ADDR[n:])
+            return
+        # the address of the first block of a row is looked up by a LUT per bit,
+        # with num_cycles a power of 2 its low bits are 0 and CYCLE fills them
+        assert b <= 4
+        low = n if num_cycles == 2 ** n else 0
+        base = []
+        for i in range(low, n_addr):
+            lut = SB_LUT4(LUT_INIT=sum((idx // num_lanes * num_cycles >> i & 1) << idx
+                                       for idx in range(0, num_classes, num_lanes)))
+            lut_inputs = [lut.I0, lut.I1, lut.I2, lut.I3]
+            wire(io.IDX, bits(lut_inputs[:b]))
+            for lut_input in lut_inputs[b:]:
+                wire(0, lut_input)
+            base.append(lut.O)
+        if low:
+            wire(io.CYCLE, io.ADDR[:n])
+            # with a row per lane there is a block per lane, ADDR = CYCLE
+            if n_addr > n:
+                wire(bits(base), io.ADDR[n:])
+        else:
+            adder = mantle.Add(n_addr, cin=False, cout=False)
+            wire(bits(base), adder.I0)
+            wire(io.CYCLE, adder.I1[:n])
+            if n_addr > n:
+                wire(bits(0, n_addr - n), adder.I1[n:])
+            wire(adder.O, io.ADDR)
+
+
+# weight ROM unit
+# WEIGHT[lane * N:(lane + 1) * N] is the weight block of row IDX + lane, one cycle after IDX and CYCLE
+# a ROM deeper than 256 words spans num_roms BRAMs, the high bits of the address select one
+# with has_write, the weights are in RAMs that can be rewritten without a new synthesis
+@lru_cache(maxsize=None)
+def DefineWeightROM(has_write=False):
+    class _WeightROM(Circuit):
+        # a ROMB is 16 bit wide
+        assert N % 16 == 0
+        name = "WeightRAM" if has_write else "WeightROM"
+        IO = ['IDX', In(Bits(b)), 'CYCLE', In(Bits(n)), 'CLK', In(Clock),
+              'WEIGHT', Out(Bits(N * num_lanes))]
+        # the RAMs start with the weights of BNN.pkl, WE has one bit per RAM,
+        # RAM j of lane l is bit l * N / 16 + j, WIDX and WCYCLE are the row and block to write
+        if has_write:
+            IO += ['WIDX', In(Bits(b)), 'WCYCLE', In(Bits(n)), 'WDATA', In(Bits(16)),
+                   'WE', In(Bits(num_lanes * N // 16))]
+        @classmethod
+        def definition(io):
+            address = RowAddress()
+            wire(io.IDX, address.IDX)
+            wire(io.CYCLE, address.CYCLE)
+            if has_write:
+                write_address = RowAddress()
+                wire(io.WIDX, write_address.IDX)
+                wire(io.WCYCLE, write_address.CYCLE)
+            if num_roms > 1:
+                # the read is registered, so is the selection of the BRAM
+                reg_rom = mantle.Register(n_addr - 8)
+                wire(io.CLK, reg_rom.CLK)
+                wire(address.ADDR[8:], reg_rom.I)
+            for lane in range(num_lanes):
+                for j in range(N // 16):
+                    weight = io.WEIGHT[lane * N + 16 * j:lane * N + 16 * (j + 1)]
+                    if num_roms > 1:
+                        mux_for_rom = mantle.Mux(height=2 ** (n_addr - 8), width=16)
+                        wire(reg_rom.O if n_addr > 9 else reg_rom.O[0], mux_for_rom.S)
+                        wire(mux_for_rom.O, weight)
+                    for rom in range(2 ** max(n_addr - 8, 0)):
+                        if rom >= num_roms:
+                            wire(bits(0, 16), getattr(mux_for_rom, 'I{}'.format(rom)))
+                            continue
+                        if has_write:
+                            weigths_rom = RAMB(256,16,weights_list(lane, j, rom))
+                            write = io.WE[lane * N // 16 + j]
+                            if num_roms > 1:
+                                comparison_rom = mantle.EQ(n_addr - 8)
+                                and_rom = mantle.And()
+                                wire(write_address.ADDR[8:], comparison_rom.I0)
+                                wire(bits(rom, n_addr - 8), comparison_rom.I1)
+                                wire(write, and_rom.I0)
+                                wire(comparison_rom.O, and_rom.I1)
+                                write = and_rom.O
+                            wire(write_address.ADDR[:min(n_addr, 8)], weigths_rom.WADDR[:min(n_addr, 8)])
+                            if n_addr < 8:
+                                wire(bits(0, 8-n_addr), weigths_rom.WADDR[n_addr:])
+                            wire(io.WDATA, weigths_rom.WDATA)
+                            wire(enable(write), weigths_rom.WE)
+                            wire(io.CLK, weigths_rom.WCLK)
+                        else:
+                            weigths_rom = ROMB(256,16,weights_list(lane, j, rom))
+                        wire(address.ADDR[:min(n_addr, 8)], weigths_rom.RADDR[:min(n_addr, 8)])
+                        if n_addr < 8:
+                            wire(bits(0, 8-n_addr), weigths_rom.RADDR[n_addr:])
+                        wire(1, weigths_rom.RE)
+                        wire(io.CLK, weigths_rom.RCLK)
+                        if num_roms > 1:
+                            wire(weigths_rom.RDATA, getattr(mux_for_rom, 'I{}'.format(rom)))
+                        else:
+                            wire(weigths_rom.RDATA, weight)
+    return _WeightROM
+
+
+WeightROM = DefineWeightROM()
+
+
+# image of image_id, IMAGE is the block CYCLE one cycle later like the weight ROM
+class ImageROM(Circuit):
+    name = "ImageROM"
+    IO = ['CYCLE', In(Bits(n)), 'CLK', In(Clock), 'IMAGE', Out(Bits(N))]
+    @classmethod
+    def definition(io):
+        if n > 4:
+            # a LUT has 4 inputs, more blocks are stored in ROMs like the weights
+            for j in range(N // 16):
+                image_rom = ROMB(256,16,image_list(j))
+                wire(io.CYCLE, image_rom.RADDR[:n])
+                if n < 8:
+                    wire(bits(0, 8-n), image_rom.RADDR[n:])
+                wire(1, image_rom.RE)
+                wire(io.CLK, image_rom.RCLK)
+                wire(image_rom.RDATA, io.IMAGE[16 * j:16 * (j + 1)])
+            return
+        # using N LUTs to store the image, each LUT contributes 1 bit per cycle
+        lut_list = []
+        for i in range(N):
+            lut_list.append(SB_LUT4(LUT_INIT=image_lut(i)))
+        reg_image = mantle.Register(N)
+        wire(io.CLK, reg_image.CLK)
+        for i in range(N):
+            lut_inputs = [lut_list[i].I0, lut_list[i].I1, lut_list[i].I2, lut_list[i].I3]
+            wire(io.CYCLE, bits(lut_inputs[:n]))
+            for lut_input in lut_inputs[n:]:
+                wire(0, lut_input)
+            wire(lut_list[i].O, reg_image.I[i])
+        wire(reg_image.O, io.IMAGE)
+
+
 # Read ROM unit
+# WEIGHT and IMAGE are the blocks of IDX and CYCLE one cycle later
 class ReadROM(Circuit):
-    assert N == 16
     name = "ReadROM"
     IO = ['IDX', In(Bits(b)), 'CYCLE', In(Bits(n)), 'CLK', In(Clock),
-          'WEIGHT', Out(Bits(N)), 'IMAGE', Out(Bits(N))]
+          'WEIGHT', Out(Bits(N * num_lanes)), 'IMAGE', Out(Bits(N))]
     @classmethod
     def definition(io):
-        weigths_rom = ROMB(256,16,weights_list)
-        # using 16 LUTs to store the image, each LUT contributes 1 bit per cycle
-        lut_list = []
-        for i in range(N):
-            lut_list.append(SB_LUT4(LUT_INIT=imgs_list[N * image_id + i]))
-        wire(io.CYCLE, weigths_rom.RADDR[:n])
-        wire(io.IDX, weigths_rom.RADDR[n:n + b])
-        if n+b < 8:
-            wire(bits(0, 8-n-b), weigths_rom.RADDR[n+b:])
-        wire(1, weigths_rom.RE)
-        wire(weigths_rom.RDATA, io.WEIGHT)
-        wire(io.CLK, weigths_rom.RCLK)
-        for i in range(N):
-            wire(io.CYCLE, bits([lut_list[i].I0, lut_list[i].I1, lut_list[i].I2, lut_list[i].I3]))
-            wire(lut_list[i].O, io.IMAGE[i])
+        weigths_rom = WeightROM()
+        image_rom = ImageROM()
+        wire(io.IDX, weigths_rom.IDX)
+        wire(io.CYCLE, weigths_rom.CYCLE)
+        wire(io.CLK, weigths_rom.CLK)
+        wire(weigths_rom.WEIGHT, io.WEIGHT)
+        wire(io.CYCLE, image_rom.CYCLE)
+        wire(io.CLK, image_rom.CLK)
+        wire(image_rom.IMAGE, io.IMAGE)
 
 
 # 4-bit pop count
@@ -208,36 +439,299 @@ class BitCounter16(Circuit):
         wire(adders[-1].COUT, io.O[-1])
 
 
-# pop count
-def DefineBitCounter(n):
-    if n <= 4:
-        return BitCounter4
-    elif n <= 8:
-        return BitCounter8
-    elif n <= 16:
-        return BitCounter16
-    else:
-        return None
+# number of carry-save levels to reduce columns of bits of the given heights
+# to at most one bit per column
+def carry_save_levels(heights):
+    levels = 0
+    while max(heights) > 1:
+        reduced = [0] * (len(heights) + 1)
+        for i, height in enumerate(heights):
+            # a full adder for every 3 bits, a half adder for 2 remaining bits
+            reduced[i] += height // 3 + height % 3 // 2 + height % 3 % 2
+            reduced[i + 1] += height // 3 + height % 3 // 2
+        heights = reduced
+        levels += 1
+    return levels
 
 
-# classifier unit: using compare operation to decide the final prediction label of image
-class Classifier(Circuit):
-    name = "Classifier"
-    IO = ['I', In(Bits(n_bc_adder)), 'IDX', In(Bits(b)), 'CLK', In(Clock), 'O', Out(Bits(b))]
+# n-bit pop count of any width
+# 4-bit pop counts of BitCounter4 are reduced by a carry-save tree of full and half adders,
+# summing the columns of bits of the same weight until each column has one bit
+# (Dadda dot notation, see notebooks/intermediate/PopCount.ipynb)
+# stages registers are spread over the levels of the tree, the result is delayed by stages cycles
+@lru_cache(maxsize=None)
+def DefineBitCounter(n, stages=0):
+    if stages == 0 and n in (4, 8, 16):
+        return {4: BitCounter4, 8: BitCounter8, 16: BitCounter16}[n]
+    width = int(math.floor(math.log2(n))) + 1
+
+    class BitCounter(Circuit):
+        name = 'BitCounter{}'.format(n) + ('_{}'.format(stages) if stages else '')
+        IO = ['I', In(Bits(n)), 'O', Out(Bits(width))]
+        if stages:
+            IO += ['CLK', In(Clock)]
+        @classmethod
+        def definition(io):
+            # columns[i] are the bits of weight 2 ** i
+            columns = [[], [], []]
+            for i in range(0, n, 4):
+                if n - i == 1:
+                    columns[0].append(io.I[i])
+                    continue
+                counter = BitCounter4()
+                wire(io.I[i:i + 4], counter.I[:min(4, n - i)])
+                if n - i < 4:
+                    wire(bits(0, 4 - (n - i)), counter.I[n - i:])
+                for j in range(3 if n - i >= 4 else 2):
+                    columns[j].append(counter.O[j])
+            # level 0 are the 4-bit pop counts, then the carry-save levels follow
+            levels = carry_save_levels([len(column) for column in columns])
+            # registers after level (k + 1) * (levels + 1) // (stages + 1) for the k-th stage
+            stage_levels = [(k + 1) * (levels + 1) // (stages + 1) for k in range(stages)]
+            for level in range(levels + 1):
+                if level > 0:
+                    reduced = [[] for _ in range(len(columns) + 1)]
+                    for i, column in enumerate(columns):
+                        for j in range(0, len(column) - 2, 3):
+                            adder = mantle.FullAdder()
+                            wire(column[j], adder.I0)
+                            wire(column[j + 1], adder.I1)
+                            wire(column[j + 2], adder.CIN)
+                            reduced[i].append(adder.O)
+                            reduced[i + 1].append(adder.COUT)
+                        if len(column) % 3 == 2:
+                            adder = mantle.HalfAdder()
+                            wire(column[-2], adder.I0)
+                            wire(column[-1], adder.I1)
+                            reduced[i].append(adder.O)
+                            reduced[i + 1].append(adder.COUT)
+                        elif len(column) % 3 == 1:
+                            reduced[i].append(column[-1])
+                    columns = reduced
+                for _ in range(stage_levels.count(level)):
+                    flat = [bit for column in columns for bit in column]
+                    reg = mantle.Register(len(flat))
+                    wire(io.CLK, reg.CLK)
+                    wire(bits(flat), reg.I)
+                    outputs = iter(reg.O)
+                    columns = [[next(outputs) for _ in column] for column in columns]
+            # columns above the width always sum to 0, since the count is at most n
+            for i in range(width):
+                if i < len(columns) and columns[i]:
+                    wire(columns[i][0], io.O[i])
+                else:
+                    wire(0, io.O[i])
+
+    return BitCounter
+
+
+# argmax reduction tree over the lanes: O is the largest count of I and IDX
+# the lane it comes from, on a tie the lower lane wins
+class ArgMax(Circuit):
+    name = "ArgMax"
+    IO = ['I', In(Bits(n_bc_adder * num_lanes)), 'O', Out(Bits(n_bc_adder)),
+          'IDX', Out(Bits(b))]
     @classmethod
     def definition(io):
-        comparison = mantle.UGT(n_bc_adder)
-        reg_count = mantle.Register(n_bc_adder, has_ce=True)
-        reg_idx = mantle.Register(b, has_ce=True)
-        wire(io.I, comparison.I0)
-        wire(reg_count.O, comparison.I1)
-        wire(comparison.O, reg_count.CE)
-        wire(comparison.O, reg_idx.CE)
+        nodes = [(io.I[lane * n_bc_adder:(lane + 1) * n_bc_adder], bits(lane, b))
+                 for lane in range(num_lanes)]
+        while len(nodes) > 1:
+            level = []
+            for (count_0, idx_0), (count_1, idx_1) in zip(nodes[0::2], nodes[1::2]):
+                comparison = mantle.UGT(n_bc_adder)
+                mux_count = mantle.Mux(height=2, width=n_bc_adder)
+                mux_idx = mantle.Mux(height=2, width=b)
+                wire(count_1, comparison.I0)
+                wire(count_0, comparison.I1)
+                wire(count_0, mux_count.I0)
+                wire(count_1, mux_count.I1)
+                wire(comparison.O, mux_count.S)
+                wire(idx_0, mux_idx.I0)
+                wire(idx_1, mux_idx.I1)
+                wire(comparison.O, mux_idx.S)
+                level.append((mux_count.O, mux_idx.O))
+            if len(nodes) % 2:
+                level.append(nodes[-1])
+            nodes = level
+        wire(nodes[0][0], io.O)
+        wire(nodes[0][1], io.IDX)
+
+
+# EX - NXOr for multiplication, pop count and accumulate the result for activation
+# one NXOr, pop count and accumulator per lane and image, the image blocks are shared by the
+# lanes and the weight blocks by the images, so a weight read is used num_images times
+# the pop count is registered before it is accumulated, so the accumulator adder is a stage of its own
+# COUNT[(image * num_lanes + lane) * n_bc_adder:][:n_bc_adder] is the count of row COUNT_IDX + lane
+# for image up to block COUNT_CYCLE, VALID marks blocks to accumulate
+# IDX is only delayed with the count, n_idx makes room for more rows, e.g. the layer of a row in layers.py
+@lru_cache(maxsize=None)
+def DefineExecute(num_images=1, n_idx=b):
+    num_counts = num_images * num_lanes
+
+    class _Execute(Circuit):
+        name = "Execute" + ("x{}".format(num_images) if num_images > 1 else "") + \
+               ("_{}".format(n_idx) if n_idx != b else "")
+        IO = ['WEIGHT', In(Bits(N * num_lanes)), 'IMAGE', In(Bits(N * num_images)), 'IDX', In(Bits(n_idx)),
+              'CYCLE', In(Bits(n)), 'VALID', In(Bit), 'CLK', In(Clock),
+              'COUNT', Out(Bits(n_bc_adder * num_counts)), 'COUNT_IDX', Out(Bits(n_idx)),
+              'COUNT_CYCLE', Out(Bits(n)), 'COUNT_VALID', Out(Bit)]
+        @classmethod
+        def definition(io):
+            # the pop count takes bc_stages cycles, delay idx, cycle and control signal to match
+            tag = concat(io.IDX, io.CYCLE, bits([io.VALID]))
+            for _ in range(bc_stages):
+                reg_delay = mantle.Register(n_idx + n + 1)
+                wire(io.CLK, reg_delay.CLK)
+                wire(tag, reg_delay.I)
+                tag = reg_delay.O
+            reg_pop = mantle.Register(n_bc * num_counts)
+            reg_pop_tag = mantle.Register(n_idx + n + 1)
+            reg_count = mantle.Register(n_bc_adder * num_counts)
+            reg_tag = mantle.Register(n_idx + n + 1)
+            wire(io.CLK, reg_pop.CLK)
+            wire(io.CLK, reg_pop_tag.CLK)
+            wire(io.CLK, reg_count.CLK)
+            wire(io.CLK, reg_tag.CLK)
+            wire(tag, reg_pop_tag.I)
+            pop_tag = reg_pop_tag.O
+            if n == 4:
+                comparison = SB_LUT4(LUT_INIT=int('0'*15+'1', 2))
+                wire(pop_tag[n_idx:n_idx + n], bits([comparison.I0, comparison.I1, comparison.I2, comparison.I3]))
+            else:
+                comparison = mantle.EQ(n)
+                wire(pop_tag[n_idx:n_idx + n], comparison.I0)
+                wire(bits(0, n), comparison.I1)
+            for image in range(num_images):
+                for lane in range(num_lanes):
+                    i = image * num_lanes + lane
+                    pop = reg_pop.O[i * n_bc:(i + 1) * n_bc]
+                    count = reg_count.O[i * n_bc_adder:(i + 1) * n_bc_adder]
+                    multiplier = mantle.NXOr(height=2, width=N)
+                    bit_counter = DefineBitCounter(N, bc_stages)()
+                    if bc_stages:
+                        wire(io.CLK, bit_counter.CLK)
+                    adder = mantle.Add(n_bc_adder, cin=False, cout=False)
+                    mux_for_adder_0 = mantle.Mux(height=2, width=n_bc)
+                    mux_for_adder_1 = mantle.Mux(height=2, width=n_bc_adder)
+                    wire(io.WEIGHT[lane * N:(lane + 1) * N], multiplier.I0)
+                    wire(io.IMAGE[image * N:(image + 1) * N], multiplier.I1)
+                    wire(multiplier.O, bit_counter.I)
+                    # only when data read is ready (i.e. control signal is high), accumulate the pop count result
+                    wire(bits(0, n_bc), mux_for_adder_0.I0)
+                    wire(bit_counter.O, mux_for_adder_0.I1)
+                    wire(tag[n_idx + n], mux_for_adder_0.S)
+                    wire(mux_for_adder_0.O, reg_pop.I[i * n_bc:(i + 1) * n_bc])
+                    # the first block of a row restarts the accumulation
+                    wire(count, mux_for_adder_1.I0)
+                    wire(bits(0, n_bc_adder), mux_for_adder_1.I1)
+                    wire(comparison.O, mux_for_adder_1.S)
+                    wire(pop, adder.I0[:n_bc])
+                    if n_bc_adder > n_bc:
+                        wire(bits(0, n_bc_adder - n_bc), adder.I0[n_bc:])
+                    wire(mux_for_adder_1.O, adder.I1)
+                    wire(adder.O, reg_count.I[i * n_bc_adder:(i + 1) * n_bc_adder])
+            wire(pop_tag, reg_tag.I)
+            wire(reg_count.O, io.COUNT)
+            wire(reg_tag.O[:n_idx], io.COUNT_IDX)
+            wire(reg_tag.O[n_idx:n_idx + n], io.COUNT_CYCLE)
+            wire(reg_tag.O[n_idx + n], io.COUNT_VALID)
+
+    return _Execute
+
+
+Execute = DefineExecute()
+
+
+# pick the count to compare from the lanes: O is the count of row O_IDX
+# with a single lane this is the count of row IDX itself
+# O and O_IDX are registered to keep the ArgMax tree out of the compare of Classifier,
+# O_CYCLE and O_VALID are CYCLE and VALID delayed with them
+class Select(Circuit):
+    name = "Select"
+    IO = ['COUNT', In(Bits(n_bc_adder * num_lanes)), 'IDX', In(Bits(b)), 'CYCLE', In(Bits(n)),
+          'VALID', In(Bit), 'CLK', In(Clock), 'O', Out(Bits(n_bc_adder)), 'O_IDX', Out(Bits(b)),
+          'O_ROW', Out(Bits(b)), 'O_CYCLE', Out(Bits(n)), 'O_VALID', Out(Bit)]
+    @classmethod
+    def definition(io):
+        reg_count = mantle.Register(n_bc_adder)
+        reg_tag = mantle.Register(b + b + n + 1)
         wire(io.CLK, reg_count.CLK)
-        wire(io.CLK, reg_idx.CLK)
-        wire(io.I, reg_count.I)
-        wire(io.IDX, reg_idx.I)
-        wire(reg_idx.O, io.O)
+        wire(io.CLK, reg_tag.CLK)
+        wire(reg_count.O, io.O)
+        wire(reg_tag.O[:b], io.O_IDX)
+        wire(reg_tag.O[b:2 * b], io.O_ROW)
+        wire(reg_tag.O[2 * b:2 * b + n], io.O_CYCLE)
+        wire(reg_tag.O[2 * b + n], io.O_VALID)
+        wire(concat(io.IDX, io.CYCLE, bits([io.VALID])), reg_tag.I[b:])
+        if num_lanes == 1:
+            wire(io.COUNT, reg_count.I)
+            wire(io.IDX, reg_tag.I[:b])
+            return
+        # lanes past the last row in the last round hold no weights, clear their count
+        comparison_idx = mantle.EQ(b)
+        wire(io.IDX, comparison_idx.I0)
+        wire(bits(last_idx, b), comparison_idx.I1)
+        argmax = ArgMax()
+        for lane in range(num_lanes):
+            count = io.COUNT[lane * n_bc_adder:(lane + 1) * n_bc_adder]
+            if last_idx + lane < num_classes:
+                wire(count, argmax.I[lane * n_bc_adder:(lane + 1) * n_bc_adder])
+            else:
+                mux_for_lane = mantle.Mux(height=2, width=n_bc_adder)
+                wire(count, mux_for_lane.I0)
+                wire(bits(0, n_bc_adder), mux_for_lane.I1)
+                wire(comparison_idx.O, mux_for_lane.S)
+                wire(mux_for_lane.O, argmax.I[lane * n_bc_adder:(lane + 1) * n_bc_adder])
+        # only compare the complete counts of the last cycle, a partial count of a
+        # later lane must not win a tie against an earlier one
+        comparison_cycle = mantle.EQ(n)
+        mux_for_count = mantle.Mux(height=2, width=n_bc_adder)
+        wire(io.CYCLE, comparison_cycle.I0)
+        wire(bits(num_cycles - 1, n), comparison_cycle.I1)
+        wire(bits(0, n_bc_adder), mux_for_count.I0)
+        wire(argmax.O, mux_for_count.I1)
+        wire(comparison_cycle.O, mux_for_count.S)
+        wire(mux_for_count.O, reg_count.I)
+        adder_idx = mantle.Add(b, cin=False, cout=False)
+        wire(io.IDX, adder_idx.I0)
+        wire(argmax.IDX, adder_idx.I1)
+        wire(adder_idx.O, reg_tag.I[:b])
+
+
+# classifier unit: using compare operation to decide the final prediction label of image
+# with has_load, LOAD takes I and IDX whatever the previous maximum, to start a new image
+@lru_cache(maxsize=None)
+def DefineClassifier(has_load=False):
+    class _Classifier(Circuit):
+        name = "Classifier" + ("Load" if has_load else "")
+        IO = ['I', In(Bits(n_bc_adder)), 'IDX', In(Bits(b)), 'CLK', In(Clock), 'O', Out(Bits(b))]
+        if has_load:
+            IO += ['LOAD', In(Bit)]
+        @classmethod
+        def definition(io):
+            comparison = mantle.UGT(n_bc_adder)
+            reg_count = mantle.Register(n_bc_adder, has_ce=True)
+            reg_idx = mantle.Register(b, has_ce=True)
+            wire(io.I, comparison.I0)
+            wire(reg_count.O, comparison.I1)
+            if has_load:
+                or_gate = mantle.Or()
+                wire(comparison.O, or_gate.I0)
+                wire(io.LOAD, or_gate.I1)
+                update = or_gate.O
+            else:
+                update = comparison.O
+            wire(update, reg_count.CE)
+            wire(update, reg_idx.CE)
+            wire(io.CLK, reg_count.CLK)
+            wire(io.CLK, reg_idx.CLK)
+            wire(io.I, reg_count.I)
+            wire(io.IDX, reg_idx.I)
+            wire(reg_idx.O, io.O)
+    return _Classifier
+
+
+Classifier = DefineClassifier()
 
 
 class Pipeline(Circuit):
@@ -259,58 +753,41 @@ class Pipeline(Circuit):
         readROM = ReadROM()
         wire(reg_1_idx, readROM.IDX)
         wire(reg_1_cycle.O, readROM.CYCLE)
-        reg_2 = mantle.Register(N + b + n)
+        reg_2 = mantle.Register(b + n)
         reg_2_control = mantle.DFF()
         reg_2_weight = readROM.WEIGHT
+        reg_2_image = readROM.IMAGE
         wire(io.CLK, reg_2.CLK)
         wire(io.CLK, readROM.CLK)
         wire(io.CLK, reg_2_control.CLK)
-        wire(readROM.IMAGE, reg_2.I[:N])
-        wire(reg_1_idx, reg_2.I[N:N + b])
-        wire(reg_1_cycle.O, reg_2.I[N + b:])
+        wire(reg_1_idx, reg_2.I[:b])
+        wire(reg_1_cycle.O, reg_2.I[b:])
         wire(reg_1_control.O, reg_2_control.I)
         # EX - NXOr for multiplication, pop count and accumulate the result for activation
-        multiplier = mantle.NXOr(height=2, width=N)
-        bit_counter = DefineBitCounter(N)()
-        adder = mantle.Add(n_bc_adder, cin=False, cout=False)
-        mux_for_adder_0 = mantle.Mux(height=2, width=n_bc_adder)
-        mux_for_adder_1 = mantle.Mux(height=2, width=n_bc_adder)
-        reg_3_1 = mantle.Register(n_bc_adder)
-        reg_3_2 = mantle.Register(b + n)
-        wire(io.CLK, reg_3_1.CLK)
-        wire(io.CLK, reg_3_2.CLK)
-        wire(reg_2_weight, multiplier.I0)
-        wire(reg_2.O[:N], multiplier.I1)
-        wire(multiplier.O, bit_counter.I)
-        wire(bits(0, n_bc_adder), mux_for_adder_0.I0)
-        wire(bit_counter.O, mux_for_adder_0.I1[:n_bc])
-        if n_bc_adder > n_bc:
-            wire(bits(0, n_bc_adder - n_bc), mux_for_adder_0.I1[n_bc:])
-        # only when data read is ready (i.e. control signal is high), accumulate the pop count result
-        wire(reg_2_control.O, mux_for_adder_0.S)
-        wire(reg_3_1.O, mux_for_adder_1.I0)
-        wire(bits(0, n_bc_adder), mux_for_adder_1.I1)
-        if n == 4:
-            comparison_3 = SB_LUT4(LUT_INIT=int('0'*15+'1', 2))
-            wire(reg_2.O[N+b:], bits([comparison_3.I0, comparison_3.I1, comparison_3.I2, comparison_3.I3]))
-        else:
-            comparison_3 = mantle.EQ(n)
-            wire(reg_2.O[N+b:], comparison_3.I0)
-            wire(bits(0, n), comparison_3.I1)
-        wire(comparison_3.O, mux_for_adder_1.S)
-        wire(mux_for_adder_0.O, adder.I0)
-        wire(mux_for_adder_1.O, adder.I1)
-        wire(adder.O, reg_3_1.I)
-        wire(reg_2.O[N:], reg_3_2.I)
-        # CF - classify the image
+        execute = Execute()
+        wire(io.CLK, execute.CLK)
+        wire(reg_2_weight, execute.WEIGHT)
+        wire(reg_2_image, execute.IMAGE)
+        wire(reg_2.O[:b], execute.IDX)
+        wire(reg_2.O[b:], execute.CYCLE)
+        wire(reg_2_control.O, execute.VALID)
+        reg_3_1 = execute.COUNT
+        # CF - classify the image, Select registers the count to compare
+        select = Select()
         classifier = Classifier()
         reg_4 = mantle.Register(n + b)
         reg_4_idx = classifier.O
+        wire(io.CLK, select.CLK)
         wire(io.CLK, classifier.CLK)
         wire(io.CLK, reg_4.CLK)
-        wire(reg_3_1.O, classifier.I)
-        wire(reg_3_2.O[:b], classifier.IDX)
-        wire(reg_3_2.O, reg_4.I)
+        wire(reg_3_1, select.COUNT)
+        wire(execute.COUNT_IDX, select.IDX)
+        wire(execute.COUNT_CYCLE, select.CYCLE)
+        wire(execute.COUNT_VALID, select.VALID)
+        reg_3_2 = concat(select.O_ROW, select.O_CYCLE)
+        wire(select.O, classifier.I)
+        wire(select.O_IDX, classifier.IDX)
+        wire(reg_3_2, reg_4.I)
         # WB - wait to show the result until the end
         reg_5 = mantle.Register(b, has_ce=True)
         comparison_5_1 = mantle.EQ(b)
@@ -319,7 +796,7 @@ class Pipeline(Circuit):
         wire(io.CLK, reg_5.CLK)
         wire(reg_4_idx, reg_5.I)
         wire(reg_4.O[:b], comparison_5_1.I0)
-        wire(bits(num_classes - 1, b), comparison_5_1.I1)
+        wire(bits(last_idx, b), comparison_5_1.I1)
         wire(reg_4.O[b:], comparison_5_2.I0)
         wire(bits(num_cycles - 1, n), comparison_5_2.I1)
         wire(comparison_5_1.O, and_gate.I0)
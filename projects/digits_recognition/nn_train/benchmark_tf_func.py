@@ -0,0 +1,72 @@
+"""
+Compare the tensor op versions of binarize_weights and binary_activation in
+tf_func.py with the py_func ones: the forward pass and the gradients must
+be the same, and the time of a training step of the network of
+MNIST_XNORNet.ipynb is printed for both.
+
+usage: python benchmark_tf_func.py [--steps 200] [--batch 50] [--hidden 64]
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tf_func import *
+
+
+def build(binarize, activation, hidden, seed):
+    """The network of the notebook, returns the input, labels, output, loss and train op."""
+    tf.set_random_seed(seed)
+    x = tf.placeholder(tf.float32, shape=[None, 256])
+    y_ = tf.placeholder(tf.float32, shape=[None, 10])
+    h = tf.reshape(x, [-1, 1, 1, 256])
+    for i, (size_in, size_out) in enumerate(zip([256] + hidden, hidden + [10])):
+        if i:
+            h = activation(h)
+        h = conv2d(h, binarize(weight_variable([1, 1, size_in, size_out])))
+    y_conv = tf.reshape(h, [-1, 10])
+    loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=y_, logits=y_conv))
+    train_step = tf.train.AdamOptimizer(1e-4).minimize(loss)
+    return x, y_, y_conv, loss, train_step
+
+
+def run(binarize, activation, args, images, labels):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        x, y_, y_conv, loss, train_step = build(binarize, activation, args.hidden, args.seed)
+        grads = tf.gradients(loss, tf.trainable_variables())
+        sess.run(tf.global_variables_initializer())
+        feed = {x: images[:args.batch], y_: labels[:args.batch]}
+        outputs = sess.run([y_conv] + grads, feed_dict=feed)
+        # the first steps include the setup of the session
+        for _ in range(10):
+            sess.run(train_step, feed_dict=feed)
+        start = time.perf_counter()
+        for i in range(args.steps):
+            j = i * args.batch % (len(images) - args.batch)
+            sess.run(train_step, feed_dict={x: images[j:j + args.batch], y_: labels[j:j + args.batch]})
+        return outputs, (time.perf_counter() - start) / args.steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--hidden', type=int, nargs='*', default=[64],
+                        help='sizes of the hidden layers, none for the network of BNN.pkl')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    images = np.sign(rng.randn(10 * args.batch, 256)).astype(np.float32)
+    labels = np.eye(10, dtype=np.float32)[rng.randint(10, size=len(images))]
+    py_outputs, py_time = run(binarize_weights_py, binary_activation_py, args, images, labels)
+    outputs, native_time = run(binarize_weights, binary_activation, args, images, labels)
+    for name, py_output, output in zip(['output'] + ['gradient'] * (len(outputs) - 1), py_outputs, outputs):
+        print('{}: max difference {:.3g}'.format(name, np.max(np.abs(py_output - output))))
+    print('py_func: {:.2f} ms per step'.format(py_time * 1e3))
+    print('tensor ops: {:.2f} ms per step, {:.2f}x'.format(native_time * 1e3, py_time / native_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,12 @@ from __future__ import division
 from __future__ import print_function
 
 import gzip
+import hashlib
+import os
+import threading
 import cv2
 import numpy
+from six.moves import queue
 from six.moves import xrange    # pylint: disable=redefined-builtin
 
 from tensorflow.contrib.learn.python.learn.datasets import base
@@ -39,10 +43,11 @@ def _read32(bytestream):
     return numpy.frombuffer(bytestream.read(4), dtype=dt)[0]
 
 
-def extract_images(f):
+def extract_images(f, size=16):
     """Extract the images into a 4D uint8 numpy array [index, y, x, depth].
     Args:
         f: A file object that can be passed into a gzip reader.
+        size: The images are resized to size x size, 28 keeps them as they are.
     Returns:
         data: A 4D uint8 numpy array [index, y, x, depth].
     Raises:
@@ -60,13 +65,42 @@ def extract_images(f):
         buf = bytestream.read(rows * cols * num_images)
         data = numpy.frombuffer(buf, dtype=numpy.uint8)
         data = data.reshape(num_images, rows, cols, 1)
-        resized_data = numpy.zeros([num_images, 16, 16, 1])
-        for i in range(num_images):
-            resized_img = cv2.resize(data[i, ..., 0], (16, 16))
-            resized_data[i, ..., 0] = resized_img
+        if (rows, cols) == (size, size):
+            return data
+        # cv2.resize takes up to 512 channels, so the images are resized 512 at a time as
+        # the channels of one image
+        resized_data = numpy.empty([num_images, size, size, 1], dtype=numpy.uint8)
+        for i in range(0, num_images, 512):
+            channels = data[i:i + 512, ..., 0].transpose(1, 2, 0)
+            resized = cv2.resize(channels, (size, size)).reshape(size, size, -1)
+            resized_data[i:i + 512, ..., 0] = resized.transpose(2, 0, 1)
         return resized_data
 
 
+def binarize_images(images):
+    """Binarize [0, 255] images into an int8 array of -1 and 1, like DataSet."""
+    return numpy.where(images > 127, 1, -1).astype(numpy.int8)
+
+
+def load_binarized_images(local_file, size=16, cache_dir=None):
+    """The binarized int8 images of an MNIST image file, cached next to it.
+
+    The cache is keyed by the hash of the file and the size, so a later run
+    maps the .npy file instead of decompressing and resizing the images.
+    """
+    with gfile.Open(local_file, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    name = os.path.basename(local_file).split('.')[0]
+    path = os.path.join(cache_dir or os.path.dirname(local_file),
+                        '{}-{}-{}.npy'.format(name, digest, size))
+    if not os.path.exists(path):
+        with gfile.Open(local_file, 'rb') as f:
+            images = binarize_images(extract_images(f, size))
+        numpy.save(path + '.tmp.npy', images)
+        os.replace(path + '.tmp.npy', path)
+    return numpy.load(path, mmap_mode='r')
+
+
 def dense_to_one_hot(labels_dense, num_classes):
     """Convert class labels from scalars to one-hot vectors."""
     num_labels = labels_dense.shape[0]
@@ -115,6 +149,9 @@ class DataSet(object):
         one_hot arg is used only if fake_data is true.    `dtype` can be either
         `uint8` to leave the input as `[0, 255]`, or `float32` to rescale into
         `[0, 1]`.    Seed arg provides for convenient deterministic testing.
+        int8 images are already binarized (see `load_binarized_images`) and
+        are kept as they are, an eighth of the memory of float64; batches
+        are float32.
         """
         seed1, seed2 = random_seed.get_seed(seed)
         # If op level seed is not set, use whatever graph level seed is returned
@@ -135,7 +172,7 @@ class DataSet(object):
             if reshape:
                 assert images.shape[3] == 1 
                 images = images.reshape(images.shape[0], images.shape[1] * images.shape[2])
-            if dtype == dtypes.float32:
+            if dtype == dtypes.float32 and images.dtype != numpy.int8:
                 # Convert from [0, 255] -> [0.0, 1.0].
                 images = images.astype(numpy.float32)
                 images[images < 128] = -1
@@ -144,6 +181,9 @@ class DataSet(object):
         self._labels = labels
         self._epochs_completed = 0
         self._index_in_epoch = 0
+        # the examples of an epoch are _images[_perm], shuffling only permutes the indices
+        self._perm = numpy.arange(self._num_examples)
+        self._prefetch = None
 
     @property
     def images(self):
@@ -172,38 +212,91 @@ class DataSet(object):
             return [fake_image for _ in xrange(batch_size)], [
                     fake_label for _ in xrange(batch_size)
             ]
+        if self._prefetch is not None and self._prefetch[0] == (batch_size, shuffle):
+            batch = self._prefetch[1].get()
+            if isinstance(batch, Exception):
+                # the thread has ended, the next batches are taken here again
+                self.stop_prefetch()
+                raise batch
+            return batch
+        # other batches than those of the prefetch thread, it is stopped so
+        # that it does not take examples at the same time
+        self.stop_prefetch()
+        return self._next_batch(batch_size, shuffle)
+
+    def _next_batch(self, batch_size, shuffle):
         start = self._index_in_epoch
         # Shuffle for the first epoch
         if self._epochs_completed == 0 and start == 0 and shuffle:
-            perm0 = numpy.arange(self._num_examples)
-            numpy.random.shuffle(perm0)
-            self._images = self.images[perm0]
-            self._labels = self.labels[perm0]
+            numpy.random.shuffle(self._perm)
         # Go to the next epoch
         if start + batch_size > self._num_examples:
             # Finished epoch
             self._epochs_completed += 1
             # Get the rest examples in this epoch
             rest_num_examples = self._num_examples - start
-            images_rest_part = self._images[start:self._num_examples]
-            labels_rest_part = self._labels[start:self._num_examples]
+            index_rest_part = self._perm[start:self._num_examples]
             # Shuffle the data
             if shuffle:
                 perm = numpy.arange(self._num_examples)
                 numpy.random.shuffle(perm)
-                self._images = self.images[perm]
-                self._labels = self.labels[perm]
+                self._perm = self._perm[perm]
             # Start next epoch
             start = 0
             self._index_in_epoch = batch_size - rest_num_examples
             end = self._index_in_epoch
-            images_new_part = self._images[start:end]
-            labels_new_part = self._labels[start:end]
-            return numpy.concatenate((images_rest_part, images_new_part), axis=0) , numpy.concatenate((labels_rest_part, labels_new_part), axis=0)
+            index = numpy.concatenate((index_rest_part, self._perm[start:end]), axis=0)
         else:
             self._index_in_epoch += batch_size
             end = self._index_in_epoch
-            return self._images[start:end], self._labels[start:end]
+            index = self._perm[start:end]
+        # only the examples of the batch are gathered
+        return self._batch(numpy.take(self._images, index, axis=0)), numpy.take(self._labels, index, axis=0)
+
+    def start_prefetch(self, batch_size, shuffle=True, depth=2):
+        """Gather up to `depth` batches in a background thread.
+
+        `next_batch` with the same `batch_size` and `shuffle` then takes the
+        batches gathered while the training step before it ran, and
+        `epochs_completed` counts the epochs of the batches gathered so far.
+        `next_batch` with others stops the thread first.
+        """
+        self.stop_prefetch()
+        batches = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def gather():
+            while not stop.is_set():
+                try:
+                    batch = self._next_batch(batch_size, shuffle)
+                except Exception as error:
+                    batch = error
+                while not stop.is_set():
+                    try:
+                        batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if isinstance(batch, Exception):
+                    return
+
+        thread = threading.Thread(target=gather)
+        thread.daemon = True
+        thread.start()
+        self._prefetch = ((batch_size, shuffle), batches, stop, thread)
+
+    def stop_prefetch(self):
+        """Stop the thread of `start_prefetch`, the batches it gathered are dropped."""
+        if self._prefetch is not None:
+            self._prefetch[2].set()
+            self._prefetch[3].join()
+            self._prefetch = None
+
+    def _batch(self, images):
+        # binarized int8 images are fed as float32
+        if images.dtype == numpy.int8:
+            return images.astype(numpy.float32)
+        return images
 
 
 def read_data_sets(train_dir,
@@ -212,7 +305,8 @@ def read_data_sets(train_dir,
              dtype=dtypes.float32,
              reshape=True,
              validation_size=1000,
-             seed=None):
+             seed=None,
+             size=16):
     if fake_data:
 
         def fake():
@@ -229,10 +323,16 @@ def read_data_sets(train_dir,
     TEST_IMAGES = 't10k-images-idx3-ubyte.gz'
     TEST_LABELS = 't10k-labels-idx1-ubyte.gz'
 
+    # the binarized images of DataSet are cached as int8
+    binarized = dtypes.as_dtype(dtype).base_dtype == dtypes.float32
+
     local_file = base.maybe_download(TRAIN_IMAGES, train_dir, SOURCE_URL + TRAIN_IMAGES)
                                                                      
-    with gfile.Open(local_file, 'rb') as f:
-        train_images = extract_images(f)
+    if binarized:
+        train_images = load_binarized_images(local_file, size)
+    else:
+        with gfile.Open(local_file, 'rb') as f:
+            train_images = extract_images(f, size)
 
     local_file = base.maybe_download(TRAIN_LABELS, train_dir, SOURCE_URL + TRAIN_LABELS)
                                                                      
@@ -241,8 +341,11 @@ def read_data_sets(train_dir,
 
     local_file = base.maybe_download(TEST_IMAGES, train_dir, SOURCE_URL + TEST_IMAGES)
                                                                      
-    with gfile.Open(local_file, 'rb') as f:
-        test_images = extract_images(f)
+    if binarized:
+        test_images = load_binarized_images(local_file, size)
+    else:
+        with gfile.Open(local_file, 'rb') as f:
+            test_images = extract_images(f, size)
 
     local_file = base.maybe_download(TEST_LABELS, train_dir, SOURCE_URL + TEST_LABELS)
                                                                      
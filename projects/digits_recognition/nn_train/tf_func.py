@@ -36,7 +36,7 @@ def py_func(func, inp, Tout, stateful=True, name=None, grad=None):
     with g.gradient_override_map({"PyFunc": rnd_name}):
         return tf.py_func(func, inp, Tout, stateful=stateful, name=name)
 
-def binarize_weights(x, name=None):
+def binarize_weights_py(x, name=None):
     """Creates the binarize_weights Op with f as forward pass
     and df as the gradient for the backward pass
     Args:
@@ -64,7 +64,7 @@ def binarize_weights(x, name=None):
         fx = py_func(f, [x], [tf.float32], name=name, grad=df)
         return fx[0]
 
-def binary_activation(x, name=None):
+def binary_activation_py(x, name=None):
     """Creates the binary_activation Op with f as forward pass
     and fd as the gradient for the backward pass
     Args:
@@ -87,6 +87,46 @@ def binary_activation(x, name=None):
         fx = py_func(f, [x], [tf.float32], name=name, grad=df)
         return fx[0]
 
+def straight_through(y, x, dy_dx):
+    """y in the forward pass with the gradient dy_dx * grad in the backward pass.
+
+    x * dy_dx - stop_gradient(x * dy_dx) is 0, but its gradient is dy_dx, so
+    the op stays in the graph without a py_func round trip.
+    """
+    dy_dx = tf.stop_gradient(dy_dx)
+    return tf.stop_gradient(y) + (x * dy_dx - tf.stop_gradient(x * dy_dx))
+
+def sign(x):
+    """np.sign with 1 for 0."""
+    return 2 * tf.cast(tf.greater_equal(x, 0), x.dtype) - 1
+
+def binarize_weights(x, name=None):
+    """binarize_weights_py as tensor ops, with the same forward pass and gradient
+    Args:
+        x: The input Tensor of shape [height, width, in_channels, out_channels]
+        name: the name for the Op
+
+    Returns:
+        The output tensor
+    """
+    with ops.name_scope(name, 'BinarizeWeights', [x]) as name:
+        n = tf.cast(tf.reduce_prod(tf.shape(x)[:3]), x.dtype)
+        alpha = tf.reduce_sum(tf.abs(x), [0, 1, 2]) / n
+        ds = x * tf.cast(tf.less_equal(tf.abs(x), 1), x.dtype)
+        return tf.identity(straight_through(sign(x) * alpha, x, 1 / n + alpha * ds), name=name)
+
+def binary_activation(x, name=None):
+    """binary_activation_py as tensor ops, with the same forward pass and gradient
+    Args:
+        x: The input Tensor
+        name: the name for the Op
+    Returns:
+        The output tensor
+    """
+    with ops.name_scope(name, 'BinarizeInputs', [x]) as name:
+        alpha = tf.cast(tf.less_equal(tf.abs(x), 1), x.dtype)
+        return tf.identity(straight_through(sign(x), x, alpha), name=name)
+
 def weight_variable(shape):
     initial = tf.truncated_normal(shape, stddev=0.1)
     return tf.Variable(initial)
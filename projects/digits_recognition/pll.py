@@ -0,0 +1,114 @@
+"""
+Clock a design from the SB_PLL40_CORE of the icestick instead of the 12 MHz
+oscillator.
+
+In the simple feedback mode of the PLL the output clock is
+
+    freq_in / (DIVR + 1) * (DIVF + 1) / 2 ** DIVQ
+
+with the phase detector input freq_in / (DIVR + 1) in [10, 133] MHz and the
+VCO in [533, 1066] MHz, so it ranges from 16 to 275 MHz.  The setting
+closest to freq_out is used, it has to be within tolerance of it.
+
+usage: python pll.py freq_out_mhz [--freq-in 12] [--tolerance 0.01]
+"""
+import argparse
+from functools import lru_cache
+
+from magma import *
+from mantle.lattice.ice40 import SB_PLL40_CORE
+
+
+def filter_range(pfd):
+    """FILTER_RANGE of the loop filter for the phase detector frequency in MHz."""
+    for i, limit in enumerate((17, 26, 44, 66, 101)):
+        if pfd < limit:
+            return i + 1
+    return 6
+
+
+# range of PLLOUT in MHz
+pllout_range = (16, 275)
+
+
+def pll_params(freq_out, freq_in=12e6, tolerance=0.01):
+    """DIVR, DIVF, DIVQ, FILTER_RANGE and the output frequency closest to freq_out.
+
+    Raises ValueError when freq_out is out of the range of PLLOUT or the
+    closest output frequency is off by more than tolerance of freq_out.
+    """
+    freq_in, freq_out = freq_in / 1e6, freq_out / 1e6
+    if not pllout_range[0] <= freq_out <= pllout_range[1]:
+        raise ValueError('{} MHz is out of the PLLOUT range of {} to {} MHz'.format(
+            freq_out, *pllout_range))
+    best = None
+    for divr in range(16):
+        pfd = freq_in / (divr + 1)
+        if pfd < 10 or pfd > 133:
+            continue
+        for divf in range(128):
+            vco = pfd * (divf + 1)
+            if vco < 533 or vco > 1066:
+                continue
+            # DIVQ is 1 to 6 in the simple feedback mode
+            for divq in range(1, 7):
+                out = vco / (1 << divq)
+                if out < pllout_range[0] or out > pllout_range[1]:
+                    continue
+                if best is None or abs(out - freq_out) < abs(best[-1] - freq_out):
+                    best = (divr, divf, divq, filter_range(pfd), out)
+    if best is None:
+        raise ValueError('no PLL setting for a {} MHz input'.format(freq_in))
+    if abs(best[-1] - freq_out) > tolerance * freq_out:
+        raise ValueError('the closest PLL output to {} MHz is {:.4f} MHz, more than {:g}% off'.format(
+            freq_out, best[-1], tolerance * 100))
+    return best[:4] + (best[4] * 1e6,)
+
+
+# PLL generating a global clock CLK of about freq_out from CLKIN
+@lru_cache(maxsize=None)
+def DefinePLL(freq_out, freq_in=12e6, tolerance=0.01):
+    divr, divf, divq, filter_, actual = pll_params(freq_out, freq_in, tolerance)
+
+    class PLL(Circuit):
+        name = 'PLL{}'.format(int(round(actual)))
+        IO = ['CLKIN', In(Clock), 'CLK', Out(Clock)]
+        frequency = actual
+        @classmethod
+        def definition(io):
+            pll = SB_PLL40_CORE(FEEDBACK_PATH="SIMPLE", PLLOUT_SELECT="GENCLK",
+                                DIVR=(divr, 4), DIVF=(divf, 7), DIVQ=(divq, 3),
+                                FILTER_RANGE=(filter_, 3))
+            wire(io.CLKIN, pll.REFERENCECLK)
+            wire(1, pll.RESETB)
+            wire(0, pll.BYPASS)
+            wire(pll.PLLOUTGLOBAL, io.CLK)
+
+    return PLL
+
+
+# the clock of about freq_out generated from the CLKIN of icestick.main()
+def pll_clock(main, freq_out, freq_in=12e6, tolerance=0.01):
+    pll = DefinePLL(freq_out, freq_in, tolerance)()
+    wire(main.CLKIN, pll.CLKIN)
+    return pll.CLK
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('freq_out', type=float, help='output clock in MHz')
+    parser.add_argument('--freq-in', type=float, default=12, help='input clock in MHz')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='largest relative error of the output clock')
+    args = parser.parse_args()
+    try:
+        divr, divf, divq, filter_, actual = pll_params(args.freq_out * 1e6, args.freq_in * 1e6,
+                                                       args.tolerance)
+    except ValueError as error:
+        parser.error(str(error))
+    print('DIVR={} DIVF={} DIVQ={} FILTER_RANGE={}: {:.4f} MHz'.format(
+        divr, divf, divq, filter_, actual / 1e6))
+
+
+if __name__ == '__main__':
+    main()
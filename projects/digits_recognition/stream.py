@@ -0,0 +1,702 @@
+"""
+Classify images streamed over the UART instead of the image baked into the
+LUTs of ReadROM.
+
+The host sends packets of a header byte and N * num_cycles / 8 bytes, the
+bits packed most significant bit first (numpy.packbits).  A header with bit 7
+clear is followed by a binarized image.  The images are classified in
+batches of num_images, scored in parallel against every weight block, and
+the predicted labels of a batch come back as one byte each.  A header with
+bit 7 set is followed by a row of the weight matrix:
+bits [0, b) of the header are the idx of the row's round and bits [b, 7) its
+lane, so new weights can be written into the weight RAMs without a synthesis.
+A header 0x40 has no data and reads the performance counters, 0x41 also
+clears them after they are sent.
+"""
+from magma import *
+import mantle
+import math
+import os
+from functools import lru_cache
+from mantle.lattice.ice40 import RAMB
+from modules import *
+
+
+# the UART receiver and transmitter of examples/uart, 115200 baud at 12 MHz
+uart_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'examples', 'uart')
+RXMOD = DefineFromVerilogFile(os.path.join(uart_dir, 'rxmod.v'))[0]
+TXMOD = DefineFromVerilogFile(os.path.join(uart_dir, 'txmod.v'))[0]
+
+# number of bytes of an image
+num_bytes = N * num_cycles // 8
+# number of bits for num_bytes
+n_bytes = int(math.ceil(math.log2(num_bytes)))
+# number of 16 bit wide RAMs of the image buffer
+num_rams = N // 16
+# number of bits for num_rams
+n_rams = int(math.ceil(math.log2(num_rams)))
+# number of bits for num_lanes
+n_lanes = int(math.ceil(math.log2(num_lanes)))
+# the header of a packet has a bit for weights, the idx and the lane of a row
+assert b + n_lanes <= 7
+# the weight RAMs of the lanes and the image RAMs of a batch fit into the 16 BRAMs of the hx1k
+assert num_rams * (num_lanes * num_roms + num_images) <= 16
+# the two halves of the image buffer fit into a RAM
+assert n <= 7
+# performance counters of the pipeline, readable over the UART
+perf_counters = True
+# width of a performance counter, 2 ** 32 cycles are almost 6 minutes at 12 MHz
+n_perf = 32
+# the counters in the order they are sent, most significant byte first
+perf_names = ['CYCLES', 'IMAGES', 'LATENCY', 'STALLS']
+# the bytes of the counters are selected by a Mux of 16
+assert len(perf_names) * n_perf // 8 == 16
+
+
+# generate idx and cycle for one image after START, like Controller
+# VALID is high while IDX and CYCLE belong to an image; a START that arrives while an
+# image is scored is kept pending and the next image follows its last cycle directly,
+# otherwise the sequencer stops until the next START
+# BANK is the half of the image buffer the image was loaded into, the first image is in 0
+class Sequencer(Circuit):
+    name = "Sequencer"
+    IO = ['START', In(Bit), 'CLK', In(Clock), 'IDX', Out(Bits(b)),
+          'CYCLE', Out(Bits(n)), 'BANK', Out(Bit), 'VALID', Out(Bit), 'PENDING', Out(Bit)]
+    @classmethod
+    def definition(io):
+        adder_cycle = mantle.Add(n, cin=False, cout=False)
+        reg_cycle = mantle.Register(n, has_ce=True, has_reset=True)
+        adder_idx = mantle.Add(b, cin=False, cout=False)
+        reg_idx = mantle.Register(b, has_ce=True, has_reset=True)
+        reg_bank = mantle.Register(1, init=1, has_ce=True)
+        reg_run = mantle.DFF()
+        reg_pending = mantle.DFF()
+        wire(io.CLK, reg_cycle.CLK)
+        wire(io.CLK, reg_idx.CLK)
+        wire(io.CLK, reg_bank.CLK)
+        wire(io.CLK, reg_run.CLK)
+        wire(io.CLK, reg_pending.CLK)
+        comparison_cycle = mantle.EQ(n)
+        wire(reg_cycle.O, comparison_cycle.I0)
+        wire(bits(num_cycles - 1, n), comparison_cycle.I1)
+        comparison_idx = mantle.EQ(b)
+        wire(reg_idx.O, comparison_idx.I0)
+        wire(bits(last_idx, b), comparison_idx.I1)
+        # the last cycle of a row while running switches to the next idx
+        and_row = mantle.And()
+        wire(reg_run.O, and_row.I0)
+        wire(comparison_cycle.O, and_row.I1)
+        # the last cycle of the last idx finishes the image
+        nand_done = mantle.NAnd()
+        wire(and_row.O, nand_done.I0)
+        wire(comparison_idx.O, nand_done.I1)
+        and_run = mantle.And()
+        wire(reg_run.O, and_run.I0)
+        wire(nand_done.O, and_run.I1)
+        # an image is requested by START or the pending one, it goes when the sequencer
+        # is idle or in the last cycle of the image before
+        or_request = mantle.Or()
+        wire(io.START, or_request.I0)
+        wire(reg_pending.O, or_request.I1)
+        nand_busy = mantle.NAnd()
+        wire(reg_run.O, nand_busy.I0)
+        wire(nand_done.O, nand_busy.I1)
+        and_go = mantle.And()
+        wire(or_request.O, and_go.I0)
+        wire(nand_busy.O, and_go.I1)
+        go = and_go.O
+        # a request that cannot go waits
+        nand_go = mantle.NAnd()
+        wire(go, nand_go.I0)
+        wire(go, nand_go.I1)
+        and_pending = mantle.And()
+        wire(or_request.O, and_pending.I0)
+        wire(nand_go.O, and_pending.I1)
+        wire(and_pending.O, reg_pending.I)
+        or_run = mantle.Or()
+        wire(go, or_run.I0)
+        wire(and_run.O, or_run.I1)
+        wire(or_run.O, reg_run.I)
+        # every image reads the other half of the buffer
+        nand_bank = mantle.NAnd()
+        wire(reg_bank.O[0], nand_bank.I0)
+        wire(reg_bank.O[0], nand_bank.I1)
+        wire(nand_bank.O, reg_bank.I[0])
+        wire(go, reg_bank.CE)
+        # a new image clears cycle and idx
+        or_cycle_ce = mantle.Or()
+        wire(go, or_cycle_ce.I0)
+        wire(reg_run.O, or_cycle_ce.I1)
+        or_cycle_reset = mantle.Or()
+        wire(go, or_cycle_reset.I0)
+        wire(comparison_cycle.O, or_cycle_reset.I1)
+        wire(reg_cycle.O, adder_cycle.I0)
+        wire(bits(1, n), adder_cycle.I1)
+        wire(adder_cycle.O, reg_cycle.I)
+        wire(or_cycle_ce.O, reg_cycle.CE)
+        wire(or_cycle_reset.O, reg_cycle.RESET)
+        or_idx_ce = mantle.Or()
+        wire(go, or_idx_ce.I0)
+        wire(and_row.O, or_idx_ce.I1)
+        wire(reg_idx.O, adder_idx.I0)
+        wire(bits(num_lanes % 2 ** b, b), adder_idx.I1)
+        wire(adder_idx.O, reg_idx.I)
+        wire(or_idx_ce.O, reg_idx.CE)
+        wire(go, reg_idx.RESET)
+        wire(reg_idx.O, io.IDX)
+        wire(reg_cycle.O, io.CYCLE)
+        wire(reg_bank.O[0], io.BANK)
+        wire(reg_run.O, io.VALID)
+        wire(reg_pending.O, io.PENDING)
+
+
+# split the bytes of the UART receiver into packets of a header and num_bytes bytes
+# two bytes make a 16 bit word WDATA, the first one is the high byte, and WADDR is the
+# word in the packet; IMAGE_WE or WEIGHT_WE are high with the second byte of a word
+# SLOT counts the images of a batch, START is high with the last byte of a batch
+class Receiver(Circuit):
+    name = "Receiver"
+    IO = ['DATA', In(Bits(8)), 'VALID', In(Bit), 'CLK', In(Clock),
+          'HEADER', Out(Bits(8)), 'WADDR', Out(Bits(n_bytes - 1)), 'WDATA', Out(Bits(16)),
+          'IMAGE_WE', Out(Bit), 'WEIGHT_WE', Out(Bit), 'START', Out(Bit)]
+    if num_images > 1:
+        IO += ['SLOT', Out(Bits(n_images))]
+    if perf_counters:
+        IO += ['REQUEST', Out(Bit)]
+    @classmethod
+    def definition(io):
+        adder_byte = mantle.Add(n_bytes, cin=False, cout=False)
+        reg_byte = mantle.Register(n_bytes, has_ce=True, has_reset=True)
+        reg_high = mantle.Register(8, has_ce=True)
+        reg_header = mantle.Register(8, has_ce=True)
+        reg_busy = mantle.DFF()
+        wire(io.CLK, reg_byte.CLK)
+        wire(io.CLK, reg_high.CLK)
+        wire(io.CLK, reg_header.CLK)
+        wire(io.CLK, reg_busy.CLK)
+        # a byte while not busy is a header, the next num_bytes bytes are the data
+        nand_header = mantle.NAnd()
+        wire(reg_busy.O, nand_header.I0)
+        wire(reg_busy.O, nand_header.I1)
+        and_header = mantle.And()
+        wire(io.VALID, and_header.I0)
+        wire(nand_header.O, and_header.I1)
+        and_data = mantle.And()
+        wire(io.VALID, and_data.I0)
+        wire(reg_busy.O, and_data.I1)
+        wire(io.DATA, reg_header.I)
+        wire(and_header.O, reg_header.CE)
+        comparison_last = mantle.EQ(n_bytes)
+        wire(reg_byte.O, comparison_last.I0)
+        wire(bits(num_bytes - 1, n_bytes), comparison_last.I1)
+        wire(reg_byte.O, adder_byte.I0)
+        wire(bits(1, n_bytes), adder_byte.I1)
+        wire(adder_byte.O, reg_byte.I)
+        wire(and_data.O, reg_byte.CE)
+        wire(comparison_last.O, reg_byte.RESET)
+        and_last = mantle.And()
+        wire(and_data.O, and_last.I0)
+        wire(comparison_last.O, and_last.I1)
+        nand_last = mantle.NAnd()
+        wire(and_last.O, nand_last.I0)
+        wire(and_last.O, nand_last.I1)
+        and_busy = mantle.And()
+        wire(reg_busy.O, and_busy.I0)
+        wire(nand_last.O, and_busy.I1)
+        header = and_header.O
+        if perf_counters:
+            # a header 0x40 or 0x41 is a command without data, REQUEST is high for a cycle
+            # after it, with HEADER[0] the bit to clear the counters
+            nand_weight = mantle.NAnd()
+            wire(io.DATA[7], nand_weight.I0)
+            wire(io.DATA[7], nand_weight.I1)
+            and_command_1 = mantle.And()
+            and_command_2 = mantle.And()
+            wire(and_header.O, and_command_1.I0)
+            wire(io.DATA[6], and_command_1.I1)
+            wire(and_command_1.O, and_command_2.I0)
+            wire(nand_weight.O, and_command_2.I1)
+            reg_request = mantle.DFF()
+            wire(io.CLK, reg_request.CLK)
+            wire(and_command_2.O, reg_request.I)
+            wire(reg_request.O, io.REQUEST)
+            nand_command = mantle.NAnd()
+            wire(and_command_2.O, nand_command.I0)
+            wire(and_command_2.O, nand_command.I1)
+            and_packet = mantle.And()
+            wire(and_header.O, and_packet.I0)
+            wire(nand_command.O, and_packet.I1)
+            header = and_packet.O
+        or_busy = mantle.Or()
+        wire(header, or_busy.I0)
+        wire(and_busy.O, or_busy.I1)
+        wire(or_busy.O, reg_busy.I)
+        # every byte is kept, so on an odd byte reg_high holds the high byte of the word
+        wire(io.DATA, reg_high.I)
+        wire(and_data.O, reg_high.CE)
+        and_word = mantle.And()
+        wire(and_data.O, and_word.I0)
+        wire(reg_byte.O[0], and_word.I1)
+        nand_image = mantle.NAnd()
+        wire(reg_header.O[7], nand_image.I0)
+        wire(reg_header.O[7], nand_image.I1)
+        and_image = mantle.And()
+        wire(and_word.O, and_image.I0)
+        wire(nand_image.O, and_image.I1)
+        and_weight = mantle.And()
+        wire(and_word.O, and_weight.I0)
+        wire(reg_header.O[7], and_weight.I1)
+        and_start = mantle.And()
+        wire(and_last.O, and_start.I0)
+        wire(nand_image.O, and_start.I1)
+        if num_images > 1:
+            # the last image of a batch starts the classification
+            adder_slot = mantle.Add(n_images, cin=False, cout=False)
+            reg_slot = mantle.Register(n_images, has_ce=True, has_reset=True)
+            comparison_slot = mantle.EQ(n_images)
+            wire(io.CLK, reg_slot.CLK)
+            wire(reg_slot.O, adder_slot.I0)
+            wire(bits(1, n_images), adder_slot.I1)
+            wire(adder_slot.O, reg_slot.I)
+            wire(reg_slot.O, comparison_slot.I0)
+            wire(bits(num_images - 1, n_images), comparison_slot.I1)
+            wire(and_start.O, reg_slot.CE)
+            wire(comparison_slot.O, reg_slot.RESET)
+            wire(reg_slot.O, io.SLOT)
+            and_batch = mantle.And()
+            wire(and_start.O, and_batch.I0)
+            wire(comparison_slot.O, and_batch.I1)
+            and_start = and_batch
+        wire(reg_header.O, io.HEADER)
+        wire(reg_byte.O[1:], io.WADDR)
+        wire(concat(io.DATA, reg_high.O), io.WDATA)
+        wire(and_image.O, io.IMAGE_WE)
+        wire(and_weight.O, io.WEIGHT_WE)
+        wire(and_start.O, io.START)
+
+
+# image buffer written by the words of Receiver, an N bit block is N / 16 words,
+# the first one is the most significant and goes to the last RAM
+# every image of a batch has its own RAMs, so the blocks of all of them are read at once
+# the buffer has two halves, a batch is written into one half while the batch in the
+# other half is read, and the last byte of a batch switches the half that is written
+# IMAGE[image * N:(image + 1) * N] is the CYCLE-th block of an image of half BANK,
+# one cycle after CYCLE like the weight ROM
+class ImageBuffer(Circuit):
+    name = "ImageBuffer"
+    IO = ['WADDR', In(Bits(n_bytes - 1)), 'WDATA', In(Bits(16)), 'WE', In(Bit), 'START', In(Bit),
+          'CYCLE', In(Bits(n)), 'BANK', In(Bit), 'CLK', In(Clock), 'IMAGE', Out(Bits(N * num_images))]
+    if num_images > 1:
+        IO += ['SLOT', In(Bits(n_images))]
+    @classmethod
+    def definition(io):
+        reg_bank = mantle.Register(1, has_ce=True)
+        wire(io.CLK, reg_bank.CLK)
+        for image in range(num_images):
+            if num_images == 1:
+                write_image = io.WE
+            else:
+                comparison_image = mantle.EQ(n_images)
+                and_image = mantle.And()
+                wire(io.SLOT, comparison_image.I0)
+                wire(bits(image, n_images), comparison_image.I1)
+                wire(io.WE, and_image.I0)
+                wire(comparison_image.O, and_image.I1)
+                write_image = and_image.O
+            for ram in range(num_rams):
+                image_ram = RAMB(256, 16)
+                if num_rams == 1:
+                    write = write_image
+                else:
+                    comparison_ram = mantle.EQ(n_rams)
+                    and_ram = mantle.And()
+                    wire(io.WADDR[:n_rams], comparison_ram.I0)
+                    wire(bits(num_rams - 1 - ram, n_rams), comparison_ram.I1)
+                    wire(write_image, and_ram.I0)
+                    wire(comparison_ram.O, and_ram.I1)
+                    write = and_ram.O
+                wire(io.WADDR[n_rams:], image_ram.WADDR[:n])
+                wire(reg_bank.O[0], image_ram.WADDR[n])
+                wire(bits(0, 7 - n), image_ram.WADDR[n + 1:])
+                wire(io.WDATA, image_ram.WDATA)
+                wire(enable(write), image_ram.WE)
+                wire(io.CLK, image_ram.WCLK)
+                wire(io.CYCLE, image_ram.RADDR[:n])
+                wire(io.BANK, image_ram.RADDR[n])
+                wire(bits(0, 7 - n), image_ram.RADDR[n + 1:])
+                wire(1, image_ram.RE)
+                wire(io.CLK, image_ram.RCLK)
+                wire(image_ram.RDATA, io.IMAGE[image * N + 16 * ram:image * N + 16 * (ram + 1)])
+        nand_bank = mantle.NAnd()
+        wire(reg_bank.O[0], nand_bank.I0)
+        wire(reg_bank.O[0], nand_bank.I1)
+        wire(nand_bank.O, reg_bank.I[0])
+        wire(io.START, reg_bank.CE)
+
+
+# write enables of the weight RAMs for a word of a weight row, the header selects the
+# lane and WADDR the RAM of the lane like in ImageBuffer, ROM_WIDX and ROM_WCYCLE are
+# the row and the block of the word
+class WeightDecoder(Circuit):
+    name = "WeightDecoder"
+    IO = ['HEADER', In(Bits(8)), 'WADDR', In(Bits(n_bytes - 1)), 'WE', In(Bit),
+          'ROM_WIDX', Out(Bits(b)), 'ROM_WCYCLE', Out(Bits(n)), 'ROM_WE', Out(Bits(num_lanes * num_rams))]
+    @classmethod
+    def definition(io):
+        for lane in range(num_lanes):
+            if num_lanes == 1:
+                write_lane = io.WE
+            else:
+                comparison_lane = mantle.EQ(n_lanes)
+                and_lane = mantle.And()
+                wire(io.HEADER[b:b + n_lanes], comparison_lane.I0)
+                wire(bits(lane, n_lanes), comparison_lane.I1)
+                wire(io.WE, and_lane.I0)
+                wire(comparison_lane.O, and_lane.I1)
+                write_lane = and_lane.O
+            for ram in range(num_rams):
+                if num_rams == 1:
+                    write = write_lane
+                else:
+                    comparison_ram = mantle.EQ(n_rams)
+                    and_ram = mantle.And()
+                    wire(io.WADDR[:n_rams], comparison_ram.I0)
+                    wire(bits(num_rams - 1 - ram, n_rams), comparison_ram.I1)
+                    wire(write_lane, and_ram.I0)
+                    wire(comparison_ram.O, and_ram.I1)
+                    write = and_ram.O
+                wire(write, io.ROM_WE[lane * num_rams + ram])
+        wire(io.HEADER[:b], io.ROM_WIDX)
+        wire(io.WADDR[n_rams:], io.ROM_WCYCLE)
+
+
+# a counter of n_perf bits, INC adds step and CLR clears it
+@lru_cache(maxsize=None)
+def DefinePerfCounter(step=1):
+    class PerfCounter(Circuit):
+        name = 'PerfCounter{}'.format(step)
+        IO = ['INC', In(Bit), 'CLR', In(Bit), 'CLK', In(Clock), 'O', Out(Bits(n_perf))]
+        @classmethod
+        def definition(io):
+            adder = mantle.Add(n_perf, cin=False, cout=False)
+            reg = mantle.Register(n_perf, has_ce=True, has_reset=True)
+            wire(io.CLK, reg.CLK)
+            wire(reg.O, adder.I0)
+            wire(bits(step, n_perf), adder.I1)
+            wire(adder.O, reg.I)
+            # the reset of the register is enabled by CE
+            or_ce = mantle.Or()
+            wire(io.INC, or_ce.I0)
+            wire(io.CLR, or_ce.I1)
+            wire(or_ce.O, reg.CE)
+            wire(io.CLR, reg.RESET)
+            wire(reg.O, io.O)
+    return PerfCounter
+
+
+# performance counters of the streamed pipeline
+# CYCLES counts every cycle, IMAGES the images classified, LATENCY is the number of cycles
+# from the last byte of a batch to its labels (D), measured for a batch that arrives while
+# no other one is in flight, and STALLS counts the cycles the sequencer does not score an image
+# REQUEST sends the counters as O and SEND like SendLabel, and they stop counting while
+# they are sent; CLEAR at the REQUEST clears them after the last byte
+class PerfCounters(Circuit):
+    name = "PerfCounters"
+    IO = ['START', In(Bit), 'VALID', In(Bit), 'D', In(Bit), 'REQUEST', In(Bit), 'CLEAR', In(Bit),
+          'READY', In(Bit), 'CLK', In(Clock), 'O', Out(Bits(8)), 'SEND', Out(Bit)]
+    @classmethod
+    def definition(io):
+        # send the 16 bytes of the counters
+        reg_send = mantle.DFF()
+        reg_clear = mantle.Register(1, has_ce=True)
+        adder_byte = mantle.Add(4, cin=False, cout=False)
+        reg_byte = mantle.Register(4, has_ce=True, has_reset=True)
+        wire(io.CLK, reg_send.CLK)
+        wire(io.CLK, reg_clear.CLK)
+        wire(io.CLK, reg_byte.CLK)
+        and_taken = mantle.And()
+        wire(reg_send.O, and_taken.I0)
+        wire(io.READY, and_taken.I1)
+        comparison_last = mantle.EQ(4)
+        wire(reg_byte.O, comparison_last.I0)
+        wire(bits(15, 4), comparison_last.I1)
+        and_last = mantle.And()
+        wire(and_taken.O, and_last.I0)
+        wire(comparison_last.O, and_last.I1)
+        nand_last = mantle.NAnd()
+        wire(and_last.O, nand_last.I0)
+        wire(and_last.O, nand_last.I1)
+        and_send = mantle.And()
+        wire(reg_send.O, and_send.I0)
+        wire(nand_last.O, and_send.I1)
+        or_send = mantle.Or()
+        wire(io.REQUEST, or_send.I0)
+        wire(and_send.O, or_send.I1)
+        wire(or_send.O, reg_send.I)
+        or_byte_ce = mantle.Or()
+        wire(io.REQUEST, or_byte_ce.I0)
+        wire(and_taken.O, or_byte_ce.I1)
+        wire(reg_byte.O, adder_byte.I0)
+        wire(bits(1, 4), adder_byte.I1)
+        wire(adder_byte.O, reg_byte.I)
+        wire(or_byte_ce.O, reg_byte.CE)
+        wire(io.REQUEST, reg_byte.RESET)
+        wire(io.CLEAR, reg_clear.I[0])
+        wire(io.REQUEST, reg_clear.CE)
+        and_clear = mantle.And()
+        wire(and_last.O, and_clear.I0)
+        wire(reg_clear.O[0], and_clear.I1)
+        clear = and_clear.O
+        # the counters stop while they are sent
+        nand_count = mantle.NAnd()
+        wire(reg_send.O, nand_count.I0)
+        wire(reg_send.O, nand_count.I1)
+        count = nand_count.O
+        # batches between their last byte and their labels, a START adds one and a D
+        # subtracts one
+        adder_flight = mantle.Add(2, cin=True, cout=False)
+        reg_flight = mantle.Register(2)
+        wire(io.CLK, reg_flight.CLK)
+        wire(reg_flight.O, adder_flight.I0)
+        wire(bits([io.D, io.D]), adder_flight.I1)
+        wire(io.START, adder_flight.CIN)
+        wire(adder_flight.O, reg_flight.I)
+        comparison_idle = mantle.EQ(2)
+        wire(reg_flight.O, comparison_idle.I0)
+        wire(bits(0, 2), comparison_idle.I1)
+        and_measure = mantle.And()
+        wire(io.START, and_measure.I0)
+        wire(comparison_idle.O, and_measure.I1)
+        reg_measure = mantle.DFF()
+        wire(io.CLK, reg_measure.CLK)
+        nand_done = mantle.NAnd()
+        wire(io.D, nand_done.I0)
+        wire(io.D, nand_done.I1)
+        and_measuring = mantle.And()
+        wire(reg_measure.O, and_measuring.I0)
+        wire(nand_done.O, and_measuring.I1)
+        or_measure = mantle.Or()
+        wire(and_measure.O, or_measure.I0)
+        wire(and_measuring.O, or_measure.I1)
+        wire(or_measure.O, reg_measure.I)
+        nand_stall = mantle.NAnd()
+        wire(io.VALID, nand_stall.I0)
+        wire(io.VALID, nand_stall.I1)
+        # CYCLES, IMAGES, LATENCY and STALLS
+        increments = [None, io.D, reg_measure.O, nand_stall.O]
+        steps = [1, num_images, 1, 1]
+        mux_byte = mantle.Mux(height=16, width=8)
+        wire(reg_byte.O, mux_byte.S)
+        for k, (increment, step) in enumerate(zip(increments, steps)):
+            counter = DefinePerfCounter(step)()
+            wire(io.CLK, counter.CLK)
+            if increment is None:
+                wire(count, counter.INC)
+            else:
+                and_inc = mantle.And()
+                wire(increment, and_inc.I0)
+                wire(count, and_inc.I1)
+                wire(and_inc.O, counter.INC)
+            if k == perf_names.index('LATENCY'):
+                # a new measurement starts from 0
+                or_clear = mantle.Or()
+                wire(and_measure.O, or_clear.I0)
+                wire(clear, or_clear.I1)
+                wire(or_clear.O, counter.CLR)
+            else:
+                wire(clear, counter.CLR)
+            for i in range(n_perf // 8):
+                byte = getattr(mux_byte, 'I{}'.format(k * n_perf // 8 + i))
+                wire(counter.O[n_perf - 8 * (i + 1):n_perf - 8 * i], byte)
+        wire(mux_byte.O, io.O)
+        wire(reg_send.O, io.SEND)
+
+
+# Pipeline for streamed images: DATA and VALID are the bytes of the UART receiver,
+# O[image * b:(image + 1) * b] are the labels of the last batch and D is high for one cycle
+# when O changes to them
+# images can be sent back to back, a batch is loaded while the one before is classified,
+# weights should only be sent while no image is classified
+# READY is low while a loaded image waits for its turn and no byte may be written
+# PERF_O and PERF_VALID are the bytes of the performance counters, they are sent while
+# PERF_READY is high; the counters should only be read while no image is classified
+class StreamPipeline(Circuit):
+    name = "StreamPipeline"
+    IO = ['DATA', In(Bits(8)), 'VALID', In(Bit), 'CLK', In(Clock),
+          'O', Out(Bits(b * num_images)), 'D', Out(Bit), 'READY', Out(Bit)]
+    if perf_counters:
+        IO += ['PERF_O', Out(Bits(8)), 'PERF_VALID', Out(Bit), 'PERF_READY', In(Bit)]
+    @classmethod
+    def definition(io):
+        # LD - collect an image or a row of weights, the last byte of an image starts
+        # the classification
+        receiver = Receiver()
+        image_buffer = ImageBuffer()
+        weight_decoder = WeightDecoder()
+        wire(io.CLK, receiver.CLK)
+        wire(io.CLK, image_buffer.CLK)
+        wire(io.DATA, receiver.DATA)
+        wire(io.VALID, receiver.VALID)
+        wire(receiver.WADDR, image_buffer.WADDR)
+        wire(receiver.WDATA, image_buffer.WDATA)
+        wire(receiver.IMAGE_WE, image_buffer.WE)
+        wire(receiver.START, image_buffer.START)
+        if num_images > 1:
+            wire(receiver.SLOT, image_buffer.SLOT)
+        wire(receiver.HEADER, weight_decoder.HEADER)
+        wire(receiver.WADDR, weight_decoder.WADDR)
+        wire(receiver.WEIGHT_WE, weight_decoder.WE)
+        # IF - get cycle_id, label_index_id
+        sequencer = Sequencer()
+        wire(io.CLK, sequencer.CLK)
+        wire(receiver.START, sequencer.START)
+        # RR - get weight block, image block of N bits, both memories register the read
+        weight_rom = DefineWeightROM(has_write=True)()
+        reg_2 = mantle.Register(b + n + 1)
+        wire(io.CLK, weight_rom.CLK)
+        wire(weight_decoder.ROM_WIDX, weight_rom.WIDX)
+        wire(weight_decoder.ROM_WCYCLE, weight_rom.WCYCLE)
+        wire(receiver.WDATA, weight_rom.WDATA)
+        wire(weight_decoder.ROM_WE, weight_rom.WE)
+        wire(io.CLK, reg_2.CLK)
+        wire(sequencer.IDX, weight_rom.IDX)
+        wire(sequencer.CYCLE, weight_rom.CYCLE)
+        wire(sequencer.CYCLE, image_buffer.CYCLE)
+        wire(sequencer.BANK, image_buffer.BANK)
+        nand_ready = mantle.NAnd()
+        wire(sequencer.PENDING, nand_ready.I0)
+        wire(sequencer.PENDING, nand_ready.I1)
+        wire(nand_ready.O, io.READY)
+        wire(concat(sequencer.IDX, sequencer.CYCLE, bits([sequencer.VALID])), reg_2.I)
+        # EX - NXOr for multiplication, pop count and accumulate the result for activation
+        execute = DefineExecute(num_images)()
+        wire(io.CLK, execute.CLK)
+        wire(weight_rom.WEIGHT, execute.WEIGHT)
+        wire(image_buffer.IMAGE, execute.IMAGE)
+        wire(reg_2.O[:b], execute.IDX)
+        wire(reg_2.O[b:b + n], execute.CYCLE)
+        wire(reg_2.O[b + n], execute.VALID)
+        # CF - classify the images, the complete count of the first row starts a new maximum
+        # every image has its own Select and Classifier, their tags are all the same
+        classifiers = []
+        for image in range(num_images):
+            counts = execute.COUNT[image * num_lanes * n_bc_adder:(image + 1) * num_lanes * n_bc_adder]
+            select = Select()
+            classifier = DefineClassifier(has_load=True)()
+            wire(io.CLK, select.CLK)
+            wire(io.CLK, classifier.CLK)
+            wire(counts, select.COUNT)
+            wire(execute.COUNT_IDX, select.IDX)
+            wire(execute.COUNT_CYCLE, select.CYCLE)
+            wire(execute.COUNT_VALID, select.VALID)
+            wire(select.O, classifier.I)
+            wire(select.O_IDX, classifier.IDX)
+            classifiers.append(classifier)
+        reg_4 = mantle.Register(b + n + 1)
+        wire(io.CLK, reg_4.CLK)
+        comparison_4_1 = mantle.EQ(b)
+        comparison_4_2 = mantle.EQ(n)
+        and_gate_4_1 = mantle.And()
+        and_gate_4_2 = mantle.And()
+        wire(select.O_ROW, comparison_4_1.I0)
+        wire(bits(0, b), comparison_4_1.I1)
+        wire(select.O_CYCLE, comparison_4_2.I0)
+        wire(bits(num_cycles - 1, n), comparison_4_2.I1)
+        wire(comparison_4_1.O, and_gate_4_1.I0)
+        wire(comparison_4_2.O, and_gate_4_1.I1)
+        wire(and_gate_4_1.O, and_gate_4_2.I0)
+        wire(select.O_VALID, and_gate_4_2.I1)
+        for classifier in classifiers:
+            wire(and_gate_4_2.O, classifier.LOAD)
+        wire(concat(select.O_ROW, select.O_CYCLE, bits([select.O_VALID])), reg_4.I)
+        # WB - show the result of the last cycle of the last idx
+        reg_5 = mantle.Register(b * num_images, has_ce=True)
+        reg_6 = mantle.DFF()
+        comparison_5_1 = mantle.EQ(b)
+        comparison_5_2 = mantle.EQ(n)
+        and_gate_5_1 = mantle.And()
+        and_gate_5_2 = mantle.And()
+        wire(io.CLK, reg_5.CLK)
+        wire(io.CLK, reg_6.CLK)
+        for image, classifier in enumerate(classifiers):
+            wire(classifier.O, reg_5.I[image * b:(image + 1) * b])
+        wire(reg_4.O[:b], comparison_5_1.I0)
+        wire(bits(last_idx, b), comparison_5_1.I1)
+        wire(reg_4.O[b:b + n], comparison_5_2.I0)
+        wire(bits(num_cycles - 1, n), comparison_5_2.I1)
+        wire(comparison_5_1.O, and_gate_5_1.I0)
+        wire(comparison_5_2.O, and_gate_5_1.I1)
+        wire(and_gate_5_1.O, and_gate_5_2.I0)
+        wire(reg_4.O[b + n], and_gate_5_2.I1)
+        wire(and_gate_5_2.O, reg_5.CE)
+        wire(and_gate_5_2.O, reg_6.I)
+        wire(reg_5.O, io.O)
+        wire(reg_6.O, io.D)
+        if perf_counters:
+            counters = PerfCounters()
+            wire(io.CLK, counters.CLK)
+            wire(receiver.START, counters.START)
+            wire(sequencer.VALID, counters.VALID)
+            wire(reg_6.O, counters.D)
+            wire(receiver.REQUEST, counters.REQUEST)
+            wire(receiver.HEADER[0], counters.CLEAR)
+            wire(io.PERF_READY, counters.READY)
+            wire(counters.O, io.PERF_O)
+            wire(counters.SEND, io.PERF_VALID)
+
+
+# send the labels of D over the UART transmitter, one byte per image of the batch,
+# VALID is held until READY takes a byte
+# I holds the labels until the next batch is classified, which takes much longer
+class SendLabel(Circuit):
+    name = "SendLabel"
+    IO = ['I', In(Bits(b * num_images)), 'D', In(Bit), 'READY', In(Bit), 'CLK', In(Clock),
+          'O', Out(Bits(8)), 'VALID', Out(Bit)]
+    @classmethod
+    def definition(io):
+        reg_valid = mantle.DFF()
+        wire(io.CLK, reg_valid.CLK)
+        nand_gate = mantle.NAnd()
+        wire(io.READY, nand_gate.I0)
+        and_gate = mantle.And()
+        wire(reg_valid.O, and_gate.I0)
+        wire(nand_gate.O, and_gate.I1)
+        or_gate = mantle.Or()
+        wire(io.D, or_gate.I0)
+        wire(and_gate.O, or_gate.I1)
+        wire(or_gate.O, reg_valid.I)
+        if num_images == 1:
+            wire(reg_valid.O, nand_gate.I1)
+            wire(io.I, io.O[:b])
+        else:
+            # the byte taken by READY moves to the next image, the last one ends VALID
+            and_sent = mantle.And()
+            wire(reg_valid.O, and_sent.I0)
+            wire(io.READY, and_sent.I1)
+            adder_slot = mantle.Add(n_images, cin=False, cout=False)
+            reg_slot = mantle.Register(n_images, has_ce=True, has_reset=True)
+            comparison_slot = mantle.EQ(n_images)
+            wire(io.CLK, reg_slot.CLK)
+            wire(reg_slot.O, adder_slot.I0)
+            wire(bits(1, n_images), adder_slot.I1)
+            wire(adder_slot.O, reg_slot.I)
+            wire(reg_slot.O, comparison_slot.I0)
+            wire(bits(num_images - 1, n_images), comparison_slot.I1)
+            wire(and_sent.O, reg_slot.CE)
+            wire(comparison_slot.O, reg_slot.RESET)
+            and_last = mantle.And()
+            wire(reg_valid.O, and_last.I0)
+            wire(comparison_slot.O, and_last.I1)
+            wire(and_last.O, nand_gate.I1)
+            mux_label = mantle.Mux(height=2 ** n_images, width=b)
+            for image in range(2 ** n_images):
+                label = getattr(mux_label, 'I{}'.format(image))
+                if image < num_images:
+                    wire(io.I[image * b:(image + 1) * b], label)
+                else:
+                    wire(bits(0, b), label)
+            # a Mux of 2 selects with a Bit
+            wire(reg_slot.O if n_images > 1 else reg_slot.O[0], mux_label.S)
+            wire(mux_label.O, io.O[:b])
+        wire(bits(0, 8 - b), io.O[b:])
+        wire(reg_valid.O, io.VALID)
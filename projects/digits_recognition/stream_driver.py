@@ -0,0 +1,146 @@
+"""
+Host side of stream_main.py: send images to the icestick over the UART and
+compare the labels it sends back with the golden model.
+
+With --load-weights the weight matrix of the checkpoint is written into the
+weight RAMs first, so a retrained BNN.pkl runs without a new synthesis.
+With --counters the performance counters of the design are cleared before
+the images are sent and read after them, which gives the throughput, the
+latency and the stalls measured on the device.
+
+usage: python stream_driver.py usb_path [--mnist MNIST_data] [--count C] [--batch K] [--window W]
+                               [--checkpoint BNN.pkl --load-weights [--lanes P]] [--counters]
+"""
+import argparse
+import struct
+import time
+
+import numpy as np
+import serial
+
+import golden
+
+
+# bit 7 of the header of a packet marks a row of weights
+WEIGHTS = 0x80
+# a header without data that reads the performance counters, bit 0 clears them
+COUNTERS = 0x40
+CLEAR = 0x01
+# the performance counters in the order they are sent, 32 bits each, most significant byte first
+counter_names = ['cycles', 'images', 'latency', 'stalls']
+
+
+def packet(header, row):
+    return bytes([header]) + np.packbits(np.asarray(row) > 0).tobytes()
+
+
+def load_weights(ser, weights, num_lanes=1):
+    """Write the rows of the weight matrix into the weight RAMs.
+
+    Row `c` is scored by lane `c % num_lanes` in the round of idx
+    `c - c % num_lanes`, the header holds the idx in bits [0, b) and the lane
+    in the bits above it.
+    """
+    b = int(np.ceil(np.log2(len(weights))))
+    for c, row in enumerate(weights):
+        lane = c % num_lanes
+        ser.write(packet(WEIGHTS | lane << b | (c - lane), row))
+    ser.flush()
+
+
+def read_counters(ser, clear=False):
+    """Read the performance counters of the design, {name: value}.
+
+    They should only be read while no image is classified, otherwise the
+    labels are sent in between.
+    """
+    ser.write(bytes([COUNTERS | (CLEAR if clear else 0)]))
+    received = ser.read(4 * len(counter_names))
+    if len(received) < 4 * len(counter_names):
+        raise IOError('no performance counters received')
+    return dict(zip(counter_names, struct.unpack('>{}I'.format(len(counter_names)), received)))
+
+
+def classify(ser, images, batch=1, window=2):
+    """Send binarized images and read back one label each.
+
+    The design classifies `batch` images (num_images) at a time, the last
+    batch is padded with blank images.  Up to `window` batches are in flight,
+    so the next batch is loaded into the image buffer while the one before it
+    is classified.
+    """
+    images = np.asarray(images)
+    pad = -len(images) % batch
+    if pad:
+        images = np.concatenate([images, np.zeros((pad,) + images.shape[1:], images.dtype)])
+    labels = []
+
+    def read_labels():
+        received = ser.read(batch)
+        if len(received) < batch:
+            raise IOError('no labels received for batch {}'.format(len(labels) // batch))
+        labels.extend(received)
+
+    for i in range(0, len(images), batch):
+        if i >= window * batch:
+            read_labels()
+        ser.write(b''.join(packet(0, image) for image in images[i:i + batch]))
+    while len(labels) < len(images):
+        read_labels()
+    return np.array(labels[:len(images) - pad])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('usb_path')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--checkpoint', default=golden.filename)
+    parser.add_argument('--mnist', metavar='DIR',
+                        help='classify the MNIST test set in DIR instead of the images of the checkpoint')
+    parser.add_argument('--count', type=int, default=None, help='number of images to send')
+    parser.add_argument('--batch', type=int, default=1, help='num_images of the design')
+    parser.add_argument('--window', type=int, default=2,
+                        help='batches in flight, 1 waits for the labels of every batch')
+    parser.add_argument('--load-weights', action='store_true',
+                        help='write the weights of the checkpoint before classifying')
+    parser.add_argument('--lanes', type=int, default=1, help='num_lanes of the design')
+    parser.add_argument('--counters', action='store_true',
+                        help='report the performance counters of the design')
+    args = parser.parse_args()
+
+    checkpoint = golden.load_checkpoint(args.checkpoint)
+    if args.mnist:
+        images, labels = golden.load_mnist_test(args.mnist, golden.image_size(checkpoint))
+    else:
+        images, labels = checkpoint['imgs'], np.arange(len(checkpoint['imgs']))
+    images, labels = images[:args.count], labels[:args.count]
+    expected = golden.classify(golden.pack_images(images), golden.pack_images(checkpoint['weights']))
+
+    with serial.Serial(args.usb_path, args.baud, timeout=1) as ser:
+        if args.load_weights:
+            start = time.perf_counter()
+            load_weights(ser, checkpoint['weights'], args.lanes)
+            print('weights loaded in {:.3f} s'.format(time.perf_counter() - start))
+        if args.counters:
+            read_counters(ser, clear=True)
+        start = time.perf_counter()
+        predictions = classify(ser, images, args.batch, args.window)
+        elapsed = time.perf_counter() - start
+        if args.counters:
+            counters = read_counters(ser)
+
+    print('{} images in {:.3f} s, {:.0f} images/s'.format(
+        len(images), elapsed, len(images) / elapsed))
+    print('accuracy {:.4f}, {} mismatches with the golden model'.format(
+        np.mean(predictions == labels), np.sum(predictions != expected)))
+    if args.counters:
+        # the cycles run from the first read of the counters to the second one
+        seconds = counters['cycles'] / golden.fpga_clock
+        print('device: {images} images in {cycles} cycles, {latency} cycles latency, '
+              '{stalls} stall cycles'.format(**counters))
+        print('device: {:.0f} images/s, {:.1%} of the cycles scoring'.format(
+            counters['images'] / seconds, 1 - counters['stalls'] / counters['cycles']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+from magma import *
+import mantle
+from loam.boards.icestick import IceStick
+from stream import StreamPipeline, SendLabel, RXMOD, TXMOD, perf_counters
+
+
+icestick = IceStick()
+icestick.Clock.on()
+icestick.RX.input().on()
+icestick.TX.output().on()
+icestick.D1.on()
+icestick.D2.on()
+icestick.D3.on()
+icestick.D4.on()
+icestick.D5.on()
+
+main = icestick.main()
+
+# the UART needs the 12 MHz clock, so the pipeline runs at 12 MHz too
+rx = RXMOD()
+tx = TXMOD()
+pipeline = StreamPipeline()
+send_label = SendLabel()
+wire(main.CLKIN, rx.CLK)
+wire(main.CLKIN, tx.CLK)
+wire(main.CLKIN, pipeline.CLK)
+wire(main.CLKIN, send_label.CLK)
+wire(main.RX, rx.RX)
+wire(rx.data, pipeline.DATA)
+wire(rx.valid, pipeline.VALID)
+wire(pipeline.O, send_label.I)
+wire(pipeline.D, send_label.D)
+wire(tx.ready, send_label.READY)
+if perf_counters:
+    # the labels go first, the counters are sent while there is no label
+    nand_label = mantle.NAnd()
+    wire(send_label.VALID, nand_label.I0)
+    wire(send_label.VALID, nand_label.I1)
+    and_ready = mantle.And()
+    wire(tx.ready, and_ready.I0)
+    wire(nand_label.O, and_ready.I1)
+    wire(and_ready.O, pipeline.PERF_READY)
+    mux_data = mantle.Mux(height=2, width=8)
+    wire(pipeline.PERF_O, mux_data.I0)
+    wire(send_label.O, mux_data.I1)
+    wire(send_label.VALID, mux_data.S)
+    or_valid = mantle.Or()
+    wire(send_label.VALID, or_valid.I0)
+    wire(pipeline.PERF_VALID, or_valid.I1)
+    wire(mux_data.O, tx.data)
+    wire(or_valid.O, tx.valid)
+else:
+    wire(send_label.O, tx.data)
+    wire(send_label.VALID, tx.valid)
+wire(tx.TX, main.TX)
+wire(pipeline.O[:4], bits([main.D1, main.D2, main.D3, main.D4]))
+# light 5 indicates that a prediction has been sent
+reg_done = mantle.DFF()
+or_gate = mantle.Or()
+wire(main.CLKIN, reg_done.CLK)
+wire(pipeline.D, or_gate.I0)
+wire(reg_done.O, or_gate.I1)
+wire(or_gate.O, reg_done.I)
+wire(reg_done.O, main.D5)
+
+EndCircuit()
@@ -0,0 +1,220 @@
+"""
+Sweep the layout of the digits recognition `Pipeline` over N, num_cycles and num_lanes.
+
+Every point of the sweep runs in a process pool and is built in a directory
+of its own, build/sweep/N{N}-c{num_cycles}-l{num_lanes}:
+
+- magma elaborates main.py, modules.py reads the layout of the point from
+  BNN_N, BNN_NUM_CYCLES and BNN_NUM_LANES
+- export_roms.py writes the ROM contents of the point, the ROMs are read
+  back in the order the pipeline reads them and scored like golden.py, which
+  checks the layout and gives its accuracy (the checkpoint images are the
+  digits 0 to 9, with --mnist also the MNIST test set)
+- yosys synthesizes it and counts the SB_LUT4 and SB_RAM40_4K cells,
+  arachne-pnr places and routes it and icetime reports its Fmax
+
+An image takes ceil(num_classes / num_lanes) * num_cycles cycles.  A point
+is on the Pareto front when no other point has at least its throughput at
+Fmax with at most its LUTs and BRAMs.
+
+usage: python sweep.py [--N 16 32 64] [--lanes 1 2 5 10] [--jobs J] [--mnist MNIST_data]
+"""
+import argparse
+import contextlib
+import csv
+import math
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import bram_patch
+import golden
+
+
+sweep_dir = os.path.join('build', 'sweep')
+num_classes = 10
+# number of SB_RAM40_4K of the hx1k on the icestick
+num_brams = 16
+# cells in the output of the yosys stat command
+cell_pattern = re.compile(r"^\s*(SB_LUT4|SB_RAM40_4K)\s+(\d+)\s*$", re.MULTILINE)
+columns = ['N', 'num_cycles', 'num_lanes', 'luts', 'brams', 'fmax', 'cycles',
+           'images_per_s', 'accuracy', 'mnist_accuracy', 'pareto', 'error']
+
+
+def tag(point):
+    return 'N{}-c{}-l{}'.format(*point)
+
+
+def cycles_per_image(point):
+    N, num_cycles, num_lanes = point
+    return -(-num_classes // num_lanes) * num_cycles
+
+
+def bram_count(point):
+    """BRAMs of the weight ROMs and of the image ROM of ReadROM."""
+    N, num_cycles, num_lanes = point
+    num_roms = int(math.ceil(cycles_per_image(point) / 256))
+    return num_lanes * N // 16 * num_roms + (N // 16 if num_cycles > 16 else 0)
+
+
+def points(pixels, widths, lanes):
+    """The layouts of the sweep and the reason a layout is skipped, or None."""
+    for N in widths:
+        for num_lanes in lanes:
+            point = (N, pixels // N, num_lanes)
+            if N % 16 or pixels % N:
+                yield point, 'N * num_cycles is not {}'.format(pixels)
+            elif pixels // N < 2:
+                yield point, 'needs at least 2 cycles'
+            elif bram_count(point) > num_brams:
+                yield point, 'needs {} BRAMs'.format(bram_count(point))
+            else:
+                yield point, None
+
+
+def read_roms(roms, point, num_images):
+    """Weight and image words of the exported ROMs, in the layout of golden.pack_images.
+
+    Row idx is read from the ROMs of lane idx % num_lanes at
+    idx / num_lanes * num_cycles + cycle, word j of a block holds its bits
+    [16 * j, 16 * (j + 1)) which are word N / 16 - 1 - j of pack_images.
+    """
+    N, num_cycles, num_lanes = point
+    num_rams = N // 16
+
+    def read(name):
+        with open(os.path.join(roms, name + '.hex')) as hex_file:
+            return [int(line, 16) for line in hex_file]
+
+    weights = np.zeros((num_classes, num_cycles * num_rams), dtype=np.uint16)
+    for idx in range(num_classes):
+        for cycle in range(num_cycles):
+            addr = idx // num_lanes * num_cycles + cycle
+            for j in range(num_rams):
+                rom = read('weights-l{}-j{}-r{}'.format(idx % num_lanes, j, addr // 256))
+                weights[idx, cycle * num_rams + num_rams - 1 - j] = rom[addr % 256]
+    images = np.zeros((num_images, num_cycles * num_rams), dtype=np.uint16)
+    for k in range(num_images):
+        if num_cycles <= 16:
+            luts = read('image{}-luts'.format(k))
+        for j in range(num_rams):
+            for cycle in range(num_cycles):
+                if num_cycles <= 16:
+                    word = sum((luts[16 * j + i] >> cycle & 1) << i for i in range(16))
+                else:
+                    word = read('image{}-j{}'.format(k, j))[cycle]
+                images[k, cycle * num_rams + num_rams - 1 - j] = word
+    return weights, images
+
+
+def utilization(stat):
+    with open(stat) as stat_file:
+        cells = dict(cell_pattern.findall(stat_file.read()))
+    return {'luts': int(cells.get('SB_LUT4', 0)), 'brams': int(cells.get('SB_RAM40_4K', 0))}
+
+
+def build_point(point, magma, checkpoint, clock, mnist=None):
+    """Build, simulate and time a point, returns its row of the report."""
+    N, num_cycles, num_lanes = point
+    directory = os.path.join(sweep_dir, tag(point))
+    name = os.path.join(directory, 'main')
+    os.makedirs(directory, exist_ok=True)
+    env = dict(os.environ, BNN_N=str(N), BNN_NUM_CYCLES=str(num_cycles), BNN_NUM_LANES=str(num_lanes))
+    row = {'N': N, 'num_cycles': num_cycles, 'num_lanes': num_lanes, 'cycles': cycles_per_image(point)}
+    with open(name + '.log', 'w') as log, contextlib.redirect_stdout(log):
+        def run(*command):
+            print(' '.join(command), flush=True)
+            subprocess.check_call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        try:
+            run(magma, '-b', 'icestick', '-d', directory, 'main.py')
+            roms = os.path.join(directory, 'roms')
+            run(sys.executable, 'export_roms.py', '--checkpoint', checkpoint, '--out', roms)
+            labels = np.arange(num_classes)
+            weights, images = read_roms(roms, point, len(labels))
+            row['accuracy'] = np.mean(golden.classify(images, weights, threads=1) == labels)
+            if mnist is not None:
+                row['mnist_accuracy'] = np.mean(golden.classify(mnist[0], weights, threads=1) == mnist[1])
+            run('yosys', '-q', '-p', 'synth_ice40 -top main -blif {0}.blif; tee -q -o {0}.stat stat'.format(name),
+                name + '.v')
+            row.update(utilization(name + '.stat'))
+            run('arachne-pnr', '-q', '-d', '1k', '-o', name + '.txt', '-p', name + '.pcf', name + '.blif')
+            row['fmax'] = bram_patch.timing_report(name, clock)
+            row['images_per_s'] = row['fmax'] * 1e6 / row['cycles']
+        except (subprocess.CalledProcessError, OSError) as error:
+            row['error'] = '{}, see {}.log'.format(error, name)
+    return row
+
+
+def pareto(rows):
+    """Mark the rows no other row beats in throughput, LUTs and BRAMs."""
+    costs = {id(row): (-row['images_per_s'], row['luts'], row['brams']) for row in rows if 'images_per_s' in row}
+    for row in rows:
+        if id(row) in costs:
+            cost = costs[id(row)]
+            row['pareto'] = not any(other != cost and all(a <= b for a, b in zip(other, cost))
+                                    for other in costs.values())
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--N', type=int, nargs='+', default=[16, 32, 64, 128], help='operand widths')
+    parser.add_argument('--lanes', type=int, nargs='+', default=[1, 2, 5, 10], help='numbers of lanes')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--checkpoint', default=golden.filename)
+    parser.add_argument('--magma', default=os.path.join('..', '..', 'bin', 'magma'))
+    parser.add_argument('--clock', type=float, default=12, help='clock in MHz for the timing report')
+    parser.add_argument('--mnist', metavar='DIR', help='also score the MNIST test set in DIR')
+    parser.add_argument('--csv', default=os.path.join(sweep_dir, 'sweep.csv'))
+    args = parser.parse_args()
+
+    checkpoint = golden.load_checkpoint(args.checkpoint)
+    # Pipeline of main.py is a single layer, layers_main.py builds the others
+    if 'layers' in checkpoint or 'weights' not in checkpoint:
+        parser.error('{} has hidden layers, sweeps only support single-layer checkpoints'.format(
+            args.checkpoint))
+    pixels = np.shape(checkpoint['weights'])[1]
+    mnist = None
+    if args.mnist:
+        images, labels = golden.load_mnist_test(args.mnist, golden.image_size(checkpoint))
+        mnist = golden.pack_images(images), labels
+
+    rows = []
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = []
+        for point, skipped in points(pixels, args.N, args.lanes):
+            if skipped:
+                rows.append({'N': point[0], 'num_cycles': point[1], 'num_lanes': point[2], 'error': skipped})
+            else:
+                futures.append(pool.submit(build_point, point, args.magma, args.checkpoint, args.clock, mnist))
+        for future in futures:
+            row = future.result()
+            print('{}: {}'.format(tag((row['N'], row['num_cycles'], row['num_lanes'])), row.get('error', 'done')))
+            rows.append(row)
+    rows = pareto(sorted(rows, key=lambda row: (row['N'], row['num_lanes'])))
+
+    os.makedirs(os.path.dirname(args.csv) or '.', exist_ok=True)
+    with open(args.csv, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print('{:>4} {:>6} {:>5} {:>5} {:>5} {:>7} {:>6} {:>9} {:>8}  {}'.format(
+        'N', 'blocks', 'lanes', 'LUTs', 'BRAMs', 'Fmax', 'cycles', 'images/s', 'accuracy', 'pareto'))
+    for row in rows:
+        if 'images_per_s' not in row:
+            print('{:>4} {:>6} {:>5}  {}'.format(row['N'], row['num_cycles'], row['num_lanes'], row['error']))
+            continue
+        print('{:>4} {:>6} {:>5} {:>5} {:>5} {:>7.2f} {:>6} {:>9.0f} {:>8.4f}  {}'.format(
+            row['N'], row['num_cycles'], row['num_lanes'], row['luts'], row['brams'], row['fmax'],
+            row['cycles'], row['images_per_s'], row.get('mnist_accuracy', row['accuracy']),
+            '*' if row['pareto'] else ''))
+    print('{}: {} points'.format(args.csv, len(rows)))
+
+
+if __name__ == '__main__':
+    main()
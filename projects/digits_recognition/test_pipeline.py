@@ -0,0 +1,196 @@
+"""
+Elaborate Pipeline and check its class against the golden model.
+
+modules.py reads N, num_cycles and num_lanes when it is imported, so every
+layout is simulated in a python of its own, with the environment of
+sweep.py.  The modules are written for the magma of the IceStick flow,
+IO = [...] circuits and its PythonSimulator; the tests are skipped with a
+magma that cannot elaborate them.
+
+    python -m pytest test_pipeline.py
+"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import golden
+
+
+project_dir = os.path.dirname(os.path.abspath(__file__))
+env = dict(os.environ, MANTLE_TARGET='ice40')
+
+# a circuit in the style of modules.py, with the simulator the tests use
+probe = '''
+from magma import *
+import mantle
+from magma.simulator import PythonSimulator
+class Probe(Circuit):
+    IO = ['O', Out(Bits(4)), 'CLK', In(Clock)]
+    @classmethod
+    def definition(io):
+        reg = mantle.Register(4, has_reset=True)
+        adder = mantle.Add(4, cin=False, cout=False)
+        wire(reg.O, adder.I0)
+        wire(bits(1, 4), adder.I1)
+        wire(adder.O, reg.I)
+        wire(0, reg.RESET)
+        wire(reg.O, io.O)
+'''
+
+
+def check_output(*args, **kwargs):
+    return subprocess.check_output([sys.executable, '-c'] + list(args), cwd=project_dir,
+                                   stderr=subprocess.STDOUT, universal_newlines=True, **kwargs)
+
+
+def old_magma():
+    """None when magma elaborates the circuits of modules.py, else why not."""
+    try:
+        check_output(probe, env=env)
+    except subprocess.CalledProcessError as error:
+        return error.output.strip().split('\n')[-1]
+    return None
+
+
+magma_error = old_magma()
+requires_old_magma = pytest.mark.skipif(magma_error is not None,
+                                        reason='magma cannot elaborate IO = [...] circuits: {}'.format(magma_error))
+# the PLL is compiled through coreir, which the magma of modules.py does not have
+requires_coreir = pytest.mark.skipif(magma_error is None, reason='magma has no coreir-verilog output')
+
+# simulate Pipeline until D and print image_id and O
+simulate = '''
+import sys
+from magma.simulator import PythonSimulator
+import modules
+top = modules.Pipeline
+simulator = PythonSimulator(top, clock=top.CLK)
+for cycle in range(int(sys.argv[1])):
+    simulator.advance(2)
+    if simulator.get_value(top.D):
+        break
+else:
+    sys.exit('no D after {} cycles'.format(sys.argv[1]))
+print(modules.image_id, sum(int(bit) << i for i, bit in enumerate(simulator.get_value(top.O))))
+'''
+
+
+def run_pipeline(N, num_cycles, num_lanes):
+    checkpoint = golden.load_checkpoint(os.path.join(project_dir, golden.filename))
+    max_cycles = len(checkpoint['weights']) * num_cycles + 64
+    layout_env = dict(env, BNN_N=str(N), BNN_NUM_CYCLES=str(num_cycles), BNN_NUM_LANES=str(num_lanes))
+    output = check_output(simulate, str(max_cycles), env=layout_env)
+    image_id, label = map(int, output.split()[-2:])
+    expected = golden.classify(golden.pack_images(checkpoint['imgs'][image_id:image_id + 1]),
+                               golden.pack_images(checkpoint['weights']))[0]
+    return label, expected
+
+
+# the ROMs and LUTs of Pipeline are filled by load_contents
+@requires_old_magma
+def test_pipeline():
+    label, expected = run_pipeline(16, 16, 1)
+    assert label == expected
+
+
+# lanes score num_lanes classes a round, the last round has the classes left over;
+# 10 lanes score every class in one round and the weight ROMs hold a row each
+@requires_old_magma
+@pytest.mark.parametrize('num_lanes', [2, 3, 10])
+def test_pipeline_lanes(num_lanes):
+    label, expected = run_pipeline(16, 16, num_lanes)
+    assert label == expected
+
+
+# count the ones of random words with BitCounter(n, stages), the registers
+# of the stages delay O by a cycle each
+count_bits = '''
+import sys
+import numpy as np
+from magma import *
+from magma.simulator import PythonSimulator
+import modules
+n, stages = int(sys.argv[1]), int(sys.argv[2])
+top = modules.DefineBitCounter(n, stages)
+simulator = PythonSimulator(top, clock=top.CLK if stages else None)
+random = np.random.RandomState(n)
+words = [random.randint(2, size=n) for _ in range(8)]
+for word in words + stages * [words[-1]]:
+    simulator.set_value(top.I, [bool(bit) for bit in word])
+    if stages:
+        simulator.advance(2)
+    else:
+        simulator.evaluate()
+    print(sum(int(bit) << i for i, bit in enumerate(simulator.get_value(top.O))))
+'''
+
+
+@requires_old_magma
+@pytest.mark.parametrize('n, stages', [(16, 0), (7, 0), (49, 0), (49, 1), (256, 2)])
+def test_bit_counter(n, stages):
+    output = check_output(count_bits, str(n), str(stages), env=env)
+    counts = list(map(int, output.split()[-8:]))
+    random = np.random.RandomState(n)
+    assert counts == [int(random.randint(2, size=n).sum()) for _ in range(8)]
+
+
+# a checkpoint trained with hidden = [64] in MNIST_XNORNet.ipynb leaves the
+# weight ROMs empty but packs the images like a single-layer checkpoint
+pack_layers = '''
+import pickle
+import numpy as np
+import modules
+checkpoint = pickle.load(open(modules.filename, 'rb'))
+weights_roms, image_words = modules.pack_contents(checkpoint)
+random = np.random.RandomState(0)
+layers = [random.randint(2, size=(64, 256)), random.randint(2, size=(10, 64))]
+layers_roms, layers_words = modules.pack_contents({'imgs': checkpoint['imgs'], 'weights': layers[-1],
+                                                   'layers': layers})
+assert layers_roms.size == 0 and weights_roms.size > 0
+assert np.array_equal(layers_words, image_words)
+'''
+
+
+@requires_old_magma
+def test_pack_contents_layers():
+    check_output(pack_layers, env=env)
+
+
+# compile a PLL of 48 MHz to verilog and print it, the string parameters of
+# SB_PLL40_CORE are quoted by the backend
+compile_pll = '''
+import os
+import sys
+from magma import *
+from pll import DefinePLL
+PLL = DefinePLL(48e6)
+class Top(Circuit):
+    name = 'Top'
+    IO = ['CLKIN', In(Clock), 'O', Out(Clock)]
+    @classmethod
+    def definition(io):
+        pll = PLL()
+        wire(io.CLKIN, pll.CLKIN)
+        wire(pll.CLK, io.O)
+compile(os.path.join(sys.argv[1], 'pll'), Top, output='coreir-verilog')
+print(open(os.path.join(sys.argv[1], 'pll.v')).read())
+'''
+
+
+@requires_coreir
+def test_pll_verilog(tmpdir):
+    verilog = check_output(compile_pll, str(tmpdir), env=env)
+    assert '.FEEDBACK_PATH("SIMPLE")' in verilog
+    assert '.PLLOUT_SELECT("GENCLK")' in verilog
+    assert ".DIVF(7'h3f)" in verilog
+
+
+# out of the PLLOUT range, and 270 MHz the closest to 275 MHz
+@pytest.mark.parametrize('freq_out', [10e6, 300e6, 275e6])
+def test_pll_params_out_of_range(freq_out):
+    import pll
+    with pytest.raises(ValueError):
+        pll.pll_params(freq_out)